@@ -0,0 +1,46 @@
+"""Blackjack rules shared by the /blackjack command and blackjack_sim.py.
+
+Infinite deck: every draw is an independent uniform pick from CARD_NAMES. Player and dealer
+both draw until they reach STAND_ON.
+"""
+import random
+
+CARD_VALUES = {
+    "2": 2, "3": 3, "4": 4, "5": 5, "6": 6,
+    "7": 7, "8": 8, "9": 9, "10": 10,
+    "J": 10, "Q": 10, "K": 10, "A": 11
+}
+CARD_NAMES = list(CARD_VALUES.keys())
+STAND_ON = 17
+
+def draw_card():
+    return random.choice(CARD_NAMES)
+
+def hand_value(cards):
+    total = sum(CARD_VALUES[c] for c in cards)
+    aces = cards.count("A")
+    while total > 21 and aces > 0:
+        total -= 10
+        aces -= 1
+    return total
+
+def format_hand(cards):
+    return ", ".join(cards) + f" (total: {hand_value(cards)})"
+
+def play_hand():
+    cards = [draw_card(), draw_card()]
+    while hand_value(cards) < STAND_ON:
+        cards.append(draw_card())
+    return cards
+
+def outcome(player_total: int, dealer_total: int) -> int:
+    """+1 win, -1 loss, 0 push, in units of the bet. A player bust loses even if the dealer busts."""
+    if player_total > 21:
+        return -1
+    if dealer_total > 21:
+        return 1
+    if player_total > dealer_total:
+        return 1
+    if player_total < dealer_total:
+        return -1
+    return 0
@@ -0,0 +1,177 @@
+"""Monte Carlo house-edge simulator for /blackjack.
+
+Usage:
+    python blackjack_sim.py [--hands N] [--seed S] [--check]
+
+Plays N hands with the rules in blackjack.py, vectorized with NumPy, and reports the player's
+expected value per unit bet, its variance and the bust rates next to the exact values. With
+--check it exits non-zero when the rules no longer produce EXPECTED_EV or when the simulation
+disagrees with the exact calculation, so a rule change cannot shift coin supply unnoticed.
+
+NumPy is only needed here, not by the bot.
+"""
+import argparse
+import sys
+import time
+from fractions import Fraction
+
+import numpy as np
+
+from blackjack import CARD_NAMES, CARD_VALUES, STAND_ON, outcome
+
+# Player EV per unit bet under the current rules; update deliberately when the rules change.
+EXPECTED_EV = -0.07929
+EXPECTED_EV_TOLERANCE = 0.00001
+CHUNK_SIZE = 1_000_000
+
+CARD_ARRAY = np.array([CARD_VALUES[c] for c in CARD_NAMES], dtype=np.int8)
+
+# ---------------- EXACT ----------------
+def final_total_distribution():
+    """Exact distribution of a finished hand's total (anything over 21 is reported as 22)."""
+    p_card = Fraction(1, len(CARD_NAMES))
+    finished = {}
+
+    def add_card(state, value):
+        total, aces = state
+        total += value
+        aces += value == 11
+        while total > 21 and aces > 0:
+            total -= 10
+            aces -= 1
+        return total, aces
+
+    states = {(0, 0): Fraction(1)}
+    for _ in range(2):
+        dealt = {}
+        for state, p in states.items():
+            for c in CARD_NAMES:
+                nxt = add_card(state, CARD_VALUES[c])
+                dealt[nxt] = dealt.get(nxt, 0) + p * p_card
+        states = dealt
+
+    while states:
+        drawing = {}
+        for (total, aces), p in states.items():
+            if total >= STAND_ON:
+                key = min(total, 22)
+                finished[key] = finished.get(key, 0) + p
+                continue
+            for c in CARD_NAMES:
+                nxt = add_card((total, aces), CARD_VALUES[c])
+                drawing[nxt] = drawing.get(nxt, 0) + p * p_card
+        states = drawing
+    return finished
+
+def exact_stats():
+    dist = final_total_distribution()
+    ev = Fraction(0)
+    second = Fraction(0)
+    for player_total, p_player in dist.items():
+        for dealer_total, p_dealer in dist.items():
+            result = outcome(player_total, dealer_total)
+            ev += p_player * p_dealer * result
+            second += p_player * p_dealer * result * result
+    bust = dist.get(22, Fraction(0))
+    return {
+        "ev": float(ev),
+        "variance": float(second - ev * ev),
+        "player_bust": float(bust),
+        "dealer_bust": float(bust)
+    }
+
+# ---------------- SIMULATED ----------------
+def play_hands(rng, n):
+    """Final totals for n independent hands (same rules as blackjack.play_hand)."""
+    draws = CARD_ARRAY[rng.integers(0, len(CARD_ARRAY), size=(n, 2))]
+    total = draws.sum(axis=1, dtype=np.int16)
+    aces = (draws == 11).sum(axis=1, dtype=np.int16)
+
+    while True:
+        soften = (total > 21) & (aces > 0)
+        if not soften.any():
+            break
+        total[soften] -= 10
+        aces[soften] -= 1
+
+    active = np.flatnonzero(total < STAND_ON)
+    while active.size:
+        card = CARD_ARRAY[rng.integers(0, len(CARD_ARRAY), size=active.size)]
+        total[active] += card
+        aces[active] += card == 11
+        soften = (total[active] > 21) & (aces[active] > 0)
+        while soften.any():
+            idx = active[soften]
+            total[idx] -= 10
+            aces[idx] -= 1
+            soften = (total[active] > 21) & (aces[active] > 0)
+        active = active[total[active] < STAND_ON]
+    return total
+
+def settle(player, dealer):
+    """Vectorized blackjack.outcome."""
+    return np.select(
+        [player > 21, dealer > 21, player > dealer, player < dealer],
+        [-1, 1, 1, -1],
+        default=0
+    ).astype(np.int8)
+
+def simulate(hands: int, seed=None):
+    rng = np.random.default_rng(seed)
+    total = 0
+    total_sq = 0
+    player_busts = 0
+    dealer_busts = 0
+    remaining = hands
+    while remaining:
+        n = min(CHUNK_SIZE, remaining)
+        player = play_hands(rng, n)
+        dealer = play_hands(rng, n)
+        result = settle(player, dealer)
+        total += int(result.sum(dtype=np.int64))
+        total_sq += int(np.abs(result).sum(dtype=np.int64))
+        player_busts += int((player > 21).sum())
+        dealer_busts += int((dealer > 21).sum())
+        remaining -= n
+
+    ev = total / hands
+    return {
+        "ev": ev,
+        "variance": total_sq / hands - ev * ev,
+        "player_bust": player_busts / hands,
+        "dealer_bust": dealer_busts / hands
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hands", type=int, default=10_000_000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--check", action="store_true", help="fail if the rules or the simulation drift")
+    args = parser.parse_args(argv)
+
+    exact = exact_stats()
+    start = time.perf_counter()
+    sim = simulate(args.hands, args.seed)
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.hands:,} hands in {elapsed:.2f}s ({args.hands / elapsed:,.0f} hands/s)")
+    print(f"{'':12}{'simulated':>12}{'exact':>12}")
+    for key in ("ev", "variance", "player_bust", "dealer_bust"):
+        print(f"{key:12}{sim[key]:12.5f}{exact[key]:12.5f}")
+    std_err = (exact["variance"] / args.hands) ** 0.5
+    print(f"house edge: {-exact['ev']:.2%} of every bet (simulated ±{std_err:.5f})")
+
+    if not args.check:
+        return 0
+
+    failures = []
+    if abs(exact["ev"] - EXPECTED_EV) > EXPECTED_EV_TOLERANCE:
+        failures.append(f"rules changed the EV: {exact['ev']:.5f}, expected {EXPECTED_EV:.5f}")
+    if abs(sim["ev"] - exact["ev"]) > 5 * std_err:
+        failures.append(f"simulated EV {sim['ev']:.5f} is more than 5 standard errors from exact")
+    for failure in failures:
+        print("CHECK FAILED:", failure)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1125 @@
+"""Local load test for main.py.
+
+Starts FakePostgREST, an in-memory stand-in for the Supabase REST API, points main.py at it,
+seeds accounts, listings and factions, and drives the slash-command coroutines with fake
+interactions at a fixed concurrency. Prints throughput and latency percentiles per command.
+
+    python loadtest.py [--accounts 500] [--ops 5000] [--concurrency 50]
+                       [--db-latency-ms 0] [--mix balance=4,transfer=3,buy=2] [--seed 1]
+
+Money-conservation check: fire thousands of concurrent transfers between a few accounts and
+fail unless the sum of all balances is unchanged and none went negative:
+
+    python loadtest.py --accounts 50 --ops 5000 --concurrency 1000 --mix transfer=1 --check-conservation
+
+REST calls per faction overview as the number of factions grows (it must stay flat):
+
+    python loadtest.py --bench-factions 10,100,1000,5000
+
+Fault injection: answer a fraction of REST calls with 503/500/429, a stalled response or a
+dropped connection, either during a normal run or in a scripted check of the retry and
+circuit-breaker layer (exits 1 if any check fails):
+
+    python loadtest.py --fault-rate 0.05 --fault-kinds 503,429,reset
+    python loadtest.py --check-faults
+
+Batched Discord channel writer against a fake channel (message size limits, 429 retries, drops):
+
+    python loadtest.py --check-channel-writer
+
+Bulk admin payouts, e.g. 5000 accounts per command:
+
+    python loadtest.py --accounts 5000 --ops 20 --concurrency 1 --mix givemoney_bulk=1 --bulk-targets 5000
+
+Nothing here talks to Discord or to the real Supabase project. Runs are reproducible for a
+given --seed (up to task interleaving), so numbers can be compared across commits.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+import discord
+from aiohttp import web
+
+DEFAULT_MIX = {
+    "balance": 4,
+    "profile": 2,
+    "transfer": 3,
+    "buy": 2,
+    "sell": 1,
+    "market": 2,
+    "leaderboard": 1,
+    "blackjack": 2,
+    "faction_join": 1,
+    "faction_leave": 1,
+    "faction_details": 1
+}
+# Commands that only move money between accounts (or don't touch it), for --check-conservation.
+CONSERVING = {"transfer", "balance", "profile", "market", "leaderboard", "faction_details"}
+ITEMS = ("DIAMOND", "IRON_INGOT", "GOLD_INGOT", "EMERALD", "OAK_LOG", "NETHERITE_INGOT")
+
+# Unique columns, for 409s on insert and Prefer: resolution=ignore-duplicates. Like PostgREST,
+# ignore-duplicates only skips rows that conflict on the on_conflict columns, or on the primary
+# key (PRIMARY_KEYS, default id) when the request names none; any other conflict is a 409.
+PRIMARY_KEYS = {
+    "economy_job_runs": ("job", "run_key")
+}
+UNIQUE_KEYS = {
+    "accounts": ("discord_id",),
+    "factions": ("name",),
+    "faction_members": ("player_uuid",),
+    "ledger": ("entry_id",),
+    "economy_job_runs": ("job", "run_key")
+}
+
+FAULT_KINDS = ("503", "500", "429", "timeout", "reset")
+
+# ============================================================
+# FAKE POSTGREST
+# ============================================================
+class QueryError(Exception):
+    pass
+
+def split_top_level(text: str):
+    """Split on commas that are not inside parentheses."""
+    parts, depth, start = [], 0, 0
+    for i, ch in enumerate(text):
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [part for part in parts if part]
+
+def coerce(row_value, text: str):
+    if isinstance(row_value, bool):
+        return text == "true"
+    if isinstance(row_value, (int, float)):
+        try:
+            return float(text)
+        except ValueError:
+            return text
+    return text
+
+def like_to_regex(pattern: str, flags=0):
+    return re.compile("^" + re.escape(pattern).replace("\\*", ".*").replace("%", ".*") + "$", flags)
+
+def make_predicate(column: str, expression: str):
+    """PostgREST `column=op.value` filter, with optional `not.` prefix."""
+    negate = expression.startswith("not.")
+    if negate:
+        expression = expression[4:]
+    op, _, value = expression.partition(".")
+    options = {v.strip('"') for v in split_top_level(value.strip("()"))} if op == "in" else None
+
+    def test(row):
+        current = row.get(column)
+        if op == "is":
+            result = current is None if value == "null" else current is (value == "true")
+        elif op == "in":
+            if isinstance(current, (int, float)) and not isinstance(current, bool):
+                result = any(current == coerce(current, v) for v in options)
+            else:
+                result = current is not None and str(current) in options
+        elif current is None:
+            result = False
+        elif op == "eq":
+            result = current == coerce(current, value)
+        elif op == "neq":
+            result = current != coerce(current, value)
+        elif op in ("gt", "gte", "lt", "lte"):
+            other = coerce(current, value)
+            if isinstance(current, (int, float)) != isinstance(other, (int, float)):
+                current, other = str(current), str(other)
+            result = {
+                "gt": current > other, "gte": current >= other,
+                "lt": current < other, "lte": current <= other
+            }[op]
+        elif op == "like":
+            result = bool(like_to_regex(value).match(str(current)))
+        elif op == "ilike":
+            result = bool(like_to_regex(value, re.IGNORECASE).match(str(current)))
+        else:
+            raise QueryError(f"unsupported operator {op}")
+        return not result if negate else result
+
+    return test
+
+def make_logic(kind: str, body: str):
+    """`or=(a.eq.1,and(b.gt.2,c.lt.3))` style filters."""
+    predicates = []
+    for term in split_top_level(body.strip()[1:-1]):
+        if term.startswith(("and(", "or(")):
+            inner_kind, _, rest = term.partition("(")
+            predicates.append(make_logic(inner_kind, "(" + rest))
+        else:
+            column, _, expression = term.partition(".")
+            predicates.append(make_predicate(column, expression))
+    combine = any if kind == "or" else all
+    return lambda row: combine(p(row) for p in predicates)
+
+class FakePostgREST:
+    """In-memory tables behind the subset of the PostgREST API that main.py uses.
+
+    Every handler mutates state without awaiting in between, so each request (and each RPC)
+    is atomic, like a single-statement transaction.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.tables = {}
+        self.sequences = {}
+        self.requests = 0
+        # Fault injection: each request fails with probability fault_rate (kind drawn from
+        # fault_kinds), and every request fails with kind `outage` while it is set.
+        self.fault_rate = 0.0
+        self.fault_kinds = ("503",)
+        self.fault_rng = random.Random(0)
+        self.outage = None
+        self.stall = 60.0
+        self.faults_injected = 0
+        self._account_index = None
+        self.unique = {}  # table -> set of unique-key tuples (see UNIQUE_KEYS)
+        self.rpcs = {
+            "economy_credit": self.rpc_economy_credit,
+            "economy_debit": self.rpc_economy_debit,
+            "economy_transfer": self.rpc_economy_transfer,
+            "economy_purchase": self.rpc_economy_purchase,
+            "economy_apply_deltas": self.rpc_economy_apply_deltas,
+            "market_item_types": self.rpc_market_item_types,
+            "ledger_snapshot": self.rpc_ledger_snapshot,
+            "faction_adjust_member_count": self.rpc_faction_adjust_member_count,
+            "faction_repair_member_counts": self.rpc_faction_repair_member_counts
+        }
+
+    # ---------------- STORAGE ----------------
+    def table(self, name: str):
+        return self.tables.setdefault(name, [])
+
+    def insert(self, name: str, row: dict, ignore_on=None):
+        """Insert `row`; `ignore_on` is the conflict target of an ignore-duplicates insert."""
+        rows = self.table(name)
+        if ignore_on == ("id",) and "id" in row and any(r["id"] == row["id"] for r in rows):
+            return None
+        columns = UNIQUE_KEYS.get(name)
+        if columns:
+            keys = self.unique.setdefault(name, set())
+            key = tuple(row.get(c) for c in columns)
+            if key in keys:
+                if ignore_on == columns:
+                    return None
+                raise QueryError("duplicate key value violates unique constraint")
+            keys.add(key)
+        row = dict(row)
+        if "id" not in row:
+            self.sequences[name] = self.sequences.get(name, 0) + 1
+            row["id"] = self.sequences[name]
+        else:
+            self.sequences[name] = max(self.sequences.get(name, 0), int(row["id"]))
+        row.setdefault("created_at", time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime()))
+        rows.append(row)
+        return row
+
+    def total_supply(self) -> float:
+        return sum(row.get("balance") or 0 for row in self.table("accounts"))
+
+    def account(self, discord_id):
+        # Rows are only ever mutated in place, so the index stays valid until rows are added or removed.
+        accounts = self.table("accounts")
+        if self._account_index is None or self._account_index[0] != len(accounts):
+            self._account_index = (len(accounts), {row.get("discord_id"): row for row in accounts})
+        return self._account_index[1].get(str(discord_id))
+
+    # ---------------- QUERY PARSING ----------------
+    def parse(self, query):
+        predicates, select, order, limit, offset = [], "*", [], None, 0
+        for key, value in query.items():
+            if key == "select":
+                select = value
+            elif key == "order":
+                for term in value.split(","):
+                    column, _, direction = term.partition(".")
+                    order.append((column, direction.startswith("desc")))
+            elif key == "limit":
+                limit = int(value)
+            elif key == "offset":
+                offset = int(value)
+            elif key in ("or", "and"):
+                predicates.append(make_logic(key, value))
+            elif key == "on_conflict":
+                continue
+            else:
+                predicates.append(make_predicate(key, value))
+        return predicates, select, order, limit, offset
+
+    def project(self, table: str, row: dict, select: str, children=None):
+        """Apply `select`, embedding related rows. `children` caches each relation grouped by foreign key."""
+        if select == "*":
+            return dict(row)
+        children = {} if children is None else children
+        out = {}
+        for field in split_top_level(select):
+            if "(" in field:
+                relation, _, columns = field.partition("(")
+                if relation not in children:
+                    foreign_key = table.rstrip("s") + "_id"
+                    grouped = children[relation] = {}
+                    for child in self.table(relation):
+                        grouped.setdefault(child.get(foreign_key), []).append(child)
+                out[relation] = [
+                    self.project(relation, child, columns[:-1], children)
+                    for child in children[relation].get(row.get("id"), ())
+                ]
+            elif field == "*":
+                out.update(row)
+            else:
+                out[field] = row.get(field)
+        return out
+
+    def select_rows(self, table: str, query):
+        predicates, select, order, limit, offset = self.parse(query)
+        rows = [row for row in self.table(table) if all(p(row) for p in predicates)]
+        for column, descending in reversed(order):
+            rows.sort(key=lambda r: (r.get(column) is None, r.get(column) if r.get(column) is not None else 0),
+                      reverse=descending)
+        total = len(rows)
+        rows = rows[offset:]
+        if limit is not None:
+            rows = rows[:limit]
+        return rows, select, total, offset
+
+    # ---------------- HTTP ----------------
+    def app(self):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post("/rest/v1/rpc/{function}", self.handle_rpc)
+        app.router.add_route("*", "/rest/v1/{table}", self.handle_table)
+        return app
+
+    async def inject_fault(self, request):
+        """A response to send instead of handling the request, or None to handle it normally."""
+        kind = self.outage
+        if kind is None and self.fault_rate and self.fault_rng.random() < self.fault_rate:
+            kind = self.fault_rng.choice(self.fault_kinds)
+        if kind is None:
+            return None
+        self.faults_injected += 1
+        if kind == "timeout":
+            await asyncio.sleep(self.stall)
+        elif kind == "reset":
+            request.transport.close()
+            raise asyncio.CancelledError
+        elif kind == "429":
+            return web.json_response({"message": "rate limited"}, status=429, headers={"Retry-After": "0"})
+        return web.json_response({"message": "injected fault"}, status=int(kind) if kind.isdigit() else 503)
+
+    async def handle_rpc(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        fault = await self.inject_fault(request)
+        if fault is not None:
+            return fault
+        handler = self.rpcs.get(request.match_info["function"])
+        if handler is None:
+            return web.json_response({"message": "function not found"}, status=404)
+        args = await request.json() if request.can_read_body else {}
+        return web.json_response(handler(**args))
+
+    async def handle_table(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        fault = await self.inject_fault(request)
+        if fault is not None:
+            return fault
+        table = request.match_info["table"]
+        prefer = request.headers.get("Prefer", "")
+        try:
+            if request.method == "GET":
+                return self.handle_get(table, request.query, prefer)
+            body = await request.json() if request.can_read_body else None
+            if request.method == "POST":
+                return self.handle_post(table, request.query, body, prefer)
+            if request.method == "PATCH":
+                return self.handle_patch(table, request.query, body, prefer)
+            if request.method == "DELETE":
+                return self.handle_delete(table, request.query, prefer)
+        except QueryError as e:
+            status = 409 if "duplicate" in str(e) else 400
+            return web.json_response({"message": str(e)}, status=status)
+        return web.json_response({"message": "method not allowed"}, status=405)
+
+    def handle_get(self, table, query, prefer):
+        rows, select, total, offset = self.select_rows(table, query)
+        headers = {}
+        if "count=" in prefer:
+            end = offset + len(rows) - 1
+            headers["Content-Range"] = f"{offset}-{end}/{total}" if rows else f"*/{total}"
+        children = {}
+        return web.json_response([self.project(table, row, select, children) for row in rows], headers=headers)
+
+    def handle_post(self, table, query, body, prefer):
+        ignore_on = None
+        if "resolution=ignore-duplicates" in prefer:
+            ignore_on = tuple(query["on_conflict"].split(",")) if "on_conflict" in query else PRIMARY_KEYS.get(table, ("id",))
+        created = []
+        rows_before = len(self.table(table))
+        try:
+            for row in body if isinstance(body, list) else [body]:
+                inserted = self.insert(table, row, ignore_on=ignore_on)
+                if inserted is not None:
+                    created.append(dict(inserted))
+        except QueryError:
+            # One statement: a conflict anywhere in the batch inserts none of it.
+            del self.table(table)[rows_before:]
+            columns = UNIQUE_KEYS.get(table)
+            if columns:
+                self.unique[table] = {tuple(row.get(c) for c in columns) for row in self.tables[table]}
+            raise
+        if "return=representation" in prefer:
+            return web.json_response(created, status=201)
+        return web.Response(status=201)
+
+    def handle_patch(self, table, query, body, prefer):
+        rows, _, _, _ = self.select_rows(table, query)
+        for row in rows:
+            row.update(body or {})
+        if "return=representation" in prefer:
+            return web.json_response([dict(row) for row in rows])
+        return web.Response(status=204)
+
+    def handle_delete(self, table, query, prefer):
+        rows, _, _, _ = self.select_rows(table, query)
+        doomed = {id(row) for row in rows}
+        self.tables[table] = [row for row in self.table(table) if id(row) not in doomed]
+        columns = UNIQUE_KEYS.get(table)
+        if columns:
+            self.unique[table] = {tuple(row.get(c) for c in columns) for row in self.tables[table]}
+        if "return=representation" in prefer:
+            return web.json_response([dict(row) for row in rows])
+        return web.Response(status=204)
+
+    # ---------------- RPC (mirrors sql/economy_rpc.sql) ----------------
+    @staticmethod
+    def clock():
+        """clock_timestamp(): the RPCs' applied_at and ledger_snapshot's taken_at share it."""
+        return datetime.now(timezone.utc).isoformat()
+
+    def rpc_economy_credit(self, p_discord_id, p_amount):
+        if p_amount <= 0:
+            return {"ok": False, "error": "invalid_amount"}
+        acc = self.account(p_discord_id)
+        if acc is None:
+            return {"ok": False, "error": "account_not_found"}
+        acc["balance"] += p_amount
+        return {"ok": True, "applied_at": self.clock(), "balances": {acc["discord_id"]: acc["balance"]}}
+
+    def rpc_economy_debit(self, p_discord_id, p_amount, p_clamp=False):
+        if p_amount <= 0:
+            return {"ok": False, "error": "invalid_amount"}
+        acc = self.account(p_discord_id)
+        if acc is None:
+            return {"ok": False, "error": "account_not_found"}
+        if not p_clamp and acc["balance"] < p_amount:
+            return {"ok": False, "error": "insufficient_funds", "balances": {acc["discord_id"]: acc["balance"]}}
+        old = acc["balance"]
+        acc["balance"] = max(old - p_amount, 0)
+        return {"ok": True, "applied_at": self.clock(), "debited": old - acc["balance"], "balances": {acc["discord_id"]: acc["balance"]}}
+
+    def rpc_economy_transfer(self, p_from, p_to, p_amount):
+        if p_amount <= 0:
+            return {"ok": False, "error": "invalid_amount"}
+        if p_from == p_to:
+            return {"ok": False, "error": "same_account"}
+        sender, receiver = self.account(p_from), self.account(p_to)
+        if sender is None:
+            return {"ok": False, "error": "sender_not_found"}
+        if receiver is None:
+            return {"ok": False, "error": "receiver_not_found"}
+        if sender["balance"] < p_amount:
+            return {"ok": False, "error": "insufficient_funds",
+                    "balances": {p_from: sender["balance"], p_to: receiver["balance"]}}
+        sender["balance"] -= p_amount
+        receiver["balance"] += p_amount
+        return {"ok": True, "applied_at": self.clock(), "balances": {p_from: sender["balance"], p_to: receiver["balance"]}}
+
+    def rpc_economy_purchase(self, p_listing_id, p_buyer_discord_id):
+        listing = next((r for r in self.table("marketplace_listings") if r["id"] == p_listing_id), None)
+        if listing is None:
+            return {"ok": False, "error": "listing_not_found"}
+        if listing["status"] != "active":
+            return {"ok": False, "error": "listing_unavailable"}
+        buyer = self.account(p_buyer_discord_id)
+        if buyer is None:
+            return {"ok": False, "error": "buyer_not_found"}
+        if buyer["mc_uuid"] == listing["seller_mc_uuid"]:
+            return {"ok": False, "error": "own_listing"}
+        cost = listing["price"] * listing["amount"]
+        if buyer["balance"] < cost:
+            return {"ok": False, "error": "insufficient_funds", "cost": cost,
+                    "balances": {buyer["discord_id"]: buyer["balance"]}}
+
+        buyer["balance"] -= cost
+        balances = {buyer["discord_id"]: buyer["balance"]}
+        seller = next((r for r in self.table("accounts") if r.get("mc_uuid") == listing["seller_mc_uuid"]), None)
+        if seller is not None:
+            seller["balance"] += cost
+            balances[seller["discord_id"]] = seller["balance"]
+        listing["status"] = "sold"
+        listing["buyer_mc_uuid"] = buyer["mc_uuid"]
+        self.insert("deliveries", {"listing_id": p_listing_id, "mc_uuid": buyer["mc_uuid"],
+                                   "item_type": listing["item_type"], "amount": listing["amount"],
+                                   "status": "pending"})
+        return {"ok": True, "applied_at": self.clock(), "item_type": listing["item_type"], "amount": listing["amount"],
+                "cost": cost, "balances": balances}
+
+    def rpc_economy_apply_deltas(self, p_batch_id, p_deltas):
+        applied_batches = self.table("applied_delta_batches")
+        if any(r["batch_id"] == p_batch_id for r in applied_batches):
+            balances = {d: self.account(d)["balance"] for d in p_deltas if self.account(d)}
+            return {"ok": True, "duplicate": True, "balances": balances}
+        applied_batches.append({"batch_id": p_batch_id})
+
+        balances, applied, missing = {}, {}, []
+        for discord_id, delta in sorted(p_deltas.items()):
+            acc = self.account(discord_id)
+            if acc is None:
+                missing.append(discord_id)
+                continue
+            old = acc["balance"]
+            acc["balance"] = max(old + delta, 0)
+            balances[discord_id] = acc["balance"]
+            applied[discord_id] = acc["balance"] - old
+        return {"ok": True, "applied_at": self.clock(), "balances": balances, "applied": applied, "missing": missing}
+
+    def rpc_market_item_types(self):
+        return [{"item_type": item} for item in sorted({r["item_type"] for r in self.table("marketplace_listings")})]
+
+    def rpc_ledger_snapshot(self):
+        now = self.clock()
+        accounts = self.table("accounts")
+        for acc in accounts:
+            self.insert("balance_snapshots", {"discord_id": acc["discord_id"], "balance": acc["balance"], "taken_at": now})
+        return len(accounts)
+
+    def rpc_faction_adjust_member_count(self, p_faction_id, p_delta):
+        for faction in self.table("factions"):
+            if str(faction["id"]) == p_faction_id:
+                faction["member_count"] = max((faction.get("member_count") or 0) + p_delta, 0)
+                return faction["member_count"]
+        return None
+
+    def rpc_faction_repair_member_counts(self):
+        actual = {}
+        for member in self.table("faction_members"):
+            actual[member["faction_id"]] = actual.get(member["faction_id"], 0) + 1
+        fixed = 0
+        for faction in self.table("factions"):
+            if faction.get("member_count") != actual.get(faction["id"], 0):
+                faction["member_count"] = actual.get(faction["id"], 0)
+                fixed += 1
+        return fixed
+
+    # ---------------- SEED DATA ----------------
+    def reset(self):
+        self.tables.clear()
+        self.sequences.clear()
+        self.unique.clear()
+        self._account_index = None
+
+    def seed(self, rng, accounts: int, listings: int, factions: int):
+        for i in range(accounts):
+            self.insert("accounts", {
+                "discord_id": str(100_000 + i),
+                "mc_uuid": str(uuid.UUID(int=rng.getrandbits(128))),
+                "balance": float(rng.randint(1_000, 100_000))
+            })
+        sellers = self.table("accounts")
+        for _ in range(listings):
+            self.insert("marketplace_listings", {
+                "seller_mc_uuid": rng.choice(sellers)["mc_uuid"],
+                "item_type": rng.choice(ITEMS),
+                "amount": rng.randint(1, 64),
+                "price": float(rng.randint(1, 50)),
+                "status": "active"
+            })
+        for i in range(factions):
+            creator = sellers[i % len(sellers)]
+            faction = self.insert("factions", {
+                "name": f"faction{i}",
+                "creator_uuid": creator["mc_uuid"],
+                "member_count": 1
+            })
+            self.insert("faction_members", {"faction_id": faction["id"], "player_uuid": creator["mc_uuid"]})
+
+# ============================================================
+# FAKE DISCORD
+# ============================================================
+class FakePermissions:
+    administrator = True
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.guild_permissions = FakePermissions()
+
+class FakeMessage:
+    def __init__(self, content=None, embed=None):
+        self.content = content
+        self.embed = embed
+
+    async def edit(self, **kwargs):
+        self.content = kwargs.get("content", self.content)
+        self.embed = kwargs.get("embed", self.embed)
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        self.interaction.sent.append(content or "")
+
+    async def edit_message(self, **kwargs):
+        self._done = True
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        self.interaction.sent.append(content or "")
+        return FakeMessage(content, kwargs.get("embed"))
+
+class FakeHTTPResponse:
+    def __init__(self, status: int, headers=None):
+        self.status = status
+        self.reason = "injected"
+        self.headers = headers or {}
+
+class FakeChannel:
+    """Records every message; `failures` is a list of statuses to raise, one per send, before succeeding.
+
+    Like Discord, rejects a message with more than 10 embeds or 6000 embed characters with a 400.
+    """
+
+    def __init__(self, failures=()):
+        self.messages = []
+        self.failures = list(failures)
+
+    async def send(self, content=None, embeds=None, **kwargs):
+        if self.failures:
+            status = self.failures.pop(0)
+            headers = {"Retry-After": "0.01"} if status == 429 else {}
+            raise discord.HTTPException(FakeHTTPResponse(status, headers), "injected")
+        if len(embeds or []) > 10 or sum(len(embed) for embed in embeds or []) > 6000:
+            raise discord.HTTPException(FakeHTTPResponse(400), "Embed size exceeds maximum size of 6000")
+        self.messages.append(list(embeds or []))
+
+class FakeInteraction:
+    def __init__(self, user: FakeUser):
+        self.user = user
+        self.guild = None
+        self.channel = None
+        self.sent = []
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    async def edit_original_response(self, **kwargs):
+        pass
+
+    @property
+    def rejected(self) -> bool:
+        return any(str(message).startswith("❌") for message in self.sent)
+
+# ============================================================
+# HARNESS
+# ============================================================
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+class LoadTest:
+    def __init__(self, main, fake: FakePostgREST, rng: random.Random, mix: dict, factions: int, bulk_targets: int):
+        self.main = main
+        self.fake = fake
+        self.rng = rng
+        self.factions = factions
+        self.bulk_targets = bulk_targets
+        self.commands = list(mix)
+        self.weights = [mix[name] for name in self.commands]
+        self.users = [FakeUser(int(acc["discord_id"])) for acc in fake.table("accounts")]
+        self.results = {}
+        self.errors = 0
+
+    def plan(self, ops: int):
+        return self.rng.choices(self.commands, weights=self.weights, k=ops)
+
+    def build(self, command: str):
+        """Pick a user and arguments for one call. Returns (user, coroutine function, kwargs)."""
+        main, rng = self.main, self.rng
+        user = rng.choice(self.users)
+        if command == "transfer":
+            target = rng.choice(self.users)
+            return user, main.transfer.callback, {"target": target, "amount": float(rng.randint(1, 100))}
+        if command == "buy":
+            active = [r["id"] for r in self.fake.table("marketplace_listings")[-200:] if r["status"] == "active"]
+            listing_id = rng.choice(active) if active else 1
+            return user, main.buy.callback, {"listing_id": listing_id}
+        if command == "sell":
+            return user, main.sell.callback, {"item": rng.choice(ITEMS), "amount": rng.randint(1, 64),
+                                              "price": float(rng.randint(1, 50))}
+        if command == "market":
+            return user, main.market.callback, {"item": rng.choice((None,) + ITEMS)}
+        if command == "blackjack":
+            return user, main.blackjack.callback, {"amount": float(rng.randint(1, 100))}
+        if command in ("givemoney_bulk", "removemoney_bulk"):
+            sample = rng.sample(self.users, min(self.bulk_targets, len(self.users)))
+            targets = " ".join(str(target.id) for target in sample)
+            return user, getattr(main, command).callback, {"amount": float(rng.randint(1, 100)), "targets": targets}
+        if command == "faction_join":
+            return user, main.faction_join.callback, {"name": f"faction{rng.randrange(max(1, self.factions))}"}
+        return user, getattr(main, command).callback, {}
+
+    async def run(self, ops: int, concurrency: int):
+        queue = asyncio.Queue()
+        for command in self.plan(ops):
+            queue.put_nowait(command)
+
+        async def worker():
+            while not queue.empty():
+                command = queue.get_nowait()
+                user, callback, kwargs = self.build(command)
+                interaction = FakeInteraction(user)
+                start = time.perf_counter()
+                try:
+                    await callback(interaction, **kwargs)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"{command} raised:", e)
+                elapsed = time.perf_counter() - start
+                stats = self.results.setdefault(command, {"latencies": [], "rejected": 0})
+                stats["latencies"].append(elapsed)
+                stats["rejected"] += interaction.rejected
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - start
+
+    def report(self, wall: float):
+        print(f"{'command':16}{'ops':>8}{'rejected':>10}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        total = 0
+        for command in sorted(self.results):
+            stats = self.results[command]
+            latencies = sorted(stats["latencies"])
+            total += len(latencies)
+            print(
+                f"{command:16}{len(latencies):8}{stats['rejected']:10}{len(latencies) / wall:10.1f}"
+                f"{percentile(latencies, 50) * 1000:10.2f}{percentile(latencies, 95) * 1000:10.2f}"
+                f"{percentile(latencies, 99) * 1000:10.2f}{latencies[-1] * 1000:10.2f}"
+            )
+        print(f"\n{total} ops in {wall:.2f}s = {total / wall:.1f} ops/s, "
+              f"{self.fake.requests} REST calls, {self.errors} exceptions")
+
+def parse_mix(text: str):
+    if not text:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def serve(fake: FakePostgREST):
+    """Start the stand-in on a free port and import main.py pointed at it. Returns (runner, main)."""
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    # main.py reads its configuration at import time.
+    os.environ["SUPABASE_URL"] = f"http://127.0.0.1:{port}"
+    os.environ["SUPABASE_SERVICE_KEY"] = "loadtest"
+    os.environ.setdefault("BALANCE_JOURNAL_PATH", os.path.join(tempfile.mkdtemp(), "balance_journal.jsonl"))
+    import main
+    return runner, main
+
+async def bench_factions(args):
+    """REST calls and time to build the faction overview, cold and from the loaded index."""
+    fake = FakePostgREST(latency=args.db_latency_ms / 1000)
+    runner, main = await serve(fake)
+    await main.supabase.start()
+    try:
+        print(f"{'factions':>10}{'members':>10}{'N+1 calls':>11}{'cold calls':>12}{'cold ms':>10}"
+              f"{'load calls':>12}{'indexed calls':>15}{'indexed ms':>12}")
+        for count in (int(n) for n in args.bench_factions.split(",")):
+            rng = random.Random(args.seed)
+            fake.reset()
+            fake.seed(rng, count * 5, 0, count)
+            factions = fake.table("factions")
+            for account in fake.table("accounts")[count:]:
+                faction = rng.choice(factions)
+                fake.insert("faction_members", {"faction_id": faction["id"], "player_uuid": account["mc_uuid"]})
+                faction["member_count"] += 1
+
+            main.faction_index = main.FactionIndex(main.FACTION_INDEX_RECONCILE_INTERVAL,
+                                                   main.FACTION_COUNT_REPAIR_INTERVAL)
+            before, start = fake.requests, time.perf_counter()
+            await main.build_faction_status_embed()
+            cold_calls, cold_ms = fake.requests - before, (time.perf_counter() - start) * 1000
+
+            before = fake.requests
+            await main.faction_index.load()
+            load_calls = fake.requests - before
+
+            before, start = fake.requests, time.perf_counter()
+            await main.build_faction_status_embed()
+            indexed_calls, indexed_ms = fake.requests - before, (time.perf_counter() - start) * 1000
+
+            print(f"{count:10}{len(fake.table('faction_members')):10}{count + 1:11}{cold_calls:12}{cold_ms:10.1f}"
+                  f"{load_calls:12}{indexed_calls:15}{indexed_ms:12.1f}")
+        print("\nN+1 calls: what one members query per faction would have cost.")
+    finally:
+        await main.supabase.close()
+        await runner.cleanup()
+    return True
+
+async def check_faults(args):
+    """Scripted checks of retries, timeouts and the circuit breaker against injected faults."""
+    # Short timeouts so the whole script runs in a few seconds; main.py reads these at import.
+    os.environ.setdefault("SUPABASE_TIMEOUT", "0.3")
+    os.environ.setdefault("SUPABASE_RETRIES", "3")
+    os.environ.setdefault("SUPABASE_BACKOFF_BASE", "0.01")
+    os.environ.setdefault("SUPABASE_BACKOFF_MAX", "0.05")
+    os.environ.setdefault("SUPABASE_BREAKER_THRESHOLD", "8")
+    os.environ.setdefault("SUPABASE_BREAKER_RESET", "0.5")
+
+    fake = FakePostgREST()
+    fake.fault_rng = random.Random(args.seed)
+    fake.stall = 1.0  # longer than any client timeout below, short enough not to hold up shutdown
+    fake.seed(random.Random(args.seed), 20, 0, 0)
+    runner, main = await serve(fake)
+    client, breaker = main.supabase, main.supabase.breaker
+    failed = []
+
+    def check(name, ok, detail=""):
+        print(f"{'ok' if ok else 'FAILED':8}{name}{f'  ({detail})' if detail else ''}")
+        if not ok:
+            failed.append(name)
+
+    async def get():
+        return await client.request("GET", "accounts", "?limit=1")
+
+    async def wait_for_half_open():
+        await asyncio.sleep(breaker.reset_timeout + 0.05)
+
+    await client.start()
+    try:
+        fake.fault_rate, fake.fault_kinds = 0.1, ("503", "500", "429", "reset")
+        retries = client.retries
+        results = await asyncio.gather(*(get() for _ in range(100)), return_exceptions=True)
+        ok = sum(1 for r in results if not isinstance(r, BaseException) and r[1] == 200)
+        check("flaky reads succeed after retries", ok == len(results),
+              f"{ok}/{len(results)} ok, {fake.faults_injected} faults, {client.retries - retries} retries")
+        fake.fault_rate = 0.0
+
+        fake.outage = "503"
+        before = fake.requests
+        data, status = await client.request("POST", "rpc/economy_credit", data={"p_discord_id": "100000", "p_amount": 1})
+        check("non-idempotent writes are not retried", status == 503 and fake.requests - before == 1,
+              f"{fake.requests - before} attempt(s)")
+
+        fake.outage = "timeout"
+        start = time.perf_counter()
+        try:
+            await client.request("GET", "accounts", "?limit=1", timeout=0.1)
+            timed_out = False
+        except main.SupabaseUnavailable:
+            timed_out = True
+        elapsed = time.perf_counter() - start
+        check("stalled reads time out", timed_out and elapsed < 2, f"{elapsed:.2f}s for {main.SUPABASE_RETRIES + 1} attempts")
+
+        fake.outage = "reset"
+        for _ in range(3):
+            with contextlib.suppress(main.SupabaseUnavailable):
+                await get()
+        check("breaker opens during an outage", breaker.state == "open", f"{breaker.trips} trip(s)")
+
+        before, start = fake.requests, time.perf_counter()
+        try:
+            await get()
+            fast = False
+        except main.SupabaseUnavailable:
+            fast = fake.requests == before
+        check("open breaker fails fast", fast, f"{(time.perf_counter() - start) * 1000:.1f} ms, no request sent")
+
+        interaction = FakeInteraction(FakeUser(100_000))
+        main.account_cache.invalidate(discord_id=100_000)
+        await main.balance.callback(interaction)
+        check("commands report the outage", any("temporarily unavailable" in str(m) for m in interaction.sent),
+              interaction.sent[-1] if interaction.sent else "nothing sent")
+
+        interaction = FakeInteraction(FakeUser(100_001))
+        await main.open_blackjack_table(interaction, {"discord_id": "100001"}, 10.0)
+        check("a bet that cannot be escrowed leaves no table behind",
+              not main.blackjack_tables.has_table(100_001) and any("Failed to place your bet" in str(m) for m in interaction.sent),
+              interaction.sent[-1] if interaction.sent else "nothing sent")
+
+        session = main.blackjack_tables.open(100_002, 10.0)
+        session.player, session.dealer = ["10", "Q"], ["10", "7"]
+        buffered = main.balance_write_behind.pending_delta(100_002)
+        await main.finish_blackjack(session)
+        check("a payout that cannot be credited goes to the write-behind buffer",
+              main.balance_write_behind.pending_delta(100_002) - buffered == 20.0,
+              f"{main.balance_write_behind.pending_delta(100_002) - buffered:.2f} buffered")
+
+        session = main.blackjack_tables.open(100_003, 10.0)
+        session.player = ["5", "6"]
+        view, interaction = main.BlackjackView(session), FakeInteraction(FakeUser(100_003))
+        await view.double.callback(interaction)
+        check("a failed double leaves the hand playable", not session.done and session.bet == 10.0
+              and any("Failed to double" in str(m) for m in interaction.sent),
+              interaction.sent[-1] if interaction.sent else "nothing sent")
+        main.blackjack_tables.close(session)
+
+        fake.outage = None
+        await wait_for_half_open()
+        data, status = await get()
+        check("breaker closes after a successful probe", status == 200 and breaker.state == "closed")
+
+        fake.outage = "503"
+        for _ in range(3):
+            with contextlib.suppress(main.SupabaseUnavailable):
+                await get()
+        await wait_for_half_open()
+        fake.outage = "timeout"
+        probe = asyncio.create_task(get())
+        await asyncio.sleep(0.05)
+        probe.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await probe
+        fake.outage = None
+        try:
+            data, status = await get()
+        except main.SupabaseUnavailable as e:
+            data, status = str(e), None
+        check("a cancelled probe does not wedge the breaker", status == 200, f"state {breaker.state}")
+    finally:
+        fake.outage, fake.fault_rate = None, 0.0
+        await client.close()
+        await runner.cleanup()
+
+    print(f"\n{len(failed)} of the checks failed" if failed else "\nall checks passed")
+    return not failed
+
+async def check_channel_writer(args):
+    """Batching limits, rate-limit retries and drop accounting of ChannelWriter against a fake channel."""
+    fake = FakePostgREST()
+    runner, main = await serve(fake)
+    failed = []
+    channel_ids = iter(range(1, 1_000))
+
+    def check(name, ok, detail=""):
+        print(f"{'ok' if ok else 'FAILED':8}{name}{f'  ({detail})' if detail else ''}")
+        if not ok:
+            failed.append(name)
+
+    def counter(name, writer):
+        return main.metrics._counters.get(name, {}).get(main._label_key(writer.labels), 0)
+
+    def writer_for(channel, maxsize=main.CHANNEL_QUEUE_SIZE):
+        writer = main.ChannelWriter(next(channel_ids), 0, maxsize)
+        writer.get_channel = lambda: channel
+        return writer
+
+    try:
+        # A burst of plugin events, formatted by the real forwarder into full 20-line embeds.
+        channel = FakeChannel()
+        writer = main.channel_writers[main.MC_EVENT_CHANNEL] = writer_for(channel)
+        events = [{"type": "join", "player": f"player_with_a_long_name_{i:05}"} for i in range(400)]
+        main.mc_event_forwarder.offer(events)
+        await main.mc_event_forwarder._flush()
+        await writer._flush()
+        sizes = [sum(len(embed) for embed in message) for message in channel.messages]
+        delivered = sum(len(embed.description.split("\n")) for message in channel.messages for embed in message)
+        check("messages stay within 10 embeds and 6000 characters",
+              all(len(m) <= main.MAX_EMBEDS_PER_MESSAGE for m in channel.messages)
+              and max(sizes, default=0) <= main.MAX_EMBED_CHARS_PER_MESSAGE,
+              f"{len(channel.messages)} messages, largest {max(sizes, default=0)} chars")
+        check("every event is delivered in order", delivered == len(events)
+              and channel.messages[0][0].description.startswith("📥 **player_with_a_long_name_00000**"),
+              f"{delivered}/{len(events)} lines")
+
+        channel = FakeChannel(failures=[429, 429])
+        writer = writer_for(channel)
+        for i in range(25):
+            writer.send(discord.Embed(description=f"sale {i}"))
+        await writer._flush()
+        order = [embed.description for message in channel.messages for embed in message]
+        check("rate-limited batches are retried after Retry-After",
+              order == [f"sale {i}" for i in range(25)] and counter("channel_rate_limited_total", writer) == 2,
+              f"{len(order)} embeds sent, {counter('channel_rate_limited_total', writer):.0f} rate limits")
+
+        channel = FakeChannel(failures=[400])
+        writer = writer_for(channel)
+        for i in range(12):
+            writer.send(discord.Embed(description=f"sale {i}"))
+        await writer._flush()
+        check("a rejected batch is dropped and counted",
+              counter("channel_embeds_dropped_total", writer) == 10 and len(channel.messages) == 1,
+              f"{counter('channel_embeds_dropped_total', writer):.0f} dropped, {len(channel.messages[0])} sent")
+
+        writer = writer_for(FakeChannel(), maxsize=5)
+        accepted = sum(writer.send(discord.Embed(description=str(i))) for i in range(8))
+        depth = main.metrics._gauges["channel_queue_depth"][main._label_key(writer.labels)]
+        check("a full queue rejects and counts drops",
+              accepted == 5 and counter("channel_embeds_dropped_total", writer) == 3 and depth == 5,
+              f"{accepted} queued, depth gauge {depth:.0f}")
+
+        # Discord falling behind: the writer fills up, plugin events back up in the forwarder
+        # and /mc/events starts answering 429 instead of events being dropped.
+        channel = FakeChannel()
+        writer = main.channel_writers[main.MC_EVENT_CHANNEL] = writer_for(channel, maxsize=3)
+        forwarder = main.McEventForwarder(100, 0)
+        forwarder.offer([{"type": "join", "player": f"p{i}"} for i in range(100)])
+        await forwarder._flush()
+        backed_up = len(forwarder._events)
+        refused = not forwarder.offer([{"type": "join", "player": "late"}] * 70)
+        await writer._flush()
+        await forwarder._flush()
+        await writer._flush()
+        delivered = sum(len(embed.description.split("\n")) for message in channel.messages for embed in message)
+        check("a full writer backs events up instead of dropping them",
+              backed_up == 40 and refused and forwarder.dropped == 0 and delivered == 100,
+              f"{backed_up} held back, offer refused: {refused}, {delivered} delivered, {forwarder.dropped} dropped")
+    finally:
+        for writer in main.channel_writers.values():
+            with contextlib.suppress(RuntimeError):
+                await writer.stop()
+        await runner.cleanup()
+
+    print(f"\n{len(failed)} of the checks failed" if failed else "\nall checks passed")
+    return not failed
+
+async def run(args):
+    rng = random.Random(args.seed)
+    fake = FakePostgREST(latency=args.db_latency_ms / 1000)
+    fake.seed(rng, args.accounts, args.listings or args.ops, args.factions)
+    runner, main = await serve(fake)
+    fake.fault_rng = random.Random(args.seed)
+    fake.fault_kinds = tuple(kind for kind in args.fault_kinds.split(",") if kind)
+    fake.fault_rate = args.fault_rate
+
+    test = LoadTest(main, fake, rng, parse_mix(args.mix), args.factions, args.bulk_targets)
+    users = {user.id: user for user in test.users}
+    main.bot.get_user = users.get  # leaderboard/profile name lookups stay local
+
+    await main.supabase.start()
+    main.ledger.start()
+    main.balance_write_behind.start()
+    await main.item_type_index.refresh()
+    await main.faction_index.load()
+    supply_before = fake.total_supply()
+    ok = True
+    try:
+        wall = await test.run(args.ops, args.concurrency)
+        test.report(wall)
+        if args.check_conservation:
+            await main.balance_write_behind.flush()
+            supply_after = fake.total_supply()
+            negative = sum(1 for row in fake.table("accounts") if (row.get("balance") or 0) < 0)
+            ok = supply_after == supply_before and negative == 0 and test.errors == 0
+            print(f"\ntotal supply {supply_before:.2f} -> {supply_after:.2f}, "
+                  f"{negative} negative balances: {'OK' if ok else 'FAILED'}")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({
+                    command: {
+                        "ops": len(stats["latencies"]),
+                        "p50_ms": percentile(sorted(stats["latencies"]), 50) * 1000,
+                        "p95_ms": percentile(sorted(stats["latencies"]), 95) * 1000,
+                        "p99_ms": percentile(sorted(stats["latencies"]), 99) * 1000
+                    }
+                    for command, stats in test.results.items()
+                }, f, indent=2)
+    finally:
+        await main.balance_write_behind.stop()
+        await main.ledger.stop()
+        for writer in main.channel_writers.values():
+            # Writers wait for a Discord login that never happens here.
+            with contextlib.suppress(RuntimeError):
+                await writer.stop()
+        await main.supabase.close()
+        await runner.cleanup()
+    return ok
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Load-test main.py against an in-memory PostgREST stand-in")
+    parser.add_argument("--accounts", type=int, default=500)
+    parser.add_argument("--listings", type=int, default=0, help="default: one per op")
+    parser.add_argument("--factions", type=int, default=20)
+    parser.add_argument("--ops", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--db-latency-ms", type=float, default=0.0, help="added to every REST call")
+    parser.add_argument("--mix", default="", help="command=weight,... (default: a mixed workload)")
+    parser.add_argument("--bulk-targets", type=int, default=1000, help="accounts per givemoney_bulk/removemoney_bulk call")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", default="", help="also write per-command percentiles to this file")
+    parser.add_argument("--check-conservation", action="store_true",
+                        help="exit 1 unless total supply is unchanged (mix may only move money)")
+    parser.add_argument("--bench-factions", default="", metavar="N,N,...",
+                        help="only report REST calls per faction overview at each faction count")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="fraction of REST calls that fail")
+    parser.add_argument("--fault-kinds", default="503,429,reset", help=f"comma-separated, from {','.join(FAULT_KINDS)}")
+    parser.add_argument("--check-faults", action="store_true",
+                        help="only run the scripted retry/timeout/circuit-breaker checks")
+    parser.add_argument("--check-channel-writer", action="store_true",
+                        help="only run the batched channel writer checks against a fake channel")
+    args = parser.parse_args()
+    if set(filter(None, args.fault_kinds.split(","))) - set(FAULT_KINDS):
+        parser.error(f"--fault-kinds must be chosen from {', '.join(FAULT_KINDS)}")
+    if args.check_conservation and set(parse_mix(args.mix)) - CONSERVING:
+        parser.error(f"--check-conservation needs a mix of {', '.join(sorted(CONSERVING))} only")
+    if args.check_faults:
+        job = check_faults(args)
+    elif args.check_channel_writer:
+        job = check_channel_writer(args)
+    elif args.bench_factions:
+        job = bench_factions(args)
+    else:
+        job = run(args)
+    if not asyncio.run(job):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
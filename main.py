@@ -1,13 +1,30 @@
 import os
+import json
 import discord
+from discord import app_commands
 from discord.ext import commands
 import aiohttp
 import re
 import random
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 import uvicorn
 import asyncio
-from datetime import datetime
+import bisect
+import contextlib
+import contextvars
+import functools
+import heapq
+import hmac
+import io
+import time
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from urllib.parse import quote
+from datetime import datetime, timezone
+
+from blackjack import STAND_ON, draw_card, format_hand, hand_value, outcome, play_hand
 
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -23,7 +40,59 @@ intents.guilds = True
 intents.members = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class EconomyBot(commands.Bot):
+    api_server = None
+    api_task = None
+
+    async def setup_hook(self):
+        await supabase.start()
+        balance_write_behind.recover()
+        balance_write_behind.start()
+        self.api_server = EmbeddedServer(
+            uvicorn.Config(api, host=API_HOST, port=API_PORT, log_level="warning", lifespan="off")
+        )
+        self.api_task = asyncio.create_task(self.api_server.serve())
+        if not MC_PLUGIN_KEY:
+            print("MC PLUGIN API DISABLED: set MC_PLUGIN_KEY to accept /mc/events and /mc/deliveries calls")
+        mc_event_forwarder.start()
+        faction_embed_refresher.start()
+        top_balances.start()
+        ledger.start()
+        blackjack_tables.start()
+        economy_scheduler.start()
+        await item_type_index.refresh()
+        try:
+            await faction_index.load()
+        except Exception as e:
+            print("FACTION INDEX LOAD ERROR:", e)
+        faction_index.start()
+        try:
+            await market_engine.load()
+        except Exception as e:
+            print("ORDER BOOK LOAD ERROR:", e)
+        market_engine.start()  # retries the load until it succeeds
+
+    async def close(self):
+        try:
+            if self.api_server is not None:
+                self.api_server.should_exit = True
+                await self.api_task
+            await mc_event_forwarder.stop()
+            for writer in channel_writers.values():
+                await writer.stop()
+            await faction_embed_refresher.stop()
+            await faction_index.stop()
+            await market_engine.stop()
+            await top_balances.stop()
+            await blackjack_tables.stop()
+            await economy_scheduler.stop()
+            await super().close()
+        finally:
+            await balance_write_behind.stop()
+            await ledger.stop()
+            await supabase.close()
+
+bot = EconomyBot(command_prefix="!", intents=intents)
 tree = bot.tree
 
 # ---------------- SAFE JSON PARSER ----------------
@@ -34,51 +103,1142 @@ async def safe_json(res):
         text = await res.text()
         return {"error": text}
 
+# ---------------- METRICS ----------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Name of the slash command being handled by the current task, for attributing Supabase time.
+current_command = contextvars.ContextVar("current_command", default=None)
+
+class Histogram:
+    """Bucketed histogram with Prometheus-style upper bounds."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+class Metrics:
+    """Counters, gauges and histograms, rendered in the Prometheus text format on /metrics."""
+
+    def __init__(self):
+        self._counters = {}    # name -> {label key: value}
+        self._gauges = {}
+        self._histograms = {}  # name -> {label key: Histogram}
+        self._collectors = []  # (prefix, callable returning {name: number})
+
+    def inc(self, name, labels=None, value: float = 1.0):
+        series = self._counters.setdefault(name, {})
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def gauge_add(self, name, labels=None, value: float = 1.0):
+        series = self._gauges.setdefault(name, {})
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name, labels=None, value: float = 0.0, buckets=LATENCY_BUCKETS):
+        series = self._histograms.setdefault(name, {})
+        key = _label_key(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def register_histogram(self, name, histogram: Histogram):
+        self._histograms.setdefault(name, {})[()] = histogram
+
+    def register_collector(self, prefix: str, collect):
+        self._collectors.append((prefix, collect))
+
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self._counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{_format_labels(key)} {value}" for key, value in series.items())
+
+        gauges = {name: dict(series) for name, series in self._gauges.items()}
+        for prefix, collect in self._collectors:
+            for key, value in collect().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges[f"{prefix}_{key}"] = {(): value}
+        for name, series in sorted(gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(f"{name}{_format_labels(key)} {value}" for key, value in series.items())
+
+        for name, series in sorted(self._histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for key, histogram in series.items():
+                for bound, count in histogram.cumulative():
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', le)])} {count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def instrumented(func):
+    """Record duration, in-flight count and escaped errors for a slash command handler."""
+    command = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        labels = {"command": command}
+        token = current_command.set(command)
+        metrics.gauge_add("command_in_flight", labels, 1)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            metrics.inc("command_errors_total", {"command": command, "error": type(e).__name__})
+            raise
+        finally:
+            metrics.observe("command_duration_seconds", labels, time.perf_counter() - start)
+            metrics.gauge_add("command_in_flight", labels, -1)
+            current_command.reset(token)
+
+    return wrapper
+
+# ---------------- SUPABASE CLIENT (POOLED) ----------------
+SUPABASE_POOL_LIMIT = int(os.getenv("SUPABASE_POOL_LIMIT", "100"))
+SUPABASE_POOL_LIMIT_PER_HOST = int(os.getenv("SUPABASE_POOL_LIMIT_PER_HOST", "50"))
+SUPABASE_KEEPALIVE_TIMEOUT = float(os.getenv("SUPABASE_KEEPALIVE_TIMEOUT", "60"))
+SUPABASE_DNS_CACHE_TTL = int(os.getenv("SUPABASE_DNS_CACHE_TTL", "300"))
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "10"))
+SUPABASE_RETRIES = int(os.getenv("SUPABASE_RETRIES", "3"))
+SUPABASE_BACKOFF_BASE = float(os.getenv("SUPABASE_BACKOFF_BASE", "0.2"))
+SUPABASE_BACKOFF_MAX = float(os.getenv("SUPABASE_BACKOFF_MAX", "5"))
+SUPABASE_BREAKER_THRESHOLD = int(os.getenv("SUPABASE_BREAKER_THRESHOLD", "5"))
+SUPABASE_BREAKER_RESET = float(os.getenv("SUPABASE_BREAKER_RESET", "30"))
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+class SupabaseUnavailable(Exception):
+    """Supabase could not be reached: circuit open, timeouts or connection errors after retries."""
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures, then lets one probe through every `reset_timeout` seconds."""
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                self.rejected += 1
+                return False
+            self._probing = True
+        return True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                self.trips += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def release_probe(self):
+        """Free the half-open probe slot when the probe ended without an outcome (e.g. it was cancelled)."""
+        self._probing = False
+
+class SupabaseClient:
+    """One long-lived aiohttp session (and connection pool) shared by every PostgREST call."""
+
+    def __init__(self, url, key):
+        self.url = url
+        self.key = key
+        self.session = None
+        self.requests_total = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.pool_waits = 0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.breaker = CircuitBreaker(SUPABASE_BREAKER_THRESHOLD, SUPABASE_BREAKER_RESET)
+
+    async def start(self):
+        if self.session is not None and not self.session.closed:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=SUPABASE_POOL_LIMIT,
+            limit_per_host=SUPABASE_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=SUPABASE_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=SUPABASE_DNS_CACHE_TTL,
+            use_dns_cache=True,
+            enable_cleanup_closed=True
+        )
+
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_connection_create)
+        trace.on_connection_reuseconn.append(self._on_connection_reuse)
+        trace.on_connection_queued_start.append(self._on_pool_wait)
+        trace.on_dns_cache_hit.append(self._on_dns_hit)
+        trace.on_dns_cache_miss.append(self._on_dns_miss)
+
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            trace_configs=[trace],
+            headers={"apikey": self.key, "Authorization": f"Bearer {self.key}"}
+        )
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def request(self, method, table, params="", data=None, headers=None, timeout=None):
+        data, status, _ = await self.request_full(method, table, params, data, headers, timeout)
+        return data, status
+
+    async def request_full(self, method, table, params="", data=None, headers=None, timeout=None):
+        """Send one PostgREST request.
+
+        GET/HEAD, and writes carrying an Idempotency-Key header, are retried with jittered
+        exponential backoff on timeouts, connection errors, 429 and 5xx. Everything else is
+        sent once. Raises SupabaseUnavailable while the circuit breaker is open or when no
+        response could be obtained at all.
+        """
+        if self.session is None or self.session.closed:
+            await self.start()
+
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await self._request_with_retries(method, table, params, data, headers, timeout)
+            status = str(response[1])
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            labels = {"method": method, "table": table}
+            metrics.observe("supabase_request_duration_seconds", labels, elapsed)
+            metrics.inc("supabase_requests_total", {**labels, "status": status})
+            command = current_command.get()
+            if command is not None:
+                metrics.inc("command_supabase_seconds_total", {"command": command}, elapsed)
+                metrics.inc("command_supabase_requests_total", {"command": command})
+
+    async def _request_with_retries(self, method, table, params, data, headers, timeout):
+        url = f"{self.url}/rest/v1/{table}{params}"
+        idempotent = method in SAFE_METHODS or bool(headers and "Idempotency-Key" in headers)
+        attempts = SUPABASE_RETRIES + 1 if idempotent else 1
+        client_timeout = aiohttp.ClientTimeout(total=timeout or SUPABASE_TIMEOUT)
+        response = None
+        error = None
+
+        for attempt in range(attempts):
+            if attempt > 0:
+                self.retries += 1
+                await asyncio.sleep(self._backoff(attempt, response))
+
+            if not self.breaker.allow():
+                raise SupabaseUnavailable(f"circuit open for {method} {table}")
+            probing = self.breaker.state == "half_open"
+
+            self.requests_total += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            try:
+                async with self.session.request(
+                    method, url, headers=headers, json=data, timeout=client_timeout
+                ) as res:
+                    response = (await safe_json(res), res.status, res.headers)
+                    error = None
+            except asyncio.TimeoutError as e:
+                self.timeouts += 1
+                self.breaker.record_failure()
+                response, error = None, e
+                continue
+            except aiohttp.ClientError as e:
+                self.breaker.record_failure()
+                response, error = None, e
+                continue
+            except BaseException:
+                # Cancelled, or failed in a way that says nothing about Supabase's health.
+                if probing:
+                    self.breaker.release_probe()
+                raise
+            finally:
+                self.in_flight -= 1
+
+            if response[1] >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            if response[1] not in RETRYABLE_STATUSES:
+                return response
+
+        if response is not None:
+            return response
+        raise SupabaseUnavailable(f"{method} {table} failed: {error!r}") from error
+
+    def _backoff(self, attempt: int, response) -> float:
+        if response is not None:
+            retry_after = response[2].get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(float(retry_after), SUPABASE_BACKOFF_MAX)
+        return random.uniform(0, min(SUPABASE_BACKOFF_MAX, SUPABASE_BACKOFF_BASE * 2 ** attempt))
+
+    def pool_stats(self):
+        connector = self.session.connector if self.session is not None else None
+        idle = 0
+        if connector is not None:
+            idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        return {
+            "requests_total": self.requests_total,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "idle_connections": idle,
+            "pool_waits": self.pool_waits,
+            "dns_cache_hits": self.dns_cache_hits,
+            "dns_cache_misses": self.dns_cache_misses,
+            "limit": SUPABASE_POOL_LIMIT,
+            "limit_per_host": SUPABASE_POOL_LIMIT_PER_HOST
+        }
+
+    def health_stats(self):
+        return {
+            "breaker_state": self.breaker.state,
+            "breaker_trips": self.breaker.trips,
+            "breaker_rejected": self.breaker.rejected,
+            "consecutive_failures": self.breaker.failures,
+            "retries": self.retries,
+            "timeouts": self.timeouts
+        }
+
+    async def _on_connection_create(self, session, ctx, params):
+        self.connections_created += 1
+
+    async def _on_connection_reuse(self, session, ctx, params):
+        self.connections_reused += 1
+
+    async def _on_pool_wait(self, session, ctx, params):
+        self.pool_waits += 1
+
+    async def _on_dns_hit(self, session, ctx, params):
+        self.dns_cache_hits += 1
+
+    async def _on_dns_miss(self, session, ctx, params):
+        self.dns_cache_misses += 1
+
+supabase = SupabaseClient(SUPABASE_URL, SUPABASE_KEY)
+
 # ---------------- SUPABASE HELPERS ----------------
-async def supabase_get(session, table, params=""):
-    url = f"{SUPABASE_URL}/rest/v1/{table}{params}"
-    headers = {"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"}
-    async with session.get(url, headers=headers) as res:
-        return await safe_json(res), res.status
-
-async def supabase_post(session, table, data):
-    url = f"{SUPABASE_URL}/rest/v1/{table}"
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Prefer": "return=representation",
-        "Content-Type": "application/json"
-    }
-    async with session.post(url, headers=headers, json=data) as res:
-        return await safe_json(res), res.status
+async def supabase_get(table, params="", timeout=None):
+    return await supabase.request("GET", table, params, timeout=timeout)
 
-async def supabase_patch(session, table, params, data):
-    url = f"{SUPABASE_URL}/rest/v1/{table}{params}"
+async def supabase_get_page(table, params="", count="estimated"):
+    """GET with a row count from Content-Range (Prefer: count=...). Returns (data, status, total)."""
+    data, status, headers = await supabase.request_full(
+        "GET", table, params, headers={"Prefer": f"count={count}"}
+    )
+    total = None
+    content_range = headers.get("Content-Range", "")
+    if "/" in content_range:
+        total_str = content_range.rsplit("/", 1)[1]
+        if total_str.isdigit():
+            total = int(total_str)
+    return data, status, total
+
+async def supabase_post(table, data):
     headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "Prefer": "return=representation",
         "Content-Type": "application/json"
     }
-    async with session.patch(url, headers=headers, json=data) as res:
-        return await safe_json(res), res.status
+    return await supabase.request("POST", table, data=data, headers=headers)
+
+async def supabase_patch(table, params, data, idempotency_key=None):
+    headers = {"Content-Type": "application/json"}
+    if idempotency_key:
+        headers["Idempotency-Key"] = idempotency_key
+    return await supabase.request("PATCH", table, params, data=data, headers=headers)
+
+def internal_error_text(e, default="❌ Internal error."):
+    metrics.inc("command_errors_total", {"command": current_command.get() or "unknown", "error": type(e).__name__})
+    if isinstance(e, SupabaseUnavailable):
+        return "❌ The economy database is temporarily unavailable. Please try again in a moment."
+    return default
+
+# ---------------- ACCOUNT CACHE ----------------
+ACCOUNT_CACHE_SIZE = int(os.getenv("ACCOUNT_CACHE_SIZE", "10000"))
+ACCOUNT_CACHE_TTL = float(os.getenv("ACCOUNT_CACHE_TTL", "30"))
+
+class _CachedAccount:
+    __slots__ = ("row", "expires_at")
+
+    def __init__(self, row, expires_at):
+        self.row = row
+        self.expires_at = expires_at
+
+class AccountCache:
+    """Bounded LRU+TTL cache of account rows. One entry per account, indexed by discord_id and mc_uuid.
+
+    Every write-through or invalidation bumps a version counter. A caller that fills the cache from a
+    read takes read_version() before the request and passes it to put(), so a row fetched before a
+    newer write-through can't replace the balance that write recorded.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # entry -> None, least recently used first
+        self._by_discord = {}
+        self._by_mc = {}
+        self._version = 0
+        self._writes = OrderedDict()   # ("discord"|"mc", key) -> (version, balance or None if invalidated)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get_by_discord(self, discord_id):
+        return self._lookup(self._by_discord, str(discord_id))
+
+    def get_by_mc_uuid(self, mc_uuid: str):
+        return self._lookup(self._by_mc, mc_uuid)
+
+    def read_version(self):
+        return self._version
+
+    def put(self, row: dict, since=None):
+        discord_id = row.get("discord_id")
+        mc_uuid = row.get("mc_uuid")
+        if discord_id is None and mc_uuid is None:
+            return row
+
+        if since is not None:
+            for key in (("discord", str(discord_id)), ("mc", mc_uuid)):
+                written = self._writes.get(key)
+                if written is None or written[0] <= since:
+                    continue
+                if written[1] is None:
+                    return row  # invalidated while the read was in flight: serve it, don't cache it
+                row = {**row, "balance": written[1]}
+
+        if discord_id is not None:
+            discord_id = str(discord_id)
+            old = self._by_discord.get(discord_id)
+            if old is not None:
+                self._remove(old)
+        if mc_uuid is not None:
+            old = self._by_mc.get(mc_uuid)
+            if old is not None:
+                self._remove(old)
+
+        entry = _CachedAccount(dict(row), time.monotonic() + self.ttl)
+        self._entries[entry] = None
+        if discord_id is not None:
+            self._by_discord[discord_id] = entry
+        if mc_uuid is not None:
+            self._by_mc[mc_uuid] = entry
+
+        while len(self._entries) > self.maxsize:
+            oldest, _ = self._entries.popitem(last=False)
+            self._unindex(oldest)
+            self.evictions += 1
+        return dict(entry.row)
+
+    def update_balance(self, discord_id, balance: float):
+        self._record_write(("discord", str(discord_id)), balance)
+        entry = self._by_discord.get(str(discord_id))
+        if entry is not None:
+            entry.row["balance"] = balance
+
+    def invalidate(self, discord_id=None, mc_uuid=None):
+        if discord_id is not None:
+            self._record_write(("discord", str(discord_id)), None)
+        if mc_uuid is not None:
+            self._record_write(("mc", mc_uuid), None)
+        if discord_id is not None:
+            entry = self._by_discord.get(str(discord_id))
+            if entry is not None:
+                self._remove(entry)
+        if mc_uuid is not None:
+            entry = self._by_mc.get(mc_uuid)
+            if entry is not None:
+                self._remove(entry)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+    def _lookup(self, index, key):
+        entry = index.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if entry.expires_at <= time.monotonic():
+            self._remove(entry)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(entry)
+        self.hits += 1
+        return dict(entry.row)
+
+    def _record_write(self, key, balance):
+        self._version += 1
+        self._writes.pop(key, None)
+        self._writes[key] = (self._version, balance)
+        while len(self._writes) > self.maxsize:
+            self._writes.popitem(last=False)
+
+    def _remove(self, entry):
+        self._entries.pop(entry, None)
+        self._unindex(entry)
+
+    def _unindex(self, entry):
+        discord_id = entry.row.get("discord_id")
+        if discord_id is not None and self._by_discord.get(str(discord_id)) is entry:
+            del self._by_discord[str(discord_id)]
+        mc_uuid = entry.row.get("mc_uuid")
+        if mc_uuid is not None and self._by_mc.get(mc_uuid) is entry:
+            del self._by_mc[mc_uuid]
+
+account_cache = AccountCache(ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL)
 
 # ---------------- ACCOUNT HELPERS ----------------
-async def get_account_by_discord(session, discord_id: int):
+# Both lookups include game results still waiting in the write-behind buffer.
+async def get_account_by_discord(discord_id: int):
+    cached = account_cache.get_by_discord(discord_id)
+    if cached is not None:
+        return balance_write_behind.overlay(cached)
+
     discord_id_str = str(discord_id)
-    data, status = await supabase_get(session, "accounts", f"?discord_id=eq.{discord_id_str}")
-    return data[0] if status == 200 and isinstance(data, list) and data else None
-
-async def get_account_by_mc_uuid(session, mc_uuid: str):
-    data, status = await supabase_get(session, "accounts", f"?mc_uuid=eq.{mc_uuid}")
-    return data[0] if status == 200 and isinstance(data, list) and data else None
-
-async def update_account_balance(session, discord_id: int, new_balance: float):
-    await supabase_patch(
-        session,
-        "accounts",
-        f"?discord_id=eq.{str(discord_id)}",
-        {"balance": new_balance}
-    )
+    since = account_cache.read_version()
+    data, status = await supabase_get("accounts", f"?discord_id=eq.{discord_id_str}")
+    if status == 200 and isinstance(data, list) and data:
+        return balance_write_behind.overlay(account_cache.put(data[0], since))
+    return None
+
+async def get_account_by_mc_uuid(mc_uuid: str):
+    cached = account_cache.get_by_mc_uuid(mc_uuid)
+    if cached is not None:
+        return balance_write_behind.overlay(cached)
+
+    since = account_cache.read_version()
+    data, status = await supabase_get("accounts", f"?mc_uuid=eq.{mc_uuid}")
+    if status == 200 and isinstance(data, list) and data:
+        return balance_write_behind.overlay(account_cache.put(data[0], since))
+    return None
+
+def remember_balance(discord_id, balance: float):
+    account_cache.update_balance(discord_id, balance)
+    top_balances.update(discord_id, balance)
+
+# ---------------- LEADERBOARD (TOP-K) ----------------
+LEADERBOARD_TRACKED = int(os.getenv("LEADERBOARD_TRACKED", "50"))
+LEADERBOARD_RECONCILE_INTERVAL = float(os.getenv("LEADERBOARD_RECONCILE_INTERVAL", "300"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "3600"))
+
+class TopBalances:
+    """The K highest balances, kept sorted in memory.
+
+    Updated whenever this process changes a balance and reconciled against the database
+    periodically. `floor` is an upper bound on every untracked balance, so tracked entries
+    at or above it are known to be in the right order.
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self.floor = float("-inf")
+        self.loaded = False
+        self._sorted = []  # (-balance, discord_id), richest first
+        self._balances = {}
+        self._task = None
+
+    def update(self, discord_id, balance: float):
+        discord_id = str(discord_id)
+        old = self._balances.pop(discord_id, None)
+        if old is not None:
+            del self._sorted[bisect.bisect_left(self._sorted, (-old, discord_id))]
+
+        if balance < self.floor:
+            return
+
+        bisect.insort(self._sorted, (-balance, discord_id))
+        self._balances[discord_id] = balance
+        while len(self._sorted) > self.k:
+            neg_balance, dropped = self._sorted.pop()
+            del self._balances[dropped]
+            self.floor = max(self.floor, -neg_balance)
+
+    def top(self, n: int):
+        return [(discord_id, -neg_balance) for neg_balance, discord_id in self._sorted[:n]]
+
+    def needs_reconcile(self, n: int) -> bool:
+        # Fewer than n tracked entries while untracked accounts may exist: the order is unknown.
+        return not self.loaded or (len(self._sorted) < n and self.floor != float("-inf"))
+
+    async def reconcile(self):
+        data, status = await supabase_get(
+            "accounts",
+            f"?select=discord_id,balance&discord_id=not.is.null&order=balance.desc&limit={self.k}"
+        )
+        if status != 200 or not isinstance(data, list):
+            print("LEADERBOARD RECONCILE ERROR:", status, data)
+            return False
+
+        self._sorted = sorted((-float(row.get("balance") or 0), str(row["discord_id"])) for row in data)
+        self._balances = {discord_id: -neg_balance for neg_balance, discord_id in self._sorted}
+        self.floor = -self._sorted[-1][0] if len(self._sorted) >= self.k else float("-inf")
+        self.loaded = True
+        return True
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self):
+        await bot.wait_until_ready()
+        while True:
+            try:
+                if await self.reconcile():
+                    await user_cache.resolve_many(int(discord_id) for discord_id, _ in self.top(10))
+            except Exception as e:
+                print("LEADERBOARD RECONCILE ERROR:", e)
+            await asyncio.sleep(LEADERBOARD_RECONCILE_INTERVAL)
+
+class UserCache:
+    """TTL cache of discord.User lookups; misses are resolved concurrently."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._users = {}  # user id -> (user or None, expires_at)
+
+    async def resolve_many(self, user_ids):
+        now = time.monotonic()
+        user_ids = list(user_ids)
+        missing = [uid for uid in user_ids if self._users.get(uid, (None, 0))[1] <= now]
+        if missing:
+            users = await asyncio.gather(*(self._fetch(uid) for uid in missing))
+            for uid, user in zip(missing, users):
+                self._users[uid] = (user, now + self.ttl)
+            self._users = {uid: entry for uid, entry in self._users.items() if entry[1] > now}
+        return {uid: self._users[uid][0] for uid in user_ids}
+
+    async def _fetch(self, user_id: int):
+        user = bot.get_user(user_id)
+        if user is not None:
+            return user
+        try:
+            return await bot.fetch_user(user_id)
+        except discord.HTTPException:
+            return None
+
+top_balances = TopBalances(LEADERBOARD_TRACKED)
+user_cache = UserCache(USER_CACHE_TTL)
+
+# ---------------- ACCOUNT LOCKS ----------------
+LOCK_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+class AccountLockManager:
+    """Keyed asyncio locks over "discord:<id>" / "mc:<uuid>" keys. Idle locks are dropped via weak references."""
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+        self.wait_time = Histogram(LOCK_WAIT_BUCKETS)
+
+    def _lock_for(self, key: str):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys):
+        # Always acquire in sorted key order so multi-account holders cannot deadlock.
+        locks = [self._lock_for(key) for key in sorted({key for key in keys if key})]
+        acquired = []
+        start = time.perf_counter()
+        try:
+            for lock in locks:
+                await lock.acquire()
+                acquired.append(lock)
+            self.wait_time.observe(time.perf_counter() - start)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    def hold_accounts(self, *accounts):
+        keys = []
+        for acc in accounts:
+            if acc:
+                keys.extend(account_lock_keys(acc.get("discord_id"), acc.get("mc_uuid")))
+        return self.hold(*keys)
+
+    def stats(self):
+        stats = {
+            "live_locks": len(self._locks),
+            "acquisitions": self.wait_time.count,
+            "total_wait_s": f"{self.wait_time.sum:.3f}"
+        }
+        for bound, count in self.wait_time.cumulative():
+            label = "+Inf" if bound == float("inf") else f"{bound}s"
+            stats[f"wait ≤ {label}"] = count
+        return stats
+
+def account_lock_keys(discord_id=None, mc_uuid=None):
+    keys = []
+    if discord_id is not None:
+        keys.append(f"discord:{discord_id}")
+    if mc_uuid:
+        keys.append(f"mc:{mc_uuid}")
+    return keys
+
+account_locks = AccountLockManager()
+
+# ---------------- BALANCE LEDGER (sql/ledger.sql) ----------------
+LEDGER_BATCH_SIZE = 500
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL", "5"))
+LEDGER_SNAPSHOT_INTERVAL = float(os.getenv("LEDGER_SNAPSHOT_INTERVAL", "86400"))
+
+class LedgerWriter:
+    """Buffers one ledger row per balance change and inserts them in batches.
+
+    Rows are never dropped: a failed batch goes back to the front of the buffer and is retried
+    on the next flush. entry_id makes retries of a batch that did land harmless. The buffer is
+    memory only, so rows not yet flushed are lost if the process dies; the balances themselves
+    are already committed, and the next snapshot makes balance_at() exact again.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, snapshot_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.written = 0
+        self.failed_flushes = 0
+        self.last_snapshot = None  # monotonic time of the newest snapshot, once looked up
+        self._entries = deque()
+        self._flush_lock = asyncio.Lock()
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def record(self, discord_id, delta: float, balance_after, reason: str, ref=None, created_at=None):
+        if not delta:
+            return
+        self._entries.append({
+            "entry_id": str(uuid.uuid4()),
+            "discord_id": str(discord_id),
+            "delta": delta,
+            "balance_after": balance_after,
+            "reason": reason,
+            "ref": ref,
+            "created_at": created_at or datetime.now(timezone.utc).isoformat()
+        })
+        if len(self._entries) >= self.batch_size:
+            self._ready.set()
+
+    def record_result(self, result, deltas, reason: str, ref=None):
+        """Record {discord_id: delta} for a successful economy RPC, taking balances from its result.
+
+        The rows are stamped with the RPC's applied_at (database clock, inside the transaction that
+        changed the balance) rather than the time the reply arrived here, so they sort on the right
+        side of a ledger_snapshot taken while the RPC was in flight.
+        """
+        balances = result.get("balances") or {}
+        applied_at = result.get("applied_at")
+        for discord_id, delta in deltas.items():
+            balance = balances.get(str(discord_id))
+            self.record(discord_id, delta, float(balance) if balance is not None else None, reason, ref, applied_at)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print("LEDGER FLUSH ERROR:", e)
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._entries:
+                batch = [self._entries.popleft() for _ in range(min(self.batch_size, len(self._entries)))]
+                try:
+                    # Without on_conflict PostgREST only ignores duplicate primary keys (id), and a
+                    # resent batch would fail with 409 on entry_id forever.
+                    _, status = await supabase.request("POST", "ledger", "?on_conflict=entry_id", data=batch, headers={
+                        "Content-Type": "application/json",
+                        "Prefer": "resolution=ignore-duplicates,return=minimal",
+                        "Idempotency-Key": batch[0]["entry_id"]
+                    })
+                except Exception:
+                    status = None
+                if status not in (200, 201, 204):
+                    self._entries.extendleft(reversed(batch))
+                    self.failed_flushes += 1
+                    print("LEDGER FLUSH ERROR:", status)
+                    return False
+                self.written += len(batch)
+            return True
+
+    async def load_last_snapshot(self):
+        """Start the snapshot clock from the newest balance_snapshots row, so restarts don't reset it."""
+        data, status = await supabase_get("balance_snapshots", "?select=taken_at&order=taken_at.desc&limit=1")
+        if status != 200 or not isinstance(data, list):
+            print("LEDGER SNAPSHOT LOOKUP ERROR:", status, data)
+            return False
+        if not data:
+            # No snapshot yet: balance_at() would replay from 0, so take one on this pass.
+            self.last_snapshot = time.monotonic() - self.snapshot_interval
+            return True
+        taken_at = datetime.fromisoformat(data[0]["taken_at"].replace("Z", "+00:00"))
+        age = max((datetime.now(timezone.utc) - taken_at).total_seconds(), 0.0)
+        self.last_snapshot = time.monotonic() - age
+        return True
+
+    async def snapshot(self):
+        # Flush first so the snapshot does not predate entries that are still buffered.
+        if not await self.flush():
+            return False
+        data, status = await supabase_rpc("ledger_snapshot", {})
+        if status != 200:
+            print("LEDGER SNAPSHOT ERROR:", status, data)
+            return False
+        self.last_snapshot = time.monotonic()
+        return True
+
+    def stats(self):
+        return {
+            "buffered": len(self._entries),
+            "written": self.written,
+            "failed_flushes": self.failed_flushes,
+            "since_snapshot_s": int(time.monotonic() - self.last_snapshot) if self.last_snapshot is not None else -1
+        }
+
+    async def _run(self):
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._ready.wait(), self.flush_interval)
+            self._ready.clear()
+            try:
+                await self.flush()
+                if self.last_snapshot is None:
+                    await self.load_last_snapshot()
+                if self.last_snapshot is not None and time.monotonic() - self.last_snapshot >= self.snapshot_interval:
+                    await self.snapshot()
+            except Exception as e:
+                print("LEDGER FLUSH ERROR:", e)
+
+ledger = LedgerWriter(LEDGER_BATCH_SIZE, LEDGER_FLUSH_INTERVAL, LEDGER_SNAPSHOT_INTERVAL)
+
+# ---------------- WRITE-BEHIND GAME BALANCES (economy_apply_deltas) ----------------
+BALANCE_WRITE_BEHIND = os.getenv("BALANCE_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+BALANCE_FLUSH_INTERVAL = float(os.getenv("BALANCE_FLUSH_MS", "2000")) / 1000
+BALANCE_FLUSH_OPS = int(os.getenv("BALANCE_FLUSH_OPS", "200"))
+BALANCE_JOURNAL_PATH = os.getenv("BALANCE_JOURNAL_PATH", "balance_journal.jsonl")
+
+class BalanceWriteBehind:
+    """Accumulates game balance deltas per account and applies them in one bulk RPC.
+
+    Every delta is appended to a local journal before it is acknowledged, and every batch is
+    journaled with its id before it is sent. After a crash, recover() replays the journal:
+    batches without a "done" record are resent under the same id (economy_apply_deltas ignores
+    a batch it has already applied) and loose deltas go back into the buffer.
+    """
+
+    def __init__(self, path: str, flush_interval: float, flush_ops: int):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_ops = flush_ops
+        self.flushed_batches = 0
+        self.failed_flushes = 0
+        self._pending = {}   # discord_id -> delta not yet in a batch
+        self._inflight = {}  # batch_id -> {discord_id: delta} sent but not confirmed
+        self._ops = 0
+        self._journal = None
+        self._flush_lock = asyncio.Lock()
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def pending_delta(self, discord_id) -> float:
+        key = str(discord_id)
+        total = self._pending.get(key, 0.0)
+        for deltas in self._inflight.values():
+            total += deltas.get(key, 0.0)
+        return total
+
+    def overlay(self, acc: dict):
+        """Return `acc` with buffered deltas applied to its balance (copying only when needed)."""
+        if not self._pending and not self._inflight:
+            return acc
+        delta = self.pending_delta(acc.get("discord_id"))
+        if not delta:
+            return acc
+        acc = dict(acc)
+        acc["balance"] = max(float(acc.get("balance", 0)) + delta, 0.0)
+        return acc
+
+    def add(self, discord_id, delta: float):
+        if not delta:
+            return
+        key = str(discord_id)
+        self._write({"op": "delta", "discord_id": key, "delta": delta})
+        self._pending[key] = self._pending.get(key, 0.0) + delta
+        self._ops += 1
+        if self._ops >= self.flush_ops:
+            self._ready.set()
+
+    async def settle(self, *discord_ids):
+        """Flush first if any of these accounts has buffered deltas, so a DB-side balance check sees them."""
+        if any(self.pending_delta(discord_id) for discord_id in discord_ids):
+            await self.flush()
+
+    def recover(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # torn final line from a crash mid-write
+                op = record.get("op")
+                if op == "delta":
+                    key = record["discord_id"]
+                    self._pending[key] = self._pending.get(key, 0.0) + record["delta"]
+                elif op == "batch":
+                    self._pending = {}
+                    self._inflight[record["batch_id"]] = record["deltas"]
+                elif op == "done":
+                    self._inflight.pop(record["batch_id"], None)
+        self._rewrite()
+        if self._pending or self._inflight:
+            print("BALANCE JOURNAL: recovered", len(self._inflight), "batches and", len(self._pending), "accounts")
+            self._ready.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print("BALANCE FLUSH ERROR:", e)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    async def flush(self):
+        async with self._flush_lock:
+            if self._pending:
+                batch_id = str(uuid.uuid4())
+                self._write({"op": "batch", "batch_id": batch_id, "deltas": self._pending})
+                self._inflight[batch_id] = self._pending
+                self._pending = {}
+                self._ops = 0
+
+            ok = True
+            for batch_id, deltas in list(self._inflight.items()):
+                result = await economy_rpc("economy_apply_deltas", {
+                    "p_batch_id": batch_id,
+                    "p_deltas": deltas
+                })
+                if not result.get("ok"):
+                    self.failed_flushes += 1
+                    ok = False
+                    break
+
+                del self._inflight[batch_id]
+                self._write({"op": "done", "batch_id": batch_id})
+                self.flushed_batches += 1
+                if not result.get("duplicate"):
+                    applied = result.get("applied") or {}
+                    ledger.record_result(result, applied, "blackjack", ref=f"batch:{batch_id}")
+                if result.get("missing"):
+                    print("BALANCE FLUSH: dropped deltas for missing accounts", result["missing"])
+
+            if not self._pending and not self._inflight:
+                self._rewrite()
+            return ok
+
+    def stats(self):
+        return {
+            "enabled": BALANCE_WRITE_BEHIND,
+            "pending_accounts": len(self._pending),
+            "pending_ops": self._ops,
+            "inflight_batches": len(self._inflight),
+            "flushed_batches": self.flushed_batches,
+            "failed_flushes": self.failed_flushes
+        }
+
+    def _write(self, record: dict):
+        if self._journal is None:
+            self._journal = open(self.path, "a", encoding="utf-8")
+        self._journal.write(json.dumps(record) + "\n")
+        self._journal.flush()
+
+    def _rewrite(self):
+        """Compact the journal down to what is still outstanding."""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for batch_id, deltas in self._inflight.items():
+                f.write(json.dumps({"op": "batch", "batch_id": batch_id, "deltas": deltas}) + "\n")
+            for discord_id, delta in self._pending.items():
+                f.write(json.dumps({"op": "delta", "discord_id": discord_id, "delta": delta}) + "\n")
+        os.replace(tmp_path, self.path)
+
+    async def _run(self):
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._ready.wait(), self.flush_interval)
+            self._ready.clear()
+            if not self._pending and not self._inflight:
+                continue
+            try:
+                await self.flush()
+            except Exception as e:
+                print("BALANCE FLUSH ERROR:", e)
+
+balance_write_behind = BalanceWriteBehind(BALANCE_JOURNAL_PATH, BALANCE_FLUSH_INTERVAL, BALANCE_FLUSH_OPS)
+
+# ---------------- ATOMIC BALANCE OPERATIONS (sql/economy_rpc.sql) ----------------
+async def supabase_rpc(function, args, idempotency_key=None):
+    headers = {"Content-Type": "application/json"}
+    if idempotency_key:
+        headers["Idempotency-Key"] = idempotency_key
+    return await supabase.request("POST", f"rpc/{function}", data=args, headers=headers)
+
+async def economy_rpc(function, args, idempotency_key=None):
+    data, status = await supabase_rpc(function, args, idempotency_key)
+    if status != 200 or not isinstance(data, dict):
+        print(f"{function.upper()} RPC ERROR:", status, data)
+        return {"ok": False, "error": "rpc_failed"}
+
+    for discord_id, balance in (data.get("balances") or {}).items():
+        remember_balance(discord_id, float(balance))
+    return data
+
+async def atomic_credit(discord_id: int, amount: float, reason: str = "credit"):
+    result = await economy_rpc("economy_credit", {
+        "p_discord_id": str(discord_id),
+        "p_amount": amount
+    })
+    if result.get("ok"):
+        ledger.record_result(result, {discord_id: amount}, reason)
+    return result
+
+async def atomic_debit(discord_id: int, amount: float, clamp: bool = False, reason: str = "debit"):
+    await balance_write_behind.settle(discord_id)
+    result = await economy_rpc("economy_debit", {
+        "p_discord_id": str(discord_id),
+        "p_amount": amount,
+        "p_clamp": clamp
+    })
+    if result.get("ok"):
+        ledger.record_result(result, {discord_id: -float(result.get("debited", amount))}, reason)
+    return result
+
+async def atomic_transfer(from_discord_id: int, to_discord_id: int, amount: float):
+    await balance_write_behind.settle(from_discord_id)
+    result = await economy_rpc("economy_transfer", {
+        "p_from": str(from_discord_id),
+        "p_to": str(to_discord_id),
+        "p_amount": amount
+    })
+    if result.get("ok"):
+        ledger.record_result(result, {from_discord_id: -amount}, "transfer_out", ref=str(to_discord_id))
+        ledger.record_result(result, {to_discord_id: amount}, "transfer_in", ref=str(from_discord_id))
+    return result
+
+async def atomic_purchase(listing_id: int, buyer_discord_id: int):
+    await balance_write_behind.settle(buyer_discord_id)
+    result = await economy_rpc("economy_purchase", {
+        "p_listing_id": listing_id,
+        "p_buyer_discord_id": str(buyer_discord_id)
+    })
+    if result.get("ok"):
+        cost = float(result["cost"])
+        deltas = {discord_id: cost for discord_id in result.get("balances") or {} if discord_id != str(buyer_discord_id)}
+        deltas[str(buyer_discord_id)] = -cost
+        ledger.record_result(result, deltas, "purchase", ref=f"listing:{listing_id}")
+    return result
+
+def result_balance(result, discord_id) -> float:
+    return float((result.get("balances") or {}).get(str(discord_id), 0))
 
 # ---------------- TARGET PARSER (for admin) ----------------
 def parse_target(target: str):
@@ -90,23 +1250,265 @@ def parse_target(target: str):
         return "mc", target
     return None, None
 
-# ---------------- MARKET PAGINATION VIEW ----------------
-class MarketView(discord.ui.View):
-    def __init__(self, listings, per_page: int = 10):
-        super().__init__(timeout=None)
-        self.listings = listings
+# ---------------- BULK ACCOUNT LOOKUP ----------------
+ACCOUNT_LOOKUP_CHUNK = 150  # ids per in.(...) query, keeps URLs well under proxy limits
+
+async def get_accounts_bulk(discord_ids=(), mc_uuids=()):
+    """Accounts for many Discord IDs and/or MC UUIDs, one `in.(...)` query per chunk, fetched concurrently.
+
+    Returns (by_discord, by_mc) dicts; ids with no account are simply absent.
+    """
+    keys = [("discord_id", str(d)) for d in dict.fromkeys(discord_ids)]
+    keys += [("mc_uuid", u) for u in dict.fromkeys(mc_uuids)]
+
+    queries = []
+    for i in range(0, len(keys), ACCOUNT_LOOKUP_CHUNK):
+        chunk = keys[i:i + ACCOUNT_LOOKUP_CHUNK]
+        clauses = []
+        for column in ("discord_id", "mc_uuid"):
+            values = [value for col, value in chunk if col == column]
+            if values:
+                clauses.append(f"{column}.in.({','.join(values)})")
+        queries.append(supabase_get("accounts", f"?or=({','.join(clauses)})&limit={len(chunk)}"))
+
+    since = account_cache.read_version()
+    by_discord, by_mc = {}, {}
+    for data, status in await asyncio.gather(*queries):
+        if status != 200 or not isinstance(data, list):
+            raise RuntimeError(f"bulk account lookup failed: {status} {data}")
+        for row in data:
+            row = balance_write_behind.overlay(account_cache.put(row, since))
+            if row.get("discord_id"):
+                by_discord[str(row["discord_id"])] = row
+            if row.get("mc_uuid"):
+                by_mc[row["mc_uuid"]] = row
+    return by_discord, by_mc
+
+# ---------------- LISTING PAGER (KEYSET) ----------------
+LISTING_PAGE_CACHE = 4
+
+# sort name -> (column, descending); id is always the tiebreaker
+LISTING_SORTS = {
+    "oldest": ("id", False),
+    "newest": ("id", True),
+    "price_asc": ("price", False),
+    "price_desc": ("price", True)
+}
+
+class ListingPager:
+    """Loads marketplace_listings one page at a time with keyset pagination on (sort column, id).
+
+    Only the current page plus a few neighbouring pages are kept, so memory per open
+    view does not depend on how many listings exist. The row count is the planner's estimate
+    and only labels the pages: Next keeps following the cursor until a short page shows the end.
+    """
+
+    def __init__(self, status: str, per_page: int = 10, filters: str = "", sort: str = "oldest"):
+        self.filters = f"?status=eq.{status}{filters}&select=id,item_type,amount,price"
+        self.sort_column, self.descending = LISTING_SORTS[sort]
         self.per_page = per_page
         self.page = 0
+        self.rows = []
+        self.total = 0
+        self.last_page = None  # index of the final page, once paging has reached it
+        self.exact = False     # page numbers and total counted, not estimated
+        self._pages = OrderedDict()  # page index -> rows
+        self._prefetch = None
 
     def max_page(self) -> int:
-        if not self.listings:
-            return 0
-        return (len(self.listings) - 1) // self.per_page
+        if self.last_page is not None:
+            return self.last_page
+        estimate = (self.total - 1) // self.per_page if self.total > 0 else 0
+        return max(estimate, self.page)
+
+    def has_next(self) -> bool:
+        if self.last_page is not None:
+            return self.page < self.last_page
+        return len(self.rows) == self.per_page
+
+    def page_label(self) -> str:
+        pages = self.max_page() + 1
+        return f"{self.page + 1}/{pages}" if self.exact else f"{self.page + 1}/~{pages}"
+
+    def total_label(self) -> str:
+        if self.exact:
+            return str(self.total)
+        return f"~{max(self.total, self.page * self.per_page + len(self.rows))}"
+
+    async def first(self) -> bool:
+        data, status, total = await supabase_get_page(
+            "marketplace_listings",
+            f"{self.filters}{self._order()}&limit={self.per_page}"
+        )
+        if status not in (200, 206) or not isinstance(data, list):
+            print("LISTING PAGER ERROR:", status, data)
+            return False
+
+        self._pages.clear()
+        self.last_page = None
+        self.exact = False
+        self.total = total if total is not None else len(data)
+        self._show(0, data)
+        return True
+
+    async def next(self):
+        if not self.rows or not self.has_next():
+            return
+
+        target = self.page + 1
+        if target not in self._pages and self._prefetch is not None:
+            await asyncio.shield(self._prefetch)
+
+        rows = self._pages.get(target)
+        if rows is None:
+            rows = await self._fetch_after(self.rows[-1])
+        if rows:
+            self._show(target, rows)
+        elif rows is not None:
+            # The previous page was full but nothing follows it.
+            self._found_end(self.page, self.rows)
+
+    async def previous(self):
+        if self.page == 0:
+            if not self.exact and self.last_page is not None:
+                await self.first()  # estimated numbering can reach 0 before the real first page
+            return
+
+        target = self.page - 1
+        rows = self._pages.get(target)
+        if rows is None and self.rows:
+            rows = await self._fetch_before(self.rows[0])
+        if rows and len(rows) == self.per_page:
+            self._show(target, rows)
+        else:
+            # A short page going backwards is the true start (page numbers came from the estimate).
+            await self.first()
+
+    async def last(self):
+        target = self.max_page()
+        if target == self.page and not self.has_next():
+            return
+        if target == self.page:
+            target += 1  # the estimate ran out before the listings did
+
+        rows = self._pages.get(target)
+        if rows is None:
+            remainder = self.total - target * self.per_page
+            if not 0 < remainder <= self.per_page:
+                remainder = self.per_page
+            data, status = await supabase_get(
+                "marketplace_listings",
+                f"{self.filters}{self._order(reverse=True)}&limit={remainder}"
+            )
+            rows = list(reversed(data)) if status == 200 and isinstance(data, list) else None
+        if rows:
+            # Numbered from the estimate; cached pages would not line up with that numbering.
+            if self.last_page is None:
+                self._pages.clear()
+            self._found_end(target, rows, exact=self.exact)
+            self._show(target, rows)
+
+    def _show(self, page: int, rows):
+        self.page = page
+        self.rows = rows
+        self._remember(page, rows)
+        if len(rows) < self.per_page:
+            self._found_end(page, rows)
+
+        if self.has_next() and (page + 1) not in self._pages:
+            self._prefetch = asyncio.create_task(self._prefetch_after(page + 1, rows[-1]))
+
+    def _found_end(self, page: int, rows, exact: bool = True):
+        if self.last_page is not None:
+            return
+        self.last_page = page
+        self.exact = exact
+        self.total = page * self.per_page + len(rows)
+
+    def _remember(self, page: int, rows):
+        self._pages[page] = rows
+        self._pages.move_to_end(page)
+        while len(self._pages) > LISTING_PAGE_CACHE:
+            self._pages.popitem(last=False)
+
+    async def _prefetch_after(self, page: int, last_row):
+        try:
+            rows = await self._fetch_after(last_row)
+        except Exception as e:
+            print("LISTING PREFETCH ERROR:", e)
+            return
+        if rows:
+            self._remember(page, rows)
+
+    async def _fetch_after(self, last_row):
+        data, status = await supabase_get(
+            "marketplace_listings",
+            f"{self.filters}{self._cursor(last_row, after=True)}{self._order()}&limit={self.per_page}"
+        )
+        return data if status == 200 and isinstance(data, list) else None
 
-    def page_slice(self):
-        start = self.page * self.per_page
-        end = start + self.per_page
-        return self.listings[start:end]
+    async def _fetch_before(self, first_row):
+        data, status = await supabase_get(
+            "marketplace_listings",
+            f"{self.filters}{self._cursor(first_row, after=False)}"
+            f"{self._order(reverse=True)}&limit={self.per_page}"
+        )
+        return list(reversed(data)) if status == 200 and isinstance(data, list) else None
+
+    def _order(self, reverse: bool = False) -> str:
+        direction = "desc" if self.descending != reverse else "asc"
+        if self.sort_column == "id":
+            return f"&order=id.{direction}"
+        return f"&order={self.sort_column}.{direction},id.{direction}"
+
+    def _cursor(self, row, after: bool) -> str:
+        op = "gt" if after != self.descending else "lt"
+        if self.sort_column == "id":
+            return f"&id={op}.{row['id']}"
+        column = self.sort_column
+        value = row[column]
+        return f"&or=({column}.{op}.{value},and({column}.eq.{value},id.{op}.{row['id']}))"
+
+# ---------------- ITEM TYPE INDEX (AUTOCOMPLETE) ----------------
+class ItemTypeIndex:
+    """Sorted list of known item_type values, for prefix autocomplete without a database round-trip."""
+
+    def __init__(self):
+        self._items = []
+
+    def add(self, item_type: str):
+        item_type = item_type.upper()
+        i = bisect.bisect_left(self._items, item_type)
+        if i == len(self._items) or self._items[i] != item_type:
+            self._items.insert(i, item_type)
+
+    def complete(self, prefix: str, limit: int = 25):
+        prefix = prefix.upper()
+        i = bisect.bisect_left(self._items, prefix)
+        matches = []
+        while i < len(self._items) and len(matches) < limit and self._items[i].startswith(prefix):
+            matches.append(self._items[i])
+            i += 1
+        return matches
+
+    async def refresh(self):
+        try:
+            data, status = await supabase_rpc("market_item_types", {})
+        except Exception as e:
+            print("ITEM TYPE INDEX ERROR:", e)
+            return
+        if status != 200 or not isinstance(data, list):
+            print("ITEM TYPE INDEX ERROR:", status, data)
+            return
+        self._items = sorted({row["item_type"].upper() for row in data if row.get("item_type")})
+
+item_type_index = ItemTypeIndex()
+
+# ---------------- MARKET PAGINATION VIEW ----------------
+class MarketView(discord.ui.View):
+    def __init__(self, pager: ListingPager):
+        super().__init__(timeout=None)
+        self.pager = pager
 
     def build_embed(self) -> discord.Embed:
         embed = discord.Embed(
@@ -114,11 +1516,11 @@ class MarketView(discord.ui.View):
             color=discord.Color.blurple()
         )
 
-        if not self.listings:
+        if not self.pager.rows:
             embed.description = "📭 Marketplace is empty."
             return embed
 
-        for row in self.page_slice():
+        for row in self.pager.rows:
             line = (
                 f"**#{row['id']}** — {row['amount']}x "
                 f"`{row['item_type']}` for **{row['price']} WeirdCoins**"
@@ -126,7 +1528,7 @@ class MarketView(discord.ui.View):
             embed.add_field(name="\u200b", value=line, inline=False)
 
         embed.set_footer(
-            text=f"Page {self.page + 1}/{self.max_page() + 1} • {len(self.listings)} total listings"
+            text=f"Page {self.pager.page_label()} • {self.pager.total_label()} total listings"
         )
         return embed
 
@@ -135,43 +1537,29 @@ class MarketView(discord.ui.View):
 
     @discord.ui.button(label="⏮ First", style=discord.ButtonStyle.secondary, custom_id="market_first")
     async def first_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.page = 0
+        await self.pager.first()
         await self._update(interaction)
 
     @discord.ui.button(label="◀ Previous", style=discord.ButtonStyle.primary, custom_id="market_prev")
     async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.page > 0:
-            self.page -= 1
+        await self.pager.previous()
         await self._update(interaction)
 
     @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.primary, custom_id="market_next")
     async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.page < self.max_page():
-            self.page += 1
+        await self.pager.next()
         await self._update(interaction)
 
     @discord.ui.button(label="Last ⏭", style=discord.ButtonStyle.secondary, custom_id="market_last")
     async def last_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.page = self.max_page()
+        await self.pager.last()
         await self._update(interaction)
 
 # ---------------- SOLD LISTINGS PAGINATION VIEW ----------------
 class SoldMarketView(discord.ui.View):
-    def __init__(self, listings, per_page: int = 10):
+    def __init__(self, pager: ListingPager):
         super().__init__(timeout=None)
-        self.listings = listings
-        self.per_page = per_page
-        self.page = 0
-
-    def max_page(self) -> int:
-        if not self.listings:
-            return 0
-        return (len(self.listings) - 1) // self.per_page
-
-    def page_slice(self):
-        start = self.page * self.per_page
-        end = start + self.per_page
-        return self.listings[start:end]
+        self.pager = pager
 
     def build_embed(self) -> discord.Embed:
         embed = discord.Embed(
@@ -179,11 +1567,11 @@ class SoldMarketView(discord.ui.View):
             color=discord.Color.dark_gray()
         )
 
-        if not self.listings:
+        if not self.pager.rows:
             embed.description = "📭 No sold listings yet."
             return embed
 
-        for row in self.page_slice():
+        for row in self.pager.rows:
             line = (
                 f"**#{row['id']}** — {row['amount']}x "
                 f"`{row['item_type']}` sold for **{row['price']} WeirdCoins**"
@@ -191,7 +1579,7 @@ class SoldMarketView(discord.ui.View):
             embed.add_field(name="\u200b", value=line, inline=False)
 
         embed.set_footer(
-            text=f"Page {self.page + 1}/{self.max_page() + 1} • {len(self.listings)} total sold listings"
+            text=f"Page {self.pager.page_label()} • {self.pager.total_label()} total sold listings"
         )
         return embed
 
@@ -200,492 +1588,1231 @@ class SoldMarketView(discord.ui.View):
 
     @discord.ui.button(label="⏮ First", style=discord.ButtonStyle.secondary, custom_id="sold_first")
     async def first_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.page = 0
+        await self.pager.first()
         await self._update(interaction)
 
     @discord.ui.button(label="◀ Previous", style=discord.ButtonStyle.primary, custom_id="sold_prev")
     async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.page > 0:
-            self.page -= 1
+        await self.pager.previous()
         await self._update(interaction)
 
     @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.primary, custom_id="sold_next")
     async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.page < self.max_page():
-            self.page += 1
+        await self.pager.next()
         await self._update(interaction)
 
     @discord.ui.button(label="Last ⏭", style=discord.ButtonStyle.secondary, custom_id="sold_last")
     async def last_page(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.page = self.max_page()
+        await self.pager.last()
         await self._update(interaction)
 
-# ---------------- BLACKJACK HELPERS ----------------
-CARD_VALUES = {
-    "2": 2, "3": 3, "4": 4, "5": 5, "6": 6,
-    "7": 7, "8": 8, "9": 9, "10": 10,
-    "J": 10, "Q": 10, "K": 10, "A": 11
-}
-CARD_NAMES = list(CARD_VALUES.keys())
-
-def draw_card():
-    return random.choice(CARD_NAMES)
+# ---------------- BATCHED CHANNEL WRITER ----------------
+CHANNEL_FLUSH_WINDOW = float(os.getenv("CHANNEL_FLUSH_WINDOW", "1.5"))
+CHANNEL_QUEUE_SIZE = int(os.getenv("CHANNEL_QUEUE_SIZE", "1000"))
+MAX_EMBEDS_PER_MESSAGE = 10        # Discord's limits
+MAX_EMBED_CHARS_PER_MESSAGE = 6000  # summed len(embed) over every embed in one message
+
+class ChannelWriter:
+    """Outbound embed queue for one channel.
+
+    Embeds queued within the flush window are sent together, up to 10 per message and 6000
+    characters in total, from a background task, so commands never wait on the Discord API for
+    log messages.
+    """
+
+    def __init__(self, channel_id: int, flush_window: float, maxsize: int):
+        self.channel_id = channel_id
+        self.flush_window = flush_window
+        self.maxsize = maxsize
+        self.labels = {"channel": str(channel_id)}
+        self._embeds = deque()
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def full(self) -> bool:
+        return len(self._embeds) >= self.maxsize
+
+    def send(self, embed: discord.Embed) -> bool:
+        if self.full():
+            metrics.inc("channel_embeds_dropped_total", self.labels)
+            return False
+        self._embeds.append(embed)
+        metrics.gauge_add("channel_queue_depth", self.labels, 1)
+        self._ready.set()
+        return True
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def get_channel(self):
+        return bot.get_channel(self.channel_id)
+
+    async def _run(self):
+        await bot.wait_until_ready()
+        while True:
+            await self._ready.wait()
+            await asyncio.sleep(self.flush_window)
+            self._ready.clear()
+            try:
+                await self._flush()
+            except Exception as e:
+                print("CHANNEL WRITER ERROR:", self.channel_id, e)
+
+    def _next_batch(self):
+        batch, chars = [], 0
+        while self._embeds and len(batch) < MAX_EMBEDS_PER_MESSAGE:
+            size = len(self._embeds[0])
+            if batch and chars + size > MAX_EMBED_CHARS_PER_MESSAGE:
+                break
+            batch.append(self._embeds.popleft())
+            chars += size
+        return batch
+
+    async def _flush(self):
+        channel = self.get_channel()
+        while self._embeds:
+            batch = self._next_batch()
+            metrics.gauge_add("channel_queue_depth", self.labels, -len(batch))
+
+            if channel is None:
+                metrics.inc("channel_embeds_dropped_total", self.labels, len(batch))
+                continue
+
+            try:
+                await channel.send(embeds=batch)
+                metrics.inc("channel_messages_sent_total", self.labels)
+                metrics.inc("channel_embeds_sent_total", self.labels, len(batch))
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    print("CHANNEL WRITER ERROR:", self.channel_id, e)
+                    metrics.inc("channel_embeds_dropped_total", self.labels, len(batch))
+                    continue
+                # Rate limited: put the batch back in front and wait as long as Discord asks.
+                self._embeds.extendleft(reversed(batch))
+                metrics.gauge_add("channel_queue_depth", self.labels, len(batch))
+                metrics.inc("channel_rate_limited_total", self.labels)
+                await asyncio.sleep(retry_after_seconds(e))
+
+def retry_after_seconds(e: discord.HTTPException, default: float = 5.0) -> float:
+    retry_after = getattr(e, "retry_after", None)
+    if retry_after is None and e.response is not None:
+        retry_after = e.response.headers.get("Retry-After")
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return default
 
-def hand_value(cards):
-    total = sum(CARD_VALUES[c] for c in cards)
-    aces = cards.count("A")
-    while total > 21 and aces > 0:
-        total -= 10
-        aces -= 1
-    return total
+channel_writers = {}
 
-def format_hand(cards):
-    return ", ".join(cards) + f" (total: {hand_value(cards)})"
+def get_channel_writer(channel_id: int) -> ChannelWriter:
+    writer = channel_writers.get(channel_id)
+    if writer is None:
+        writer = channel_writers[channel_id] = ChannelWriter(channel_id, CHANNEL_FLUSH_WINDOW, CHANNEL_QUEUE_SIZE)
+        writer.start()
+    return writer
 
 # ============================================================
 # /link CODE — link Discord ↔ Minecraft
 # ============================================================
 @tree.command(name="link", description="Link your Discord account to your Minecraft account")
+@instrumented
 async def link(interaction: discord.Interaction, code: str):
     await interaction.response.defer(thinking=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            data, status = await supabase_get(
-                session,
-                "link_codes",
-                f"?code=eq.{code}&used=eq.false"
-            )
+        data, status = await supabase_get(
+            "link_codes",
+            f"?code=eq.{code}&used=eq.false"
+        )
 
-            if status != 200 or not isinstance(data, list) or len(data) == 0:
-                print("LINK: no matching code or bad status", status, data)
-                return await interaction.followup.send("❌ Invalid or already used link code.")
+        if status != 200 or not isinstance(data, list) or len(data) == 0:
+            print("LINK: no matching code or bad status", status, data)
+            return await interaction.followup.send("❌ Invalid or already used link code.")
 
-            entry = data[0]
-            mc_uuid = entry["mc_uuid"]
+        entry = data[0]
+        mc_uuid = entry["mc_uuid"]
 
-            existing = await get_account_by_discord(session, interaction.user.id)
-
-            if existing:
-                await supabase_patch(
-                    session,
-                    "accounts",
-                    f"?discord_id=eq.{str(interaction.user.id)}",
-                    {"mc_uuid": mc_uuid}
-                )
-            else:
-                await supabase_post(
-                    session,
-                    "accounts",
-                    {
-                        "mc_uuid": mc_uuid,
-                        "discord_id": str(interaction.user.id)
-                    }
-                )
+        existing = await get_account_by_discord(interaction.user.id)
 
+        if existing:
             await supabase_patch(
-                session,
-                "link_codes",
-                f"?code=eq.{code}",
+                "accounts",
+                f"?discord_id=eq.{str(interaction.user.id)}",
+                {"mc_uuid": mc_uuid},
+                idempotency_key=f"link-account:{interaction.user.id}:{mc_uuid}"
+            )
+            account_cache.put({**existing, "mc_uuid": mc_uuid})
+        else:
+            created, c_status = await supabase_post(
+                "accounts",
                 {
-                    "used": True,
+                    "mc_uuid": mc_uuid,
                     "discord_id": str(interaction.user.id)
                 }
             )
+            if c_status == 201 and isinstance(created, list) and created:
+                account_cache.put(created[0])
+            else:
+                account_cache.invalidate(discord_id=interaction.user.id, mc_uuid=mc_uuid)
+
+        await supabase_patch(
+            "link_codes",
+            f"?code=eq.{code}",
+            {
+                "used": True,
+                "discord_id": str(interaction.user.id)
+            },
+            idempotency_key=f"link-code:{code}"
+        )
 
-            await interaction.followup.send(
-                f"✅ {interaction.user.mention}, your Discord account is now linked!\n"
-                f"You start with **100 WeirdCoins** (if this is your first time)."
-            )
+        await interaction.followup.send(
+            f"✅ {interaction.user.mention}, your Discord account is now linked!\n"
+            f"You start with **100 WeirdCoins** (if this is your first time)."
+        )
 
     except Exception as e:
         print("LINK ERROR:", e)
-        await interaction.followup.send("❌ Internal error during linking.")
+        await interaction.followup.send(internal_error_text(e, "❌ Internal error during linking."))
 
 # ============================================================
 # /balance — show WeirdCoins
 # ============================================================
 @tree.command(name="balance", description="Check your WeirdCoins balance")
+@instrumented
 async def balance(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            acc = await get_account_by_discord(session, interaction.user.id)
-            if not acc:
-                return await interaction.followup.send(
-                    "❌ You are not linked.\n"
-                    "Run `/link` in Minecraft to get a code, then `/link CODE` here."
-                )
-
-            bal = float(acc.get("balance", 0))
-            await interaction.followup.send(
-                f"💰 {interaction.user.mention}, you have **{bal:.2f} WeirdCoins**."
+        acc = await get_account_by_discord(interaction.user.id)
+        if not acc:
+            return await interaction.followup.send(
+                "❌ You are not linked.\n"
+                "Run `/link` in Minecraft to get a code, then `/link CODE` here."
             )
 
+        bal = float(acc.get("balance", 0))
+        await interaction.followup.send(
+            f"💰 {interaction.user.mention}, you have **{bal:.2f} WeirdCoins**."
+        )
+
     except Exception as e:
         print("BALANCE ERROR:", e)
-        await interaction.followup.send("❌ Internal error.")
+        await interaction.followup.send(internal_error_text(e))
 
 # ============================================================
 # /market — view active listings (PAGINATED)
 # ============================================================
 @tree.command(name="market", description="View the global marketplace")
-async def market(interaction: discord.Interaction):
+@app_commands.describe(
+    item="Only show this item type",
+    min_price="Minimum price per item",
+    max_price="Maximum price per item",
+    seller="Only show listings from this player",
+    sort="Sort order (default: oldest first)"
+)
+@app_commands.choices(sort=[
+    app_commands.Choice(name="Oldest first", value="oldest"),
+    app_commands.Choice(name="Newest first", value="newest"),
+    app_commands.Choice(name="Cheapest first", value="price_asc"),
+    app_commands.Choice(name="Most expensive first", value="price_desc")
+])
+@instrumented
+async def market(
+    interaction: discord.Interaction,
+    item: str = None,
+    min_price: float = None,
+    max_price: float = None,
+    seller: discord.User = None,
+    sort: str = "oldest"
+):
     await interaction.response.defer(thinking=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            data, status = await supabase_get(
-                session,
-                "marketplace_listings",
-                "?status=eq.active&select=id,item_type,amount,price"
-            )
-
-            if status != 200 or not isinstance(data, list):
-                print("MARKET ERROR DATA:", status, data)
-                return await interaction.followup.send("❌ Failed to load marketplace.")
-
-            if len(data) == 0:
-                return await interaction.followup.send("📭 Marketplace is empty.")
-
-            view = MarketView(data, per_page=10)
-            embed = view.build_embed()
-            await interaction.followup.send(embed=embed, view=view)
+        filters = ""
+        if item:
+            filters += f"&item_type=eq.{quote(item.upper(), safe='')}"
+        if min_price is not None:
+            filters += f"&price=gte.{min_price}"
+        if max_price is not None:
+            filters += f"&price=lte.{max_price}"
+        if seller is not None:
+            seller_acc = await get_account_by_discord(seller.id)
+            if not seller_acc or not seller_acc.get("mc_uuid"):
+                return await interaction.followup.send("❌ That player is not linked.")
+            filters += f"&seller_mc_uuid=eq.{seller_acc['mc_uuid']}"
+
+        pager = ListingPager("active", per_page=10, filters=filters, sort=sort)
+        if not await pager.first():
+            return await interaction.followup.send("❌ Failed to load marketplace.")
+
+        if not pager.rows:
+            if filters:
+                return await interaction.followup.send("📭 No listings match those filters.")
+            return await interaction.followup.send("📭 Marketplace is empty.")
+
+        view = MarketView(pager)
+        embed = view.build_embed()
+        await interaction.followup.send(embed=embed, view=view)
 
     except Exception as e:
         print("MARKET ERROR:", e)
-        await interaction.followup.send("❌ Internal error.")
+        await interaction.followup.send(internal_error_text(e))
+
+@market.autocomplete("item")
+async def market_item_autocomplete(interaction: discord.Interaction, current: str):
+    return [app_commands.Choice(name=item, value=item) for item in item_type_index.complete(current)]
 
 # ============================================================
 # /soldlistings — view sold listings (PAGINATED, GLOBAL)
 # ============================================================
 @tree.command(name="soldlistings", description="View all sold marketplace listings")
+@instrumented
 async def soldlistings(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            data, status = await supabase_get(
-                session,
-                "marketplace_listings",
-                "?status=eq.sold&select=id,item_type,amount,price"
-            )
+        pager = ListingPager("sold", per_page=10)
+        if not await pager.first():
+            return await interaction.followup.send("❌ Failed to load sold listings.")
 
-            if status != 200 or not isinstance(data, list):
-                print("SOLDLISTINGS ERROR DATA:", status, data)
-                return await interaction.followup.send("❌ Failed to load sold listings.")
-
-            if len(data) == 0:
-                return await interaction.followup.send("📭 No sold listings yet.")
+        if not pager.rows:
+            return await interaction.followup.send("📭 No sold listings yet.")
 
-            view = SoldMarketView(data, per_page=10)
-            embed = view.build_embed()
-            await interaction.followup.send(embed=embed, view=view)
+        view = SoldMarketView(pager)
+        embed = view.build_embed()
+        await interaction.followup.send(embed=embed, view=view)
 
     except Exception as e:
         print("SOLDLISTINGS ERROR:", e)
-        await interaction.followup.send("❌ Internal error while loading sold listings.")
+        await interaction.followup.send(internal_error_text(e, "❌ Internal error while loading sold listings."))
+
+# ============================================================
+# /price ITEM — OHLC from pre-aggregated price buckets (sql/price_history.sql)
+# ============================================================
+def summarize_buckets(rows):
+    """Fold consecutive OHLC buckets (oldest first) into one."""
+    if not rows:
+        return None
+    return {
+        "open": float(rows[0]["open"]),
+        "high": max(float(r["high"]) for r in rows),
+        "low": min(float(r["low"]) for r in rows),
+        "close": float(rows[-1]["close"]),
+        "volume": sum(int(r["volume"]) for r in rows),
+        "trades": sum(int(r["trades"]) for r in rows)
+    }
+
+def format_ohlc(summary) -> str:
+    if summary is None:
+        return "No trades"
+    change = summary["close"] - summary["open"]
+    pct = change / summary["open"] * 100 if summary["open"] else 0
+    return (
+        f"O **{summary['open']:.2f}** • H **{summary['high']:.2f}** • "
+        f"L **{summary['low']:.2f}** • C **{summary['close']:.2f}**\n"
+        f"{change:+.2f} ({pct:+.1f}%) • {summary['volume']} items in {summary['trades']} trades"
+    )
+
+async def get_price_buckets(item_type: str, bucket: str, since: float):
+    since_text = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(since))
+    data, status = await supabase_get(
+        "price_buckets",
+        f"?item_type=eq.{quote(item_type, safe='')}&bucket=eq.{bucket}"
+        f"&bucket_start=gte.{since_text}&order=bucket_start.asc"
+        "&select=bucket_start,open,high,low,close,volume,trades"
+    )
+    if status != 200 or not isinstance(data, list):
+        print("PRICE BUCKETS ERROR:", status, data)
+        return None
+    return data
+
+@tree.command(name="price", description="Show recent price history for an item")
+@instrumented
+async def price(interaction: discord.Interaction, item: str):
+    await interaction.response.defer(thinking=True)
+
+    try:
+        item_type = item.upper()
+        now = time.time()
+        hourly, daily = await asyncio.gather(
+            get_price_buckets(item_type, "1h", now - 86400),
+            get_price_buckets(item_type, "1d", now - 30 * 86400)
+        )
+        if hourly is None or daily is None:
+            return await interaction.followup.send("❌ Failed to load price history.")
+
+        if not daily:
+            return await interaction.followup.send(f"📭 No sales of **{item_type}** in the last 30 days.")
+
+        week_start = time.strftime("%Y-%m-%d", time.gmtime(now - 7 * 86400))
+        week = [row for row in daily if row["bucket_start"][:10] >= week_start]
+
+        embed = discord.Embed(title=f"💹 Price: {item_type}", color=discord.Color.teal())
+        embed.add_field(name="Last Price", value=f"**{float(daily[-1]['close']):.2f} WeirdCoins**", inline=False)
+        embed.add_field(name="24h", value=format_ohlc(summarize_buckets(hourly)), inline=False)
+        embed.add_field(name="7d", value=format_ohlc(summarize_buckets(week)), inline=False)
+        embed.add_field(name="30d", value=format_ohlc(summarize_buckets(daily)), inline=False)
+        await interaction.followup.send(embed=embed)
+
+    except Exception as e:
+        print("PRICE ERROR:", e)
+        await interaction.followup.send(internal_error_text(e))
+
+price.autocomplete("item")(market_item_autocomplete)
 
 # ============================================================
 # /buy ID — buy listing with WeirdCoins
 # ============================================================
 @tree.command(name="buy", description="Buy a marketplace listing")
+@instrumented
 async def buy(interaction: discord.Interaction, listing_id: int):
     await interaction.response.defer(thinking=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            data, status = await supabase_get(
-                session,
-                "marketplace_listings",
-                f"?id=eq.{listing_id}"
-            )
+        buyer_acc = await get_account_by_discord(interaction.user.id)
+        if not buyer_acc:
+            return await interaction.followup.send("❌ You must link your account first.")
 
-            if status != 200 or not isinstance(data, list) or len(data) == 0:
-                return await interaction.followup.send("❌ Listing not found.")
+        data, status = await supabase_get(
+            "marketplace_listings",
+            f"?id=eq.{listing_id}&select=seller_mc_uuid,status"
+        )
 
-            listing = data[0]
+        if status != 200 or not isinstance(data, list) or len(data) == 0:
+            return await interaction.followup.send("❌ Listing not found.")
 
-            if listing["status"] != "active":
-                return await interaction.followup.send("❌ This listing is no longer available.")
+        listing = data[0]
 
-            price = float(listing["price"])
-            amount = int(listing["amount"])
-            total_cost = price * amount
+        if listing["status"] != "active":
+            return await interaction.followup.send("❌ This listing is no longer available.")
 
-            buyer_acc = await get_account_by_discord(session, interaction.user.id)
-            if not buyer_acc:
-                return await interaction.followup.send("❌ You must link your account first.")
+        buyer_keys = account_lock_keys(buyer_acc["discord_id"], buyer_acc.get("mc_uuid"))
+        seller_keys = account_lock_keys(mc_uuid=listing.get("seller_mc_uuid"))
+        async with account_locks.hold(*buyer_keys, *seller_keys):
+            result = await atomic_purchase(listing_id, interaction.user.id)
 
-            if buyer_acc.get("mc_uuid") == listing.get("seller_mc_uuid"):
+        if not result.get("ok"):
+            error = result.get("error")
+            if error == "listing_not_found":
+                return await interaction.followup.send("❌ Listing not found.")
+            if error == "listing_unavailable":
+                return await interaction.followup.send("❌ This listing is no longer available.")
+            if error == "buyer_not_found":
+                return await interaction.followup.send("❌ You must link your account first.")
+            if error == "own_listing":
                 return await interaction.followup.send("❌ You cannot buy your own listing.")
-
-            buyer_balance = float(buyer_acc.get("balance", 0))
-            if buyer_balance < total_cost:
+            if error == "insufficient_funds":
+                total_cost = float(result["cost"])
+                buyer_balance = result_balance(result, interaction.user.id)
                 return await interaction.followup.send(
                     f"❌ You need **{total_cost:.2f}**, but you only have **{buyer_balance:.2f}**."
                 )
+            return await interaction.followup.send("❌ Purchase failed, please try again.")
 
-            seller_acc = await get_account_by_mc_uuid(session, listing["seller_mc_uuid"])
-
-            await update_account_balance(
-                session,
-                int(buyer_acc["discord_id"]),
-                buyer_balance - total_cost
-            )
-
-            if seller_acc:
-                seller_balance = float(seller_acc.get("balance", 0))
-                await update_account_balance(
-                    session,
-                    int(seller_acc["discord_id"]),
-                    seller_balance + total_cost
-                )
-
-            await supabase_patch(
-                session,
-                "marketplace_listings",
-                f"?id=eq.{listing_id}",
-                {"status": "sold", "buyer_mc_uuid": buyer_acc["mc_uuid"]}
-            )
+        amount = int(result["amount"])
+        total_cost = float(result["cost"])
 
-            await interaction.followup.send(
-                f"✅ {interaction.user.mention} bought **{amount}x {listing['item_type']}** "
-                f"for **{total_cost:.2f} WeirdCoins**.\n"
-                f"It will be delivered next time you join Minecraft or run `/deliver`."
-            )
+        await interaction.followup.send(
+            f"✅ {interaction.user.mention} bought **{amount}x {result['item_type']}** "
+            f"for **{total_cost:.2f} WeirdCoins**.\n"
+            f"It will be delivered next time you join Minecraft or run `/deliver`."
+        )
 
     except Exception as e:
         print("BUY ERROR:", e)
-        await interaction.followup.send("❌ Internal error.")
+        await interaction.followup.send(internal_error_text(e))
 
 # ============================================================
 # /sell — Discord-side listing
 # ============================================================
 @tree.command(name="sell", description="List an item on the marketplace (Discord-side)")
+@instrumented
 async def sell(interaction: discord.Interaction, item: str, amount: int, price: float):
     await interaction.response.defer(thinking=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            acc = await get_account_by_discord(session, interaction.user.id)
-            if not acc:
-                return await interaction.followup.send("❌ You must link your account first.")
+        acc = await get_account_by_discord(interaction.user.id)
+        if not acc:
+            return await interaction.followup.send("❌ You must link your account first.")
+
+        listing_data = {
+            "seller_mc_uuid": acc["mc_uuid"],
+            "item_type": item.upper(),
+            "amount": amount,
+            "price": price,
+            "status": "active"
+        }
+
+        created, status = await supabase_post("marketplace_listings", listing_data)
+
+        if status != 201:
+            print("SELL CREATE ERROR:", status, created)
+            return await interaction.followup.send("❌ Failed to create listing.")
+
+        listing_id = created[0]["id"]
+        item_type_index.add(item)
+
+        embed = discord.Embed(title="📦 New Marketplace Listing", color=discord.Color.green())
+        embed.add_field(name="Seller", value=interaction.user.mention, inline=False)
+        embed.add_field(name="Item", value=item.upper(), inline=True)
+        embed.add_field(name="Amount", value=str(amount), inline=True)
+        embed.add_field(name="Price", value=f"{price} WeirdCoins", inline=True)
+        embed.add_field(name="Listing ID", value=str(listing_id), inline=False)
+        get_channel_writer(MARKET_CHANNEL_ID).send(embed)
+
+        await interaction.followup.send(
+            f"📦 Listed **{amount}x {item.upper()}** for **{price} WeirdCoins** "
+            f"as listing **#{listing_id}**."
+        )
+
+    except Exception as e:
+        print("SELL ERROR:", e)
+        await interaction.followup.send(internal_error_text(e))
 
-            listing_data = {
-                "seller_mc_uuid": acc["mc_uuid"],
-                "item_type": item.upper(),
-                "amount": amount,
-                "price": price,
-                "status": "active"
+# ============================================================
+# ORDER BOOK — bids/asks with price-time matching (sql/order_book.sql)
+# ============================================================
+ORDER_LOAD_PAGE = 1000
+ORDER_LOAD_RETRY = float(os.getenv("ORDER_LOAD_RETRY", "10"))
+
+class Order:
+    __slots__ = ("id", "item_type", "side", "price", "remaining", "discord_id", "mc_uuid")
+
+    def __init__(self, row: dict):
+        self.id = int(row["id"])
+        self.item_type = row["item_type"]
+        self.side = row["side"]
+        self.price = float(row["price"])
+        self.remaining = int(row["remaining"])
+        self.discord_id = str(row["discord_id"])
+        self.mc_uuid = row["mc_uuid"]
+
+class OrderBook:
+    """Open orders for one item_type.
+
+    Each side is a heap keyed by (price, id) — ids are assigned in arrival order, so this is
+    price-time priority. Removed orders are dropped lazily when they reach the top of a heap;
+    `depth` keeps the total open amount per price level for display.
+    """
+
+    def __init__(self, item_type: str):
+        self.item_type = item_type
+        self.bids = []  # (-price, id, order)
+        self.asks = []  # (price, id, order)
+        self.depth = {"bid": {}, "ask": {}}
+        self.orders = {}
+        self.lock = asyncio.Lock()
+
+    def clear(self):
+        # Reloads empty the book in place, so every caller keeps queueing on the same lock.
+        self.bids = []
+        self.asks = []
+        self.depth = {"bid": {}, "ask": {}}
+        self.orders = {}
+
+    def add(self, order: Order):
+        if order.side == "bid":
+            heapq.heappush(self.bids, (-order.price, order.id, order))
+        else:
+            heapq.heappush(self.asks, (order.price, order.id, order))
+        self.orders[order.id] = order
+        self._adjust_depth(order, order.remaining)
+
+    def remove(self, order_id: int):
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            self._adjust_depth(order, -order.remaining)
+            order.remaining = 0
+        return order
+
+    def match(self, taker: Order):
+        """Match `taker` against resting orders, updating both in memory. Returns [(maker, amount, price)]."""
+        heap = self.asks if taker.side == "bid" else self.bids
+        fills = []
+        skipped = []
+        while taker.remaining > 0:
+            maker = self._best(heap)
+            if maker is None:
+                break
+            if taker.side == "bid" and maker.price > taker.price:
+                break
+            if taker.side == "ask" and maker.price < taker.price:
+                break
+            if maker.discord_id == taker.discord_id:
+                skipped.append(heapq.heappop(heap))
+                continue
+
+            amount = min(taker.remaining, maker.remaining)
+            fills.append((maker, amount, maker.price))
+            taker.remaining -= amount
+            maker.remaining -= amount
+            self._adjust_depth(maker, -amount)
+            if maker.remaining == 0:
+                heapq.heappop(heap)
+                del self.orders[maker.id]
+
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return fills
+
+    def levels(self, side: str, count: int = 5):
+        prices = sorted(self.depth[side], reverse=(side == "bid"))[:count]
+        return [(price, self.depth[side][price]) for price in prices]
+
+    def _best(self, heap):
+        while heap:
+            order = heap[0][2]
+            if order.remaining > 0 and self.orders.get(order.id) is order:
+                return order
+            heapq.heappop(heap)
+        return None
+
+    def _adjust_depth(self, order: Order, amount: int):
+        levels = self.depth[order.side]
+        total = levels.get(order.price, 0) + amount
+        if total > 0:
+            levels[order.price] = total
+        else:
+            levels.pop(order.price, None)
+
+class MarketEngine:
+    """All order books, rebuilt from market_orders at startup and kept in sync by every placement.
+
+    Placing and cancelling orders is refused until the books have loaded; a background task
+    retries the full load while they haven't, including after a failed per-item rebuild.
+    """
+
+    def __init__(self, retry_interval: float):
+        self.retry_interval = retry_interval
+        self.books = {}
+        self.order_items = {}  # open order id -> item_type
+        self.loaded = False
+        self._task = None
+
+    def book(self, item_type: str) -> OrderBook:
+        book = self.books.get(item_type)
+        if book is None:
+            book = self.books[item_type] = OrderBook(item_type)
+        return book
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.retry_interval)
+            if not self.loaded:
+                try:
+                    await self.load()
+                except Exception as e:
+                    print("ORDER BOOK LOAD ERROR:", e)
+
+    async def load(self, item_type: str = None):
+        """Rebuild every book, or only `item_type`'s (the caller must hold that book's lock)."""
+        if item_type is not None:
+            return await self._load(item_type)
+        # Wait out in-flight placements before reading, so none of them is lost by the rebuild.
+        async with contextlib.AsyncExitStack() as stack:
+            for name in sorted(self.books):
+                await stack.enter_async_context(self.books[name].lock)
+            return await self._load(None)
+
+    async def _load(self, item_type):
+        filters = "?status=eq.open&select=id,item_type,side,price,remaining,discord_id,mc_uuid"
+        if item_type is not None:
+            filters += f"&item_type=eq.{quote(item_type, safe='')}"
+
+        rows = []
+        last_id = 0
+        while True:
+            data, status = await supabase_get(
+                "market_orders",
+                f"{filters}&id=gt.{last_id}&order=id.asc&limit={ORDER_LOAD_PAGE}"
+            )
+            if status != 200 or not isinstance(data, list):
+                print("ORDER BOOK LOAD ERROR:", status, data)
+                self.loaded = False
+                return False
+            rows.extend(data)
+            if len(data) < ORDER_LOAD_PAGE:
+                break
+            last_id = data[-1]["id"]
+
+        if item_type is None:
+            for book in self.books.values():
+                book.clear()
+            self.order_items = {}
+        else:
+            self.book(item_type).clear()
+            self.order_items = {oid: item for oid, item in self.order_items.items() if item != item_type}
+
+        for row in rows:
+            order = Order(row)
+            self.book(order.item_type).add(order)
+            self.order_items[order.id] = order.item_type
+            item_type_index.add(order.item_type)
+        if item_type is None:
+            self.loaded = True
+        return True
+
+    def stats(self):
+        return {
+            "loaded": int(self.loaded),
+            "books": len(self.books),
+            "open_orders": len(self.order_items)
+        }
+
+    async def submit(self, discord_id: int, item_type: str, side: str, amount: int, price: float):
+        if not self.loaded:
+            return {"ok": False, "error": "order_book_loading"}
+        book = self.book(item_type)
+        async with book.lock:
+            await balance_write_behind.settle(discord_id)
+            placed = await economy_rpc("market_place_order", {
+                "p_discord_id": str(discord_id),
+                "p_item_type": item_type,
+                "p_side": side,
+                "p_price": price,
+                "p_amount": amount
+            })
+            if not placed.get("ok"):
+                return placed
+
+            order = Order(placed["order"])
+            if side == "bid":
+                ledger.record_result(placed, {discord_id: -price * amount}, "order_escrow", ref=f"order:{order.id}")
+            fills = book.match(order)
+            if fills:
+                payload = []
+                for maker, fill_amount, fill_price in fills:
+                    bid, ask = (order, maker) if order.side == "bid" else (maker, order)
+                    payload.append({"bid_id": bid.id, "ask_id": ask.id, "amount": fill_amount, "price": fill_price})
+                    if maker.remaining == 0:
+                        self.order_items.pop(maker.id, None)
+
+                settled = await economy_rpc("market_settle_fills", {"p_fills": payload})
+                if not settled.get("ok"):
+                    # Memory and database disagree (e.g. a concurrent cancel); rebuild this book.
+                    await self.load(item_type)
+                    return {"ok": True, "order_id": order.id, "filled": 0, "remaining": amount, "settle_failed": True}
+
+                for maker, fill_amount, fill_price in fills:
+                    bid, ask = (order, maker) if order.side == "bid" else (maker, order)
+                    ref = f"order:{bid.id}/{ask.id}"
+                    ledger.record_result(settled, {ask.discord_id: fill_amount * fill_price}, "order_fill", ref=ref)
+                    ledger.record_result(settled, {bid.discord_id: fill_amount * (bid.price - fill_price)}, "order_refund", ref=ref)
+
+            if order.remaining > 0:
+                book.add(order)
+                self.order_items[order.id] = item_type
+
+            metrics.inc("market_orders_total", {"side": side})
+            metrics.inc("market_fills_total", value=len(fills))
+            return {
+                "ok": True,
+                "order_id": order.id,
+                "filled": amount - order.remaining,
+                "remaining": order.remaining,
+                "fills": [(fill_amount, fill_price) for _, fill_amount, fill_price in fills]
             }
 
-            created, status = await supabase_post(session, "marketplace_listings", listing_data)
+    async def cancel(self, discord_id: int, order_id: int):
+        if not self.loaded:
+            return {"ok": False, "error": "order_book_loading"}
+        item_type = self.order_items.get(order_id)
+        if item_type is None:
+            return {"ok": False, "error": "order_not_found"}
+
+        book = self.book(item_type)
+        async with book.lock:
+            result = await economy_rpc("market_cancel_order", {
+                "p_order_id": order_id,
+                "p_discord_id": str(discord_id)
+            })
+            if result.get("ok") or result.get("error") == "order_closed":
+                book.remove(order_id)
+                self.order_items.pop(order_id, None)
+            if result.get("ok"):
+                ledger.record_result(result, {discord_id: float(result.get("refund") or 0)}, "order_cancel", ref=f"order:{order_id}")
+            return result
+
+market_engine = MarketEngine(ORDER_LOAD_RETRY)
+
+ORDER_BOOK_LOADING_TEXT = "❌ The order book is still loading. Please try again in a moment."
+
+def describe_order_result(result, side: str, item_type: str, price: float) -> str:
+    filled = result["filled"]
+    remaining = result["remaining"]
+    lines = [f"📈 Order **#{result['order_id']}**: {side} **{item_type}** @ **{price:.2f} WeirdCoins**"]
+    if filled:
+        spent = sum(amount * fill_price for amount, fill_price in result.get("fills", []))
+        lines.append(f"✅ Filled **{filled}** immediately (avg **{spent / filled:.2f}** each).")
+    if result.get("settle_failed"):
+        lines.append("⚠️ Matching failed and was rolled back; your order is resting in the book.")
+    if remaining:
+        lines.append(f"⏳ **{remaining}** resting in the order book.")
+    return "\n".join(lines)
+
+async def place_order_command(interaction: discord.Interaction, side: str, item: str, amount: int, price: float):
+    await interaction.response.defer(thinking=True)
+
+    if amount <= 0 or price <= 0:
+        return await interaction.followup.send("❌ Amount and price must be positive.")
 
-            if status != 201:
-                print("SELL CREATE ERROR:", status, created)
-                return await interaction.followup.send("❌ Failed to create listing.")
+    try:
+        acc = await get_account_by_discord(interaction.user.id)
+        if not acc or not acc.get("mc_uuid"):
+            return await interaction.followup.send("❌ You must link your account first.")
+
+        item_type = item.upper()
+        async with account_locks.hold_accounts(acc):
+            result = await market_engine.submit(interaction.user.id, item_type, side, amount, price)
+
+        if not result.get("ok"):
+            if result.get("error") == "order_book_loading":
+                return await interaction.followup.send(ORDER_BOOK_LOADING_TEXT)
+            if result.get("error") == "insufficient_funds":
+                balance = result_balance(result, interaction.user.id)
+                return await interaction.followup.send(
+                    f"❌ You need **{float(result['cost']):.2f}**, but you only have **{balance:.2f}**."
+                )
+            return await interaction.followup.send("❌ Failed to place order.")
 
-            listing_id = created[0]["id"]
+        item_type_index.add(item_type)
+        await interaction.followup.send(describe_order_result(result, side, item_type, price))
 
-            channel = bot.get_channel(MARKET_CHANNEL_ID)
-            if channel:
-                embed = discord.Embed(title="📦 New Marketplace Listing", color=discord.Color.green())
-                embed.add_field(name="Seller", value=interaction.user.mention, inline=False)
-                embed.add_field(name="Item", value=item.upper(), inline=True)
-                embed.add_field(name="Amount", value=str(amount), inline=True)
-                embed.add_field(name="Price", value=f"{price} WeirdCoins", inline=True)
-                embed.add_field(name="Listing ID", value=str(listing_id), inline=False)
-                await channel.send(embed=embed)
+    except Exception as e:
+        print(f"{side.upper()} ERROR:", e)
+        await interaction.followup.send(internal_error_text(e))
+
+@tree.command(name="bid", description="Place a buy order (coins are held until it fills or is cancelled)")
+@instrumented
+async def bid(interaction: discord.Interaction, item: str, amount: int, price: float):
+    await place_order_command(interaction, "bid", item, amount, price)
+
+@tree.command(name="ask", description="Place a sell order")
+@instrumented
+async def ask(interaction: discord.Interaction, item: str, amount: int, price: float):
+    await place_order_command(interaction, "ask", item, amount, price)
+
+@tree.command(name="orderbook", description="Show the best bids and asks for an item")
+@instrumented
+async def orderbook(interaction: discord.Interaction, item: str):
+    await interaction.response.defer(thinking=True)
 
-            await interaction.followup.send(
-                f"📦 Listed **{amount}x {item.upper()}** for **{price} WeirdCoins** "
-                f"as listing **#{listing_id}**."
-            )
+    try:
+        if not market_engine.loaded:
+            return await interaction.followup.send(ORDER_BOOK_LOADING_TEXT)
+        item_type = item.upper()
+        book = market_engine.books.get(item_type)
+        bids = book.levels("bid") if book else []
+        asks = book.levels("ask") if book else []
+
+        embed = discord.Embed(title=f"📊 Order Book: {item_type}", color=discord.Color.blurple())
+        embed.add_field(
+            name="Asks (sell)",
+            value="\n".join(f"**{price:.2f}** × {amount}" for price, amount in asks) or "No asks",
+            inline=True
+        )
+        embed.add_field(
+            name="Bids (buy)",
+            value="\n".join(f"**{price:.2f}** × {amount}" for price, amount in bids) or "No bids",
+            inline=True
+        )
+        await interaction.followup.send(embed=embed)
 
     except Exception as e:
-        print("SELL ERROR:", e)
-        await interaction.followup.send("❌ Internal error.")
+        print("ORDERBOOK ERROR:", e)
+        await interaction.followup.send(internal_error_text(e))
+
+@tree.command(name="cancelorder", description="Cancel one of your open orders")
+@instrumented
+async def cancelorder(interaction: discord.Interaction, order_id: int):
+    await interaction.response.defer(thinking=True)
+
+    try:
+        result = await market_engine.cancel(interaction.user.id, order_id)
+        if not result.get("ok"):
+            if result.get("error") == "order_book_loading":
+                return await interaction.followup.send(ORDER_BOOK_LOADING_TEXT)
+            if result.get("error") == "order_closed":
+                return await interaction.followup.send("❌ That order is already filled or cancelled.")
+            return await interaction.followup.send("❌ Order not found.")
+
+        refund = float(result.get("refund") or 0)
+        msg = f"🗑️ Order **#{order_id}** cancelled."
+        if refund:
+            msg += f" Refunded **{refund:.2f} WeirdCoins**."
+        await interaction.followup.send(msg)
+
+    except Exception as e:
+        print("CANCELORDER ERROR:", e)
+        await interaction.followup.send(internal_error_text(e))
+
+for order_command in (bid, ask, orderbook):
+    order_command.autocomplete("item")(market_item_autocomplete)
 
 # ============================================================
 # ADMIN COMMANDS
 # ============================================================
 @tree.command(name="givemoney", description="Admin: Give WeirdCoins to a user or UUID")
+@instrumented
 async def givemoney(interaction: discord.Interaction, target: str, amount: float):
     await interaction.response.defer(thinking=True)
 
     if not interaction.user.guild_permissions.administrator:
         return await interaction.followup.send("❌ Admins only.")
 
+    if amount <= 0:
+        return await interaction.followup.send("❌ Amount must be positive.")
+
     try:
         mode, value = parse_target(target)
         if mode is None:
             return await interaction.followup.send("❌ Invalid target. Use @user, Discord ID, or UUID.")
 
-        async with aiohttp.ClientSession() as session:
-            if mode == "discord":
-                acc = await get_account_by_discord(session, value)
-            else:
-                acc = await get_account_by_mc_uuid(session, value)
+        if mode == "discord":
+            acc = await get_account_by_discord(value)
+        else:
+            acc = await get_account_by_mc_uuid(value)
 
-            if not acc:
-                return await interaction.followup.send("❌ Account not found.")
+        if not acc:
+            return await interaction.followup.send("❌ Account not found.")
 
-            new_balance = float(acc["balance"]) + amount
-            await update_account_balance(session, int(acc["discord_id"]), new_balance)
+        async with account_locks.hold_accounts(acc):
+            result = await atomic_credit(int(acc["discord_id"]), amount, reason="admin_give")
+        if not result.get("ok"):
+            return await interaction.followup.send("❌ Failed to update balance.")
 
-            await interaction.followup.send(
-                f"✅ Added **{amount} WeirdCoins**. New balance: **{new_balance:.2f}**."
-            )
+        new_balance = result_balance(result, acc["discord_id"])
+        await interaction.followup.send(
+            f"✅ Added **{amount} WeirdCoins**. New balance: **{new_balance:.2f}**."
+        )
 
     except Exception as e:
         print("GIVEMONEY ERROR:", e)
-        await interaction.followup.send("❌ Internal error.")
+        await interaction.followup.send(internal_error_text(e))
 
 @tree.command(name="removemoney", description="Admin: Remove WeirdCoins from a user or UUID")
+@instrumented
 async def removemoney(interaction: discord.Interaction, target: str, amount: float):
     await interaction.response.defer(thinking=True)
 
     if not interaction.user.guild_permissions.administrator:
         return await interaction.followup.send("❌ Admins only.")
 
+    if amount <= 0:
+        return await interaction.followup.send("❌ Amount must be positive.")
+
     try:
         mode, value = parse_target(target)
         if mode is None:
             return await interaction.followup.send("❌ Invalid target. Use @user, Discord ID, or UUID.")
 
-        async with aiohttp.ClientSession() as session:
-            if mode == "discord":
-                acc = await get_account_by_discord(session, value)
+        if mode == "discord":
+            acc = await get_account_by_discord(value)
+        else:
+            acc = await get_account_by_mc_uuid(value)
+
+        if not acc:
+            return await interaction.followup.send("❌ Account not found.")
+
+        async with account_locks.hold_accounts(acc):
+            result = await atomic_debit(int(acc["discord_id"]), amount, clamp=True, reason="admin_remove")
+        if not result.get("ok"):
+            return await interaction.followup.send("❌ Failed to update balance.")
+
+        new_balance = result_balance(result, acc["discord_id"])
+        await interaction.followup.send(
+            f"✅ Removed **{amount} WeirdCoins**. New balance: **{new_balance:.2f}**."
+        )
+
+    except Exception as e:
+        print("REMOVEMONEY ERROR:", e)
+        await interaction.followup.send(internal_error_text(e))
+
+# ---------------- BULK GIVE/REMOVE ----------------
+def resolve_bulk_targets(targets: str, role: discord.Role = None, faction: str = None):
+    """Expand the bulk command inputs into (label, kind, value) entries plus unparseable tokens."""
+    entries, invalid = [], []
+    for token in re.split(r"[\s,]+", targets or ""):
+        if not token:
+            continue
+        kind, value = parse_target(token)
+        if kind is None:
+            invalid.append(token)
+        else:
+            entries.append((token, kind, value))
+
+    if role is not None:
+        entries.extend((f"@{m.display_name}", "discord", m.id) for m in role.members if not m.bot)
+
+    if faction:
+        found = faction_index.by_name(faction.strip())
+        if found is None:
+            invalid.append(f"faction:{faction}")
+        else:
+            entries.extend((mc_uuid, "mc", mc_uuid) for mc_uuid in faction_index.members(found["id"]))
+    return entries, invalid
+
+async def bulk_adjust_command(interaction: discord.Interaction, amount: float, targets: str,
+                              role: discord.Role, faction: str, sign: int):
+    await interaction.response.defer(thinking=True)
+
+    if not interaction.user.guild_permissions.administrator:
+        return await interaction.followup.send("❌ Admins only.")
+
+    if amount <= 0:
+        return await interaction.followup.send("❌ Amount must be positive.")
+
+    try:
+        if faction and not faction_index.loaded:
+            await faction_index.load()
+
+        entries, invalid = resolve_bulk_targets(targets, role, faction)
+        if not entries:
+            return await interaction.followup.send("❌ No valid targets. Use mentions, Discord IDs, UUIDs, a role or a faction.")
+
+        by_discord, by_mc = await get_accounts_bulk(
+            [value for _, kind, value in entries if kind == "discord"],
+            [value for _, kind, value in entries if kind == "mc"]
+        )
+
+        # One delta per account, however many times it was named.
+        deltas = {}
+        resolved = []
+        for label, kind, value in entries:
+            acc = by_discord.get(str(value)) if kind == "discord" else by_mc.get(value)
+            discord_id = str(acc["discord_id"]) if acc and acc.get("discord_id") else None
+            resolved.append((label, discord_id))
+            if discord_id:
+                deltas[discord_id] = sign * amount
+
+        applied, balances = {}, {}
+        if deltas:
+            batch_id = str(uuid.uuid4())
+            reason = "admin_give" if sign > 0 else "admin_remove"
+            result = await economy_rpc(
+                "economy_apply_deltas",
+                {"p_batch_id": batch_id, "p_deltas": deltas},
+                idempotency_key=batch_id
+            )
+            if not result.get("ok"):
+                return await interaction.followup.send("❌ Failed to update balances.")
+            applied = result.get("applied") or {}
+            balances = result.get("balances") or {}
+            if not result.get("duplicate"):
+                ledger.record_result(result, applied, reason, ref=f"batch:{batch_id}")
+
+        lines = []
+        skipped = len(invalid)
+        reported = set()
+        for label, discord_id in resolved:
+            if discord_id is not None and discord_id in reported:
+                continue
+            if discord_id is None:
+                lines.append(f"{label}\tno linked account")
+                skipped += 1
+            elif discord_id in balances:
+                reported.add(discord_id)
+                lines.append(f"{label}\t{float(applied.get(discord_id, 0)):+.2f}\t{float(balances[discord_id]):.2f}")
             else:
-                acc = await get_account_by_mc_uuid(session, value)
+                lines.append(f"{label}\tfailed")
+                skipped += 1
+        lines.extend(f"{token}\tinvalid target" for token in invalid)
+
+        verb = "Added" if sign > 0 else "Removed"
+        total = sum(abs(float(v)) for v in applied.values())
+        summary = (
+            f"✅ {verb} **{amount} WeirdCoins** for **{len(reported)}** accounts "
+            f"({total:.2f} total)."
+        )
+        if skipped:
+            summary += f"\n⚠️ {skipped} targets were skipped; see the attached report."
+
+        report = discord.File(
+            io.BytesIO(("target\tchange\tbalance\n" + "\n".join(lines)).encode("utf-8")),
+            filename="bulk_results.tsv"
+        )
+        await interaction.followup.send(summary, file=report)
 
-            if not acc:
-                return await interaction.followup.send("❌ Account not found.")
+    except Exception as e:
+        print("BULK BALANCE ERROR:", e)
+        await interaction.followup.send(internal_error_text(e))
+
+@tree.command(name="givemoney_bulk", description="Admin: Give WeirdCoins to many users, a role or a faction")
+@app_commands.describe(
+    targets="Mentions, Discord IDs or UUIDs separated by spaces or commas",
+    role="Everyone with this role",
+    faction="Every member of this faction"
+)
+@instrumented
+async def givemoney_bulk(interaction: discord.Interaction, amount: float, targets: str = None,
+                         role: discord.Role = None, faction: str = None):
+    await bulk_adjust_command(interaction, amount, targets, role, faction, 1)
+
+@tree.command(name="removemoney_bulk", description="Admin: Remove WeirdCoins from many users, a role or a faction")
+@app_commands.describe(
+    targets="Mentions, Discord IDs or UUIDs separated by spaces or commas",
+    role="Everyone with this role",
+    faction="Every member of this faction"
+)
+@instrumented
+async def removemoney_bulk(interaction: discord.Interaction, amount: float, targets: str = None,
+                           role: discord.Role = None, faction: str = None):
+    await bulk_adjust_command(interaction, amount, targets, role, faction, -1)
+
+@tree.command(name="botstats", description="Admin: Show connection pool and cache counters")
+@instrumented
+async def botstats(interaction: discord.Interaction):
+    await interaction.response.defer(thinking=True)
 
-            new_balance = max(0, float(acc["balance"]) - amount)
-            await update_account_balance(session, int(acc["discord_id"]), new_balance)
+    if not interaction.user.guild_permissions.administrator:
+        return await interaction.followup.send("❌ Admins only.")
 
-            await interaction.followup.send(
-                f"✅ Removed **{amount} WeirdCoins**. New balance: **{new_balance:.2f}**."
+    try:
+        sections = {
+            "Supabase Pool": supabase.pool_stats(),
+            "Supabase Health": supabase.health_stats(),
+            "Account Cache": account_cache.stats(),
+            "Account Locks": account_locks.stats(),
+            "Faction Embed": faction_embed_refresher.stats(),
+            "Faction Index": faction_index.stats(),
+            "Ledger": ledger.stats(),
+            "Write-Behind": balance_write_behind.stats(),
+            "Blackjack Tables": blackjack_tables.stats(),
+            "Economy Jobs": economy_scheduler.stats()
+        }
+
+        embed = discord.Embed(title="📊 Bot Stats", color=discord.Color.teal())
+        for section, stats in sections.items():
+            embed.add_field(
+                name=section,
+                value="\n".join(f"**{key}:** {value}" for key, value in stats.items()),
+                inline=False
             )
 
+        await interaction.followup.send(embed=embed)
+
     except Exception as e:
-        print("REMOVEMONEY ERROR:", e)
-        await interaction.followup.send("❌ Internal error.")
+        print("BOTSTATS ERROR:", e)
+        await interaction.followup.send(internal_error_text(e))
 
 # ============================================================
 # /leaderboard — top balances
 # ============================================================
 @tree.command(name="leaderboard", description="Show the top WeirdCoins holders")
+@instrumented
 async def leaderboard(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            data, status = await supabase_get(
-                session,
-                "accounts",
-                "?select=discord_id,balance&order=balance.desc&limit=10"
-            )
+        if top_balances.needs_reconcile(10) and not await top_balances.reconcile():
+            return await interaction.followup.send("❌ Failed to load leaderboard.")
 
-            if status != 200 or not isinstance(data, list):
-                print("LEADERBOARD ERROR DATA:", status, data)
-                return await interaction.followup.send("❌ Failed to load leaderboard.")
+        rows = top_balances.top(10)
+        if len(rows) == 0:
+            return await interaction.followup.send("📭 No accounts yet.")
 
-            if len(data) == 0:
-                return await interaction.followup.send("📭 No accounts yet.")
+        users = await user_cache.resolve_many(int(did) for did, _ in rows)
 
-            lines = []
-            rank = 1
-            for row in data:
-                did = row["discord_id"]
-                bal = float(row.get("balance", 0))
-                user = bot.get_user(int(did)) or await bot.fetch_user(int(did))
-                name = user.mention if user else f"`{did}`"
-                lines.append(f"**#{rank}** — {name}: **{bal:.2f} WeirdCoins**")
-                rank += 1
-
-            msg = "**🏆 WeirdCoins Leaderboard**\n" + "\n".join(lines)
-            await interaction.followup.send(msg)
+        lines = []
+        rank = 1
+        for did, bal in rows:
+            user = users[int(did)]
+            name = user.mention if user else f"`{did}`"
+            lines.append(f"**#{rank}** — {name}: **{bal:.2f} WeirdCoins**")
+            rank += 1
+
+        msg = "**🏆 WeirdCoins Leaderboard**\n" + "\n".join(lines)
+        await interaction.followup.send(msg)
 
     except Exception as e:
         print("LEADERBOARD ERROR:", e)
-        await interaction.followup.send("❌ Internal error.")
+        await interaction.followup.send(internal_error_text(e))
 
 # ============================================================
 # /profile — show your account info
 # ============================================================
 @tree.command(name="profile", description="Show your WeirdCoins profile")
+@instrumented
 async def profile(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            acc = await get_account_by_discord(session, interaction.user.id)
-            if not acc:
-                return await interaction.followup.send(
-                    "❌ You are not linked.\n"
-                    "Run `/link` in Minecraft to get a code, then `/link CODE` here."
-                )
+        acc = await get_account_by_discord(interaction.user.id)
+        if not acc:
+            return await interaction.followup.send(
+                "❌ You are not linked.\n"
+                "Run `/link` in Minecraft to get a code, then `/link CODE` here."
+            )
 
-            bal = float(acc.get("balance", 0))
-            mc_uuid = acc.get("mc_uuid", "Not linked to Minecraft")
+        bal = float(acc.get("balance", 0))
+        mc_uuid = acc.get("mc_uuid", "Not linked to Minecraft")
 
-            embed = discord.Embed(
-                title=f"{interaction.user.name}'s Profile",
-                color=discord.Color.gold()
-            )
-            embed.add_field(name="WeirdCoins", value=f"**{bal:.2f}**", inline=False)
-            embed.add_field(name="Minecraft UUID", value=f"`{mc_uuid}`", inline=False)
+        embed = discord.Embed(
+            title=f"{interaction.user.name}'s Profile",
+            color=discord.Color.gold()
+        )
+        embed.add_field(name="WeirdCoins", value=f"**{bal:.2f}**", inline=False)
+        embed.add_field(name="Minecraft UUID", value=f"`{mc_uuid}`", inline=False)
 
-            await interaction.followup.send(embed=embed)
+        await interaction.followup.send(embed=embed)
 
     except Exception as e:
         print("PROFILE ERROR:", e)
-        await interaction.followup.send("❌ Internal error.")
+        await interaction.followup.send(internal_error_text(e))
 
 # ============================================================
 # /richest — show the single richest player
 # ============================================================
 @tree.command(name="richest", description="Show the richest WeirdCoins holder")
+@instrumented
 async def richest(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            data, status = await supabase_get(
-                session,
-                "accounts",
-                "?select=discord_id,balance&order=balance.desc&limit=1"
-            )
+        if top_balances.needs_reconcile(1) and not await top_balances.reconcile():
+            return await interaction.followup.send("❌ Failed to load richest player.")
 
-            if status != 200 or not isinstance(data, list):
-                print("RICHEST ERROR DATA:", status, data)
-                return await interaction.followup.send("❌ Failed to load richest player.")
+        rows = top_balances.top(1)
+        if len(rows) == 0:
+            return await interaction.followup.send("📭 No accounts yet.")
 
-            if len(data) == 0:
-                return await interaction.followup.send("📭 No accounts yet.")
+        did, bal = rows[0]
+        users = await user_cache.resolve_many([int(did)])
+        user = users[int(did)]
+        name = user.mention if user else f"`{did}`"
 
-            row = data[0]
-            did = row["discord_id"]
-            bal = float(row.get("balance", 0))
-            user = bot.get_user(int(did)) or await bot.fetch_user(int(did))
-            name = user.mention if user else f"`{did}`"
-
-            await interaction.followup.send(
-                f"👑 Richest player: {name} with **{bal:.2f} WeirdCoins**."
-            )
+        await interaction.followup.send(
+            f"👑 Richest player: {name} with **{bal:.2f} WeirdCoins**."
+        )
 
     except Exception as e:
         print("RICHEST ERROR:", e)
-        await interaction.followup.send("❌ Internal error.")
+        await interaction.followup.send(internal_error_text(e))
 
 # ============================================================
 # /transfer — send WeirdCoins to another player
 # ============================================================
 @tree.command(name="transfer", description="Send WeirdCoins to another player")
+@instrumented
 async def transfer(interaction: discord.Interaction, target: discord.User, amount: float):
     await interaction.response.defer(thinking=True)
 
@@ -696,58 +2823,171 @@ async def transfer(interaction: discord.Interaction, target: discord.User, amoun
         return await interaction.followup.send("❌ Amount must be positive.")
 
     try:
-        async with aiohttp.ClientSession() as session:
-            sender_acc = await get_account_by_discord(session, interaction.user.id)
-            if not sender_acc:
-                return await interaction.followup.send("❌ You are not linked.")
-
-            receiver_acc = await get_account_by_discord(session, target.id)
-            if not receiver_acc:
-                return await interaction.followup.send("❌ Target user is not linked.")
-
-            sender_balance = float(sender_acc.get("balance", 0))
-            if sender_balance < amount:
+        sender_acc = await get_account_by_discord(interaction.user.id)
+        if not sender_acc:
+            return await interaction.followup.send("❌ You are not linked.")
+
+        receiver_acc = await get_account_by_discord(target.id)
+        if not receiver_acc:
+            return await interaction.followup.send("❌ Target user is not linked.")
+
+        async with account_locks.hold_accounts(sender_acc, receiver_acc):
+            result = await atomic_transfer(interaction.user.id, target.id, amount)
+        if not result.get("ok"):
+            if result.get("error") == "insufficient_funds":
+                sender_balance = result_balance(result, interaction.user.id)
                 return await interaction.followup.send(
                     f"❌ You don't have enough WeirdCoins. You have **{sender_balance:.2f}**."
                 )
+            return await interaction.followup.send("❌ Transfer failed, please try again.")
 
-            receiver_balance = float(receiver_acc.get("balance", 0))
+        sender_balance = result_balance(result, interaction.user.id)
+        await interaction.followup.send(
+            f"✅ {interaction.user.mention} sent **{amount:.2f} WeirdCoins** to {target.mention}.\n"
+            f"Your new balance: **{sender_balance:.2f} WeirdCoins**."
+        )
 
-            await update_account_balance(
-                session,
-                int(sender_acc["discord_id"]),
-                sender_balance - amount
-            )
-            await update_account_balance(
-                session,
-                int(receiver_acc["discord_id"]),
-                receiver_balance + amount
-            )
+    except Exception as e:
+        print("TRANSFER ERROR:", e)
+        await interaction.followup.send(internal_error_text(e))
 
-            await interaction.followup.send(
-                f"✅ {interaction.user.mention} sent **{amount:.2f} WeirdCoins** to {target.mention}.\n"
-                f"Your new balance: **{sender_balance - amount:.2f} WeirdCoins**."
-            )
+# ============================================================
+# /history — your recent ledger entries (KEYSET PAGINATED)
+# ============================================================
+HISTORY_PAGE_SIZE = 10
+
+LEDGER_REASONS = {
+    "credit": "Credit",
+    "debit": "Debit",
+    "admin_give": "Admin grant",
+    "admin_remove": "Admin removal",
+    "transfer_in": "Transfer received",
+    "transfer_out": "Transfer sent",
+    "purchase": "Marketplace",
+    "blackjack": "Blackjack",
+    "blackjack_bet": "Blackjack bet",
+    "order_escrow": "Bid placed",
+    "order_fill": "Order filled",
+    "order_refund": "Bid price improvement",
+    "order_cancel": "Bid cancelled",
+    "interest": "Daily interest",
+    "wealth_tax": "Wealth tax"
+}
+
+class HistoryView(discord.ui.View):
+    """Pages through one account's ledger newest-first, keyed on ledger.id."""
+
+    def __init__(self, discord_id: int):
+        super().__init__(timeout=300)
+        self.discord_id = discord_id
+        self.rows = []
+
+    async def load(self, before_id=None, after_id=None):
+        params = (
+            f"?discord_id=eq.{self.discord_id}"
+            f"&select=id,delta,balance_after,reason,ref,created_at&limit={HISTORY_PAGE_SIZE}"
+        )
+        if after_id is not None:
+            params += f"&id=gt.{after_id}&order=id.asc"
+        else:
+            params += "&order=id.desc"
+            if before_id is not None:
+                params += f"&id=lt.{before_id}"
+
+        data, status = await supabase_get("ledger", params)
+        if status != 200 or not isinstance(data, list):
+            print("HISTORY ERROR:", status, data)
+            return False
+        if after_id is not None:
+            data.reverse()
+        if data or (before_id is None and after_id is None):
+            self.rows = data
+        return True
+
+    def build_embed(self) -> discord.Embed:
+        embed = discord.Embed(title="📜 Transaction History", color=discord.Color.dark_teal())
+        if not self.rows:
+            embed.description = "📭 No transactions yet."
+            return embed
+
+        lines = []
+        for row in self.rows:
+            delta = float(row["delta"])
+            line = f"`{row['created_at'][:16].replace('T', ' ')}` **{delta:+.2f}** — {LEDGER_REASONS.get(row['reason'], row['reason'])}"
+            if row.get("balance_after") is not None:
+                line += f" → {float(row['balance_after']):.2f}"
+            lines.append(line)
+        embed.description = "\n".join(lines)
+        return embed
+
+    async def _update(self, interaction: discord.Interaction):
+        await interaction.response.edit_message(embed=self.build_embed(), view=self)
+
+    @discord.ui.button(label="◀ Newer", style=discord.ButtonStyle.primary)
+    async def newer_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if self.rows:
+            await self.load(after_id=self.rows[0]["id"])
+        await self._update(interaction)
+
+    @discord.ui.button(label="Older ▶", style=discord.ButtonStyle.primary)
+    async def older_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if self.rows:
+            await self.load(before_id=self.rows[-1]["id"])
+        await self._update(interaction)
+
+@tree.command(name="history", description="View your recent WeirdCoins transactions")
+@instrumented
+async def history(interaction: discord.Interaction):
+    await interaction.response.defer(thinking=True)
+
+    try:
+        # Make sure the caller's latest changes are in the table before reading it.
+        await ledger.flush()
+
+        view = HistoryView(interaction.user.id)
+        if not await view.load():
+            return await interaction.followup.send("❌ Failed to load your history.")
+
+        await interaction.followup.send(embed=view.build_embed(), view=view)
 
     except Exception as e:
-        print("TRANSFER ERROR:", e)
-        await interaction.followup.send("❌ Internal error.")
+        print("HISTORY ERROR:", e)
+        await interaction.followup.send(internal_error_text(e))
 
 # ============================================================
 # /blackjack AMOUNT — gamble WeirdCoins
 # ============================================================
+def blackjack_result_text(player_total: int, dealer_total: int) -> str:
+    if player_total > 21:
+        return "💥 You busted and lost your bet."
+    if dealer_total > 21:
+        return "🎉 Dealer busted, you win!"
+    if player_total > dealer_total:
+        return "🎉 You win!"
+    if player_total < dealer_total:
+        return "😢 You lose."
+    return "🤝 It's a tie. Your bet is returned."
+
 @tree.command(name="blackjack", description="Play blackjack with a WeirdCoins bet")
-async def blackjack(interaction: discord.Interaction, amount: float):
+@app_commands.describe(interactive="Choose hit, stand or double yourself instead of auto-playing to 17")
+@instrumented
+async def blackjack(interaction: discord.Interaction, amount: float, interactive: bool = False):
     await interaction.response.defer(thinking=True)
 
     if amount <= 0:
         return await interaction.followup.send("❌ Bet amount must be positive.")
 
     try:
-        async with aiohttp.ClientSession() as session:
-            acc = await get_account_by_discord(session, interaction.user.id)
-            if not acc:
-                return await interaction.followup.send("❌ You are not linked.")
+        acc = await get_account_by_discord(interaction.user.id)
+        if not acc:
+            return await interaction.followup.send("❌ You are not linked.")
+
+        if interactive:
+            return await open_blackjack_table(interaction, acc, amount)
+
+        async with account_locks.hold_accounts(acc):
+            # Re-read under the lock so a game that just settled is reflected in the balance check.
+            acc = await get_account_by_discord(interaction.user.id) or acc
 
             balance = float(acc.get("balance", 0))
             if balance < amount:
@@ -755,79 +2995,460 @@ async def blackjack(interaction: discord.Interaction, amount: float):
                     f"❌ You don't have enough WeirdCoins. You have **{balance:.2f}**."
                 )
 
-            player_cards = [draw_card(), draw_card()]
-            dealer_cards = [draw_card(), draw_card()]
-
-            while hand_value(player_cards) < 17:
-                player_cards.append(draw_card())
-
-            while hand_value(dealer_cards) < 17:
-                dealer_cards.append(draw_card())
+            player_cards = play_hand()
+            dealer_cards = play_hand()
 
             player_total = hand_value(player_cards)
             dealer_total = hand_value(dealer_cards)
 
-            result = ""
-            delta = 0.0
-
-            if player_total > 21:
-                result = "💥 You busted and lost your bet."
-                delta = -amount
-            elif dealer_total > 21:
-                result = "🎉 Dealer busted, you win!"
-                delta = amount
-            elif player_total > dealer_total:
-                result = "🎉 You win!"
-                delta = amount
-            elif player_total < dealer_total:
-                result = "😢 You lose."
-                delta = -amount
+            # The payout comes from blackjack.outcome so blackjack_sim.py measures the same rules.
+            delta = outcome(player_total, dealer_total) * amount
+
+            result = blackjack_result_text(player_total, dealer_total)
+
+            if BALANCE_WRITE_BEHIND:
+                # Applied in the next bulk flush; the lock and the balance check above already
+                # see earlier unflushed hands through get_account_by_discord.
+                balance_write_behind.add(acc["discord_id"], delta)
+                settled = None
+                balance += delta
+            elif delta > 0:
+                settled = await atomic_credit(int(acc["discord_id"]), delta, reason="blackjack")
+            elif delta < 0:
+                settled = await atomic_debit(int(acc["discord_id"]), -delta, reason="blackjack")
             else:
-                result = "🤝 It's a tie. Your bet is returned."
-                delta = 0.0
-
-            new_balance = balance + delta
-            await update_account_balance(session, int(acc["discord_id"]), new_balance)
-
-            msg = (
-                f"🃏 **Blackjack Result**\n"
-                f"**Your hand:** {format_hand(player_cards)}\n"
-                f"**Dealer's hand:** {format_hand(dealer_cards)}\n\n"
-                f"{result}\n"
-                f"💰 New balance: **{new_balance:.2f} WeirdCoins**."
-            )
-            await interaction.followup.send(msg)
+                settled = None
+
+            if settled is not None and not settled.get("ok"):
+                if settled.get("error") == "insufficient_funds":
+                    return await interaction.followup.send(
+                        "❌ Your balance changed during the game, so the bet could not be settled."
+                    )
+                return await interaction.followup.send("❌ Failed to settle your bet, please try again.")
+
+            new_balance = result_balance(settled, acc["discord_id"]) if settled else balance
+
+        msg = (
+            f"🃏 **Blackjack Result**\n"
+            f"**Your hand:** {format_hand(player_cards)}\n"
+            f"**Dealer's hand:** {format_hand(dealer_cards)}\n\n"
+            f"{result}\n"
+            f"💰 New balance: **{new_balance:.2f} WeirdCoins**."
+        )
+        await interaction.followup.send(msg)
 
     except Exception as e:
         print("BLACKJACK ERROR:", e)
-        await interaction.followup.send("❌ Internal error.")
+        await interaction.followup.send(internal_error_text(e))
+
+# ---------------- INTERACTIVE BLACKJACK TABLES ----------------
+BLACKJACK_TABLE_TTL = float(os.getenv("BLACKJACK_TABLE_TTL", "120"))
+BLACKJACK_MAX_TABLES = int(os.getenv("BLACKJACK_MAX_TABLES", "5000"))
+BLACKJACK_SWEEP_INTERVAL = 15
+
+class BlackjackSession:
+    """One live interactive game. The bet has already been debited (escrowed)."""
+    __slots__ = ("discord_id", "bet", "player", "dealer", "expires_at", "message", "done")
+
+    def __init__(self, discord_id: int, bet: float):
+        self.discord_id = discord_id
+        self.bet = bet
+        self.player = [draw_card(), draw_card()]
+        self.dealer = [draw_card(), draw_card()]
+        self.expires_at = time.monotonic() + BLACKJACK_TABLE_TTL
+        self.message = None
+        self.done = False
+
+class BlackjackTables:
+    """At most one live game per player and `max_tables` overall; idle games are auto-stood by a sweeper."""
+
+    def __init__(self, max_tables: int, sweep_interval: float):
+        self.max_tables = max_tables
+        self.sweep_interval = sweep_interval
+        self.timed_out = 0
+        self._sessions = {}
+        self._task = None
+
+    def open(self, discord_id: int, bet: float):
+        if discord_id in self._sessions or len(self._sessions) >= self.max_tables:
+            return None
+        session = self._sessions[discord_id] = BlackjackSession(discord_id, bet)
+        return session
+
+    def close(self, session: BlackjackSession):
+        if self._sessions.get(session.discord_id) is session:
+            del self._sessions[session.discord_id]
+
+    def has_table(self, discord_id: int) -> bool:
+        return discord_id in self._sessions
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        # Escrowed bets must not be lost on shutdown: stand every open hand.
+        for session in [s for s in self._sessions.values() if not s.done]:
+            await self._expire(session)
+
+    def stats(self):
+        return {
+            "open_tables": len(self._sessions),
+            "max_tables": self.max_tables,
+            "timed_out": self.timed_out
+        }
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            now = time.monotonic()
+            for session in [s for s in self._sessions.values() if s.expires_at <= now and not s.done]:
+                await self._expire(session)
+
+    async def _expire(self, session: BlackjackSession):
+        try:
+            self.timed_out += 1
+            result_text, new_balance = await finish_blackjack(session)
+            if session.message is not None:
+                await session.message.edit(
+                    embed=blackjack_table_embed(session, f"⏰ Timed out, standing.\n{result_text}", new_balance),
+                    view=None
+                )
+        except Exception as e:
+            print("BLACKJACK TABLE ERROR:", e)
+
+blackjack_tables = BlackjackTables(BLACKJACK_MAX_TABLES, BLACKJACK_SWEEP_INTERVAL)
+
+def blackjack_table_embed(session: BlackjackSession, result_text: str = None, new_balance=None) -> discord.Embed:
+    embed = discord.Embed(title="🃏 Blackjack", color=discord.Color.dark_green())
+    embed.add_field(name="Your hand", value=format_hand(session.player), inline=False)
+    if result_text is None:
+        embed.add_field(name="Dealer's hand", value=f"{session.dealer[0]}, ?", inline=False)
+        embed.set_footer(text=f"Bet: {session.bet:.2f} WeirdCoins")
+    else:
+        embed.add_field(name="Dealer's hand", value=format_hand(session.dealer), inline=False)
+        embed.description = result_text
+        if new_balance is not None:
+            embed.set_footer(text=f"Bet: {session.bet:.2f} • New balance: {new_balance:.2f} WeirdCoins")
+    return embed
+
+async def finish_blackjack(session: BlackjackSession):
+    """Play out the dealer, pay out the escrowed bet and close the table. Returns (result text, balance)."""
+    session.done = True
+    blackjack_tables.close(session)
+
+    player_total = hand_value(session.player)
+    if player_total <= 21:
+        while hand_value(session.dealer) < STAND_ON:
+            session.dealer.append(draw_card())
+    dealer_total = hand_value(session.dealer)
+
+    # Escrow already took the bet, so a win pays back twice the bet and a push returns it.
+    payout = session.bet * (outcome(player_total, dealer_total) + 1)
+    new_balance = None
+    if payout and not BALANCE_WRITE_BEHIND:
+        try:
+            async with account_locks.hold(*account_lock_keys(session.discord_id)):
+                settled = await atomic_credit(session.discord_id, payout, reason="blackjack")
+        except Exception as e:
+            # The table is already closed, so nothing else would ever pay this hand out.
+            settled = {"ok": False, "error": str(e)}
+        if settled.get("ok"):
+            new_balance = result_balance(settled, session.discord_id)
+        else:
+            # The journaled write-behind buffer keeps retrying, so the payout is not lost.
+            print("BLACKJACK PAYOUT ERROR:", settled)
+            balance_write_behind.add(session.discord_id, payout)
+    elif payout:
+        balance_write_behind.add(session.discord_id, payout)
+
+    if new_balance is None:
+        try:
+            acc = await get_account_by_discord(session.discord_id)
+        except Exception as e:
+            # The payout is settled or buffered either way; still show the player the result.
+            print("BLACKJACK BALANCE ERROR:", e)
+            acc = None
+        new_balance = float(acc.get("balance", 0)) if acc else None
+    return blackjack_result_text(player_total, dealer_total), new_balance
+
+class BlackjackView(discord.ui.View):
+    def __init__(self, session: BlackjackSession):
+        super().__init__(timeout=BLACKJACK_TABLE_TTL)
+        self.session = session
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.session.discord_id:
+            await interaction.response.send_message("❌ This is not your table.", ephemeral=True)
+            return False
+        if self.session.done:
+            await interaction.response.send_message("❌ This game is already over.", ephemeral=True)
+            return False
+        return True
+
+    async def _finish(self, interaction: discord.Interaction):
+        result_text, new_balance = await finish_blackjack(self.session)
+        self.stop()
+        await interaction.edit_original_response(
+            embed=blackjack_table_embed(self.session, result_text, new_balance),
+            view=None
+        )
+
+    @discord.ui.button(label="Hit", style=discord.ButtonStyle.primary)
+    async def hit(self, interaction: discord.Interaction, button: discord.ui.Button):
+        session = self.session
+        session.player.append(draw_card())
+        session.expires_at = time.monotonic() + BLACKJACK_TABLE_TTL
+        if hand_value(session.player) >= 21:
+            session.done = True
+            await interaction.response.defer()
+            return await self._finish(interaction)
+        self.double.disabled = True
+        await interaction.response.edit_message(embed=blackjack_table_embed(session), view=self)
+
+    @discord.ui.button(label="Stand", style=discord.ButtonStyle.secondary)
+    async def stand(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.session.done = True
+        await interaction.response.defer()
+        await self._finish(interaction)
+
+    @discord.ui.button(label="Double", style=discord.ButtonStyle.success)
+    async def double(self, interaction: discord.Interaction, button: discord.ui.Button):
+        session = self.session
+        if len(session.player) != 2:
+            return await interaction.response.send_message("❌ You can only double on your first two cards.", ephemeral=True)
+
+        session.done = True  # blocks other presses while the extra bet is escrowed
+        await interaction.response.defer()
+        try:
+            async with account_locks.hold(*account_lock_keys(session.discord_id)):
+                escrowed = await atomic_debit(session.discord_id, session.bet, reason="blackjack_bet")
+        except Exception as e:
+            print("BLACKJACK DOUBLE ERROR:", e)
+            session.done = False
+            return await interaction.followup.send("❌ Failed to double, please try again.", ephemeral=True)
+        if not escrowed.get("ok"):
+            session.done = False
+            if escrowed.get("error") == "insufficient_funds":
+                return await interaction.followup.send("❌ You don't have enough WeirdCoins to double.", ephemeral=True)
+            return await interaction.followup.send("❌ Failed to double, please try again.", ephemeral=True)
+
+        session.bet *= 2
+        session.player.append(draw_card())
+        await self._finish(interaction)
+
+async def open_blackjack_table(interaction: discord.Interaction, acc: dict, amount: float):
+    session = blackjack_tables.open(interaction.user.id, amount)
+    if session is None:
+        if blackjack_tables.has_table(interaction.user.id):
+            return await interaction.followup.send("❌ You already have a blackjack game in progress.")
+        return await interaction.followup.send("❌ All blackjack tables are busy, try again shortly.")
+
+    try:
+        async with account_locks.hold_accounts(acc):
+            escrowed = await atomic_debit(interaction.user.id, amount, reason="blackjack_bet")
+    except Exception as e:
+        print("BLACKJACK BET ERROR:", e)
+        escrowed = {"ok": False, "error": "rpc_failed"}
+    if not escrowed.get("ok"):
+        # No escrow, so the table must go before the sweeper stands it and pays out the bet.
+        blackjack_tables.close(session)
+        if escrowed.get("error") == "insufficient_funds":
+            balance = result_balance(escrowed, interaction.user.id)
+            return await interaction.followup.send(
+                f"❌ You don't have enough WeirdCoins. You have **{balance:.2f}**."
+            )
+        return await interaction.followup.send("❌ Failed to place your bet, please try again.")
+
+    view = BlackjackView(session)
+    if hand_value(session.player) == 21:
+        result_text, new_balance = await finish_blackjack(session)
+        return await interaction.followup.send(embed=blackjack_table_embed(session, result_text, new_balance))
+    session.message = await interaction.followup.send(embed=blackjack_table_embed(session), view=view)
 
 # --------------- PART 1 END (NEXT: FACTION LOGIC) ---------------
 # ============================================================
 # EXTRA SUPABASE HELPER FOR DELETE
 # ============================================================
-async def supabase_delete(session, table, params):
-    url = f"{SUPABASE_URL}/rest/v1/{table}{params}"
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "application/json"
-    }
-    async with session.delete(url, headers=headers) as res:
-        return await safe_json(res), res.status
+async def supabase_delete(table, params):
+    headers = {"Content-Type": "application/json"}
+    return await supabase.request("DELETE", table, params, headers=headers)
 
 # ============================================================
 # FACTION CONSTANTS
 # ============================================================
 FACTION_STATUS_CHANNEL_ID = FACTION_CHANNEL_ID
 FACTION_EMBED_MESSAGE_ID = int(os.getenv("FACTION_EMBED_MESSAGE_ID", "0"))
+FACTION_EMBED_REFRESH_WINDOW = float(os.getenv("FACTION_EMBED_REFRESH_WINDOW", "5"))
+FACTION_INDEX_RECONCILE_INTERVAL = float(os.getenv("FACTION_INDEX_RECONCILE_INTERVAL", "300"))
+FACTION_COUNT_REPAIR_INTERVAL = float(os.getenv("FACTION_COUNT_REPAIR_INTERVAL", "3600"))
+
+# ============================================================
+# FACTION INDEX (IN-MEMORY)
+# ============================================================
+class FactionIndex:
+    """All factions and memberships, loaded at startup and updated by every faction command.
+
+    Lookups by name (case-insensitive), id and member UUID, plus each faction's member set.
+    A periodic reload picks up changes made outside this process (e.g. by the plugin); a reload
+    that overlaps a local mutation is discarded and retried on the next pass.
+    """
+
+    def __init__(self, reconcile_interval: float, repair_interval: float):
+        self.reconcile_interval = reconcile_interval
+        self.repair_interval = repair_interval
+        self.loaded = False
+        self.reloads = 0
+        self.discarded_reloads = 0
+        self.counts_repaired = 0
+        self.last_repair = time.monotonic()
+        self._by_id = {}
+        self._by_name = {}
+        self._by_uuid = {}
+        self._members = {}
+        self._version = 0
+        self._task = None
+
+    async def load(self) -> bool:
+        version = self._version
+        data, status = await supabase_get(
+            "factions",
+            "?select=id,name,creator_uuid,created_at,member_count,faction_members(player_uuid)"
+            "&order=created_at.asc"
+        )
+        if status != 200 or not isinstance(data, list):
+            print("FACTION INDEX LOAD ERROR:", status, data)
+            return False
+        if version != self._version:
+            self.discarded_reloads += 1
+            return False
+
+        by_id, by_name, by_uuid, members = {}, {}, {}, {}
+        for row in data:
+            faction = {key: value for key, value in row.items() if key != "faction_members"}
+            faction_id = str(faction["id"])
+            by_id[faction_id] = faction
+            by_name[faction["name"].lower()] = faction_id
+            members[faction_id] = set()
+            for member in row.get("faction_members") or []:
+                members[faction_id].add(member["player_uuid"])
+                by_uuid[member["player_uuid"]] = faction_id
+
+        self._by_id, self._by_name, self._by_uuid, self._members = by_id, by_name, by_uuid, members
+        self.loaded = True
+        self.reloads += 1
+        return True
+
+    def by_name(self, name: str):
+        faction_id = self._by_name.get(name.lower())
+        return self._by_id.get(faction_id) if faction_id else None
+
+    def by_id(self, faction_id):
+        return self._by_id.get(str(faction_id))
+
+    def by_member(self, mc_uuid: str):
+        faction_id = self._by_uuid.get(mc_uuid)
+        return self._by_id.get(faction_id) if faction_id else None
+
+    def members(self, faction_id):
+        return sorted(self._members.get(str(faction_id), ()))
+
+    def all(self):
+        return sorted(self._by_id.values(), key=lambda f: str(f.get("created_at") or ""))
+
+    def add_faction(self, faction: dict):
+        self._version += 1
+        faction_id = str(faction["id"])
+        self._by_id[faction_id] = dict(faction)
+        self._by_name[faction["name"].lower()] = faction_id
+        self._members.setdefault(faction_id, set())
+
+    def remove_faction(self, faction_id):
+        self._version += 1
+        faction_id = str(faction_id)
+        faction = self._by_id.pop(faction_id, None)
+        if faction is not None:
+            self._by_name.pop(faction["name"].lower(), None)
+        for mc_uuid in self._members.pop(faction_id, ()):
+            self._by_uuid.pop(mc_uuid, None)
+
+    def add_member(self, faction_id, mc_uuid: str):
+        self._version += 1
+        faction_id = str(faction_id)
+        self._members.setdefault(faction_id, set()).add(mc_uuid)
+        self._by_uuid[mc_uuid] = faction_id
+
+    def remove_member(self, mc_uuid: str):
+        self._version += 1
+        faction_id = self._by_uuid.pop(mc_uuid, None)
+        if faction_id is not None:
+            self._members.get(faction_id, set()).discard(mc_uuid)
+
+    def set_member_count(self, faction_id, count: int):
+        faction = self._by_id.get(str(faction_id))
+        if faction is not None:
+            faction["member_count"] = count
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def stats(self):
+        return {
+            "loaded": int(self.loaded),
+            "factions": len(self._by_id),
+            "members": len(self._by_uuid),
+            "reloads": self.reloads,
+            "discarded_reloads": self.discarded_reloads,
+            "counts_repaired": self.counts_repaired
+        }
+
+    async def repair_counts(self):
+        """Recount member_count for every faction server-side; returns how many were wrong."""
+        data, status = await supabase_rpc("faction_repair_member_counts", {})
+        self.last_repair = time.monotonic()
+        if status != 200 or not isinstance(data, int):
+            print("FACTION COUNT REPAIR ERROR:", status, data)
+            return None
+        if data:
+            print("FACTION COUNT REPAIR: fixed", data, "factions")
+            self.counts_repaired += data
+        return data
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                if time.monotonic() - self.last_repair >= self.repair_interval:
+                    await self.repair_counts()
+                await self.load()
+            except Exception as e:
+                print("FACTION INDEX LOAD ERROR:", e)
+
+faction_index = FactionIndex(FACTION_INDEX_RECONCILE_INTERVAL, FACTION_COUNT_REPAIR_INTERVAL)
 
 # ============================================================
 # FACTION HELPERS
 # ============================================================
-async def get_faction_by_name(session, name: str):
+# Each helper answers from faction_index once it has loaded and only falls back to Supabase
+# if the startup load failed.
+async def get_faction_by_name(name: str):
+    if faction_index.loaded:
+        return faction_index.by_name(name)
+
     data, status = await supabase_get(
-        session,
         "factions",
         f"?name=eq.{name}"
     )
@@ -835,9 +3456,11 @@ async def get_faction_by_name(session, name: str):
         return data[0]
     return None
 
-async def get_faction_by_id(session, faction_id: str):
+async def get_faction_by_id(faction_id: str):
+    if faction_index.loaded:
+        return faction_index.by_id(faction_id)
+
     data, status = await supabase_get(
-        session,
         "factions",
         f"?id=eq.{faction_id}"
     )
@@ -845,9 +3468,14 @@ async def get_faction_by_id(session, faction_id: str):
         return data[0]
     return None
 
-async def get_player_faction(session, mc_uuid: str):
+async def get_player_faction(mc_uuid: str):
+    if faction_index.loaded:
+        faction = faction_index.by_member(mc_uuid)
+        if faction is None:
+            return None, None
+        return faction, {"faction_id": faction["id"], "player_uuid": mc_uuid}
+
     data, status = await supabase_get(
-        session,
         "faction_members",
         f"?player_uuid=eq.{mc_uuid}"
     )
@@ -856,12 +3484,14 @@ async def get_player_faction(session, mc_uuid: str):
 
     member_row = data[0]
     faction_id = member_row["faction_id"]
-    faction = await get_faction_by_id(session, faction_id)
+    faction = await get_faction_by_id(faction_id)
     return faction, member_row
 
-async def get_faction_members(session, faction_id: str):
+async def get_faction_members(faction_id: str):
+    if faction_index.loaded:
+        return [{"faction_id": faction_id, "player_uuid": mc_uuid} for mc_uuid in faction_index.members(faction_id)]
+
     data, status = await supabase_get(
-        session,
         "faction_members",
         f"?faction_id=eq.{faction_id}"
     )
@@ -869,23 +3499,37 @@ async def get_faction_members(session, faction_id: str):
         return data
     return []
 
-async def update_faction_member_count(session, faction_id: str):
-    members = await get_faction_members(session, faction_id)
-    count = len(members)
-    await supabase_patch(
-        session,
-        "factions",
-        f"?id=eq.{faction_id}",
-        {"member_count": count}
-    )
-    return count
+async def adjust_faction_member_count(faction_id: str, delta: int):
+    """Atomically add `delta` to factions.member_count (sql/faction_counts.sql) and return the new count.
+
+    Not retried, since a repeated increment would double count; faction_repair_member_counts
+    fixes any count a failed call leaves behind.
+    """
+    data, status = await supabase_rpc("faction_adjust_member_count", {
+        "p_faction_id": str(faction_id),
+        "p_delta": delta
+    })
+    if status == 200 and isinstance(data, int):
+        faction_index.set_member_count(faction_id, data)
+        return data
 
-async def build_faction_status_embed(session):
-    data, status = await supabase_get(
-        session,
-        "factions",
-        "?select=id,name,creator_uuid,created_at,member_count&order=created_at.asc"
-    )
+    print("FACTION COUNT ERROR:", status, data)
+    return len(await get_faction_members(faction_id))
+
+async def build_faction_status_embed():
+    if faction_index.loaded:
+        status = 200
+        data = [
+            dict(faction, faction_members=[{"player_uuid": u} for u in faction_index.members(faction["id"])])
+            for faction in faction_index.all()
+        ]
+    else:
+        # Members come back embedded in each faction row, so the overview is a single request.
+        data, status = await supabase_get(
+            "factions",
+            "?select=id,name,creator_uuid,created_at,member_count,faction_members(player_uuid)"
+            "&order=created_at.asc"
+        )
 
     embed = discord.Embed(
         title="🏰 Factions Overview",
@@ -898,13 +3542,12 @@ async def build_faction_status_embed(session):
         return embed
 
     for faction in data:
-        faction_id = faction["id"]
         name = faction["name"]
         creator_uuid = faction["creator_uuid"]
         created_at = faction["created_at"]
         member_count = faction.get("member_count", 0)
 
-        members = await get_faction_members(session, faction_id)
+        members = faction.get("faction_members") or []
         member_list = ", ".join(m["player_uuid"][:8] for m in members) if members else "No members yet"
 
         value = (
@@ -916,30 +3559,88 @@ async def build_faction_status_embed(session):
 
     return embed
 
-async def refresh_faction_embed(session):
+async def refresh_faction_embed():
     if FACTION_EMBED_MESSAGE_ID == 0:
         return
 
-    channel = bot.get_channel(FACTION_STATUS_CHANNEL_ID)
-    if channel is None:
-        return
-
-    try:
-        message = await channel.fetch_message(FACTION_EMBED_MESSAGE_ID)
-    except Exception as e:
-        print("FACTION EMBED FETCH ERROR:", e)
+    message = await faction_embed_refresher.get_message()
+    if message is None:
         return
 
-    embed = await build_faction_status_embed(session)
+    embed = await build_faction_status_embed()
     try:
         await message.edit(embed=embed)
+    except discord.NotFound:
+        faction_embed_refresher.forget_message()
     except Exception as e:
         print("FACTION EMBED EDIT ERROR:", e)
 
+class FactionEmbedRefresher:
+    """Coalesces faction changes into one embed rebuild and edit per window, off the command path."""
+
+    def __init__(self, window: float):
+        self.window = window
+        self.refreshes = 0
+        self.coalesced = 0
+        self._dirty = asyncio.Event()
+        self._task = None
+        self._message = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def mark_dirty(self):
+        if self._dirty.is_set():
+            self.coalesced += 1
+        self._dirty.set()
+
+    async def get_message(self):
+        if self._message is not None:
+            return self._message
+
+        channel = bot.get_channel(FACTION_STATUS_CHANNEL_ID)
+        if channel is None:
+            return None
+
+        try:
+            self._message = await channel.fetch_message(FACTION_EMBED_MESSAGE_ID)
+        except Exception as e:
+            print("FACTION EMBED FETCH ERROR:", e)
+        return self._message
+
+    def forget_message(self):
+        self._message = None
+
+    def stats(self):
+        return {"refreshes": self.refreshes, "coalesced": self.coalesced, "window_s": self.window}
+
+    async def _run(self):
+        await bot.wait_until_ready()
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(self.window)
+            self._dirty.clear()
+            try:
+                await refresh_faction_embed()
+                self.refreshes += 1
+            except Exception as e:
+                print("FACTION EMBED REFRESH ERROR:", e)
+
+faction_embed_refresher = FactionEmbedRefresher(FACTION_EMBED_REFRESH_WINDOW)
+
 # ============================================================
 # DISCORD-SIDE FACTION COMMANDS
 # ============================================================
 @tree.command(name="faction_create", description="Create a new faction (linked to your Minecraft UUID)")
+@instrumented
 async def faction_create(interaction: discord.Interaction, name: str):
     await interaction.response.defer(thinking=True)
 
@@ -948,251 +3649,684 @@ async def faction_create(interaction: discord.Interaction, name: str):
         return await interaction.followup.send("❌ Faction name must be between 3 and 16 characters.")
 
     try:
-        async with aiohttp.ClientSession() as session:
-            acc = await get_account_by_discord(session, interaction.user.id)
-            if not acc or not acc.get("mc_uuid"):
-                return await interaction.followup.send(
-                    "❌ You are not linked to a Minecraft account. Use `/link` first."
-                )
-
-            mc_uuid = acc["mc_uuid"]
+        acc = await get_account_by_discord(interaction.user.id)
+        if not acc or not acc.get("mc_uuid"):
+            return await interaction.followup.send(
+                "❌ You are not linked to a Minecraft account. Use `/link` first."
+            )
 
-            existing_faction, _ = await get_player_faction(session, mc_uuid)
-            if existing_faction:
-                return await interaction.followup.send("❌ You are already in a faction. Leave it first.")
+        mc_uuid = acc["mc_uuid"]
 
-            existing_by_name = await get_faction_by_name(session, name)
-            if existing_by_name:
-                return await interaction.followup.send("❌ A faction with that name already exists.")
+        existing_faction, _ = await get_player_faction(mc_uuid)
+        if existing_faction:
+            return await interaction.followup.send("❌ You are already in a faction. Leave it first.")
 
-            faction_data = {
-                "name": name,
-                "creator_uuid": mc_uuid,
-                "member_count": 0
-            }
-            created, status = await supabase_post(session, "factions", faction_data)
-            if status != 201 or not isinstance(created, list) or not created:
-                print("FACTION CREATE ERROR:", status, created)
-                return await interaction.followup.send("❌ Failed to create faction in database.")
+        existing_by_name = await get_faction_by_name(name)
+        if existing_by_name:
+            return await interaction.followup.send("❌ A faction with that name already exists.")
 
-            faction = created[0]
-            faction_id = faction["id"]
+        faction_data = {
+            "name": name,
+            "creator_uuid": mc_uuid,
+            "member_count": 0
+        }
+        created, status = await supabase_post("factions", faction_data)
+        if status != 201 or not isinstance(created, list) or not created:
+            print("FACTION CREATE ERROR:", status, created)
+            return await interaction.followup.send("❌ Failed to create faction in database.")
 
-            member_data = {
-                "faction_id": faction_id,
-                "player_uuid": mc_uuid
-            }
-            m_created, m_status = await supabase_post(session, "faction_members", member_data)
-            if m_status != 201:
-                print("FACTION MEMBER CREATE ERROR:", m_status, m_created)
-                return await interaction.followup.send(
-                    "❌ Faction created but failed to add you as a member. Contact an admin."
-                )
+        faction = created[0]
+        faction_id = faction["id"]
+        faction_index.add_faction(faction)
+
+        member_data = {
+            "faction_id": faction_id,
+            "player_uuid": mc_uuid
+        }
+        m_created, m_status = await supabase_post("faction_members", member_data)
+        if m_status != 201:
+            print("FACTION MEMBER CREATE ERROR:", m_status, m_created)
+            return await interaction.followup.send(
+                "❌ Faction created but failed to add you as a member. Contact an admin."
+            )
+        faction_index.add_member(faction_id, mc_uuid)
 
-            count = await update_faction_member_count(session, faction_id)
-            await refresh_faction_embed(session)
+        count = await adjust_faction_member_count(faction_id, 1)
+        faction_embed_refresher.mark_dirty()
 
-            await interaction.followup.send(
-                f"🏰 Faction **{name}** created!\n"
-                f"You are the leader. Members: **{count}**."
-            )
+        await interaction.followup.send(
+            f"🏰 Faction **{name}** created!\n"
+            f"You are the leader. Members: **{count}**."
+        )
 
     except Exception as e:
         print("FACTION_CREATE ERROR:", e)
-        await interaction.followup.send("❌ Internal error while creating faction.")
+        await interaction.followup.send(internal_error_text(e, "❌ Internal error while creating faction."))
 
 @tree.command(name="faction_join", description="Join an existing faction (by name)")
+@instrumented
 async def faction_join(interaction: discord.Interaction, name: str):
     await interaction.response.defer(thinking=True)
 
     name = name.strip()
 
     try:
-        async with aiohttp.ClientSession() as session:
-            acc = await get_account_by_discord(session, interaction.user.id)
-            if not acc or not acc.get("mc_uuid"):
-                return await interaction.followup.send(
-                    "❌ You are not linked to a Minecraft account. Use `/link` first."
-                )
-
-            mc_uuid = acc["mc_uuid"]
-
-            existing_faction, _ = await get_player_faction(session, mc_uuid)
-            if existing_faction:
-                return await interaction.followup.send("❌ You are already in a faction. Leave it first.")
+        acc = await get_account_by_discord(interaction.user.id)
+        if not acc or not acc.get("mc_uuid"):
+            return await interaction.followup.send(
+                "❌ You are not linked to a Minecraft account. Use `/link` first."
+            )
 
-            faction = await get_faction_by_name(session, name)
-            if not faction:
-                return await interaction.followup.send("❌ No faction with that name exists.")
+        mc_uuid = acc["mc_uuid"]
 
-            faction_id = faction["id"]
+        existing_faction, _ = await get_player_faction(mc_uuid)
+        if existing_faction:
+            return await interaction.followup.send("❌ You are already in a faction. Leave it first.")
 
-            member_data = {
-                "faction_id": faction_id,
-                "player_uuid": mc_uuid
-            }
-            created, status = await supabase_post(session, "faction_members", member_data)
-            if status != 201:
-                print("FACTION JOIN ERROR:", status, created)
-                return await interaction.followup.send("❌ Failed to join faction (database error).")
+        faction = await get_faction_by_name(name)
+        if not faction:
+            return await interaction.followup.send("❌ No faction with that name exists.")
 
-            count = await update_faction_member_count(session, faction_id)
-            await refresh_faction_embed(session)
+        faction_id = faction["id"]
 
-            await interaction.followup.send(
-                f"✅ You joined faction **{faction['name']}**.\n"
-                f"Current members: **{count}**."
-            )
+        member_data = {
+            "faction_id": faction_id,
+            "player_uuid": mc_uuid
+        }
+        created, status = await supabase_post("faction_members", member_data)
+        if status != 201:
+            print("FACTION JOIN ERROR:", status, created)
+            return await interaction.followup.send("❌ Failed to join faction (database error).")
+        faction_index.add_member(faction_id, mc_uuid)
+
+        count = await adjust_faction_member_count(faction_id, 1)
+        faction_embed_refresher.mark_dirty()
+
+        await interaction.followup.send(
+            f"✅ You joined faction **{faction['name']}**.\n"
+            f"Current members: **{count}**."
+        )
 
     except Exception as e:
         print("FACTION_JOIN ERROR:", e)
-        await interaction.followup.send("❌ Internal error while joining faction.")
+        await interaction.followup.send(internal_error_text(e, "❌ Internal error while joining faction."))
 
 @tree.command(name="faction_details", description="Show details about your current faction")
+@instrumented
 async def faction_details(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            acc = await get_account_by_discord(session, interaction.user.id)
-            if not acc or not acc.get("mc_uuid"):
-                return await interaction.followup.send(
-                    "❌ You are not linked to a Minecraft account. Use `/link` first."
-                )
+        acc = await get_account_by_discord(interaction.user.id)
+        if not acc or not acc.get("mc_uuid"):
+            return await interaction.followup.send(
+                "❌ You are not linked to a Minecraft account. Use `/link` first."
+            )
 
-            mc_uuid = acc["mc_uuid"]
+        mc_uuid = acc["mc_uuid"]
 
-            faction, member_row = await get_player_faction(session, mc_uuid)
-            if not faction:
-                return await interaction.followup.send("❌ You are not in a faction.")
+        faction, member_row = await get_player_faction(mc_uuid)
+        if not faction:
+            return await interaction.followup.send("❌ You are not in a faction.")
 
-            faction_id = faction["id"]
-            members = await get_faction_members(session, faction_id)
-            member_count = len(members)
+        faction_id = faction["id"]
+        members = await get_faction_members(faction_id)
+        member_count = len(members)
 
-            creator_uuid = faction["creator_uuid"]
-            created_at = faction["created_at"]
-            name = faction["name"]
+        creator_uuid = faction["creator_uuid"]
+        created_at = faction["created_at"]
+        name = faction["name"]
 
-            embed = discord.Embed(
-                title=f"🏰 Faction: {name}",
-                color=discord.Color.purple()
+        embed = discord.Embed(
+            title=f"🏰 Faction: {name}",
+            color=discord.Color.purple()
+        )
+        embed.add_field(name="Creator UUID", value=f"`{creator_uuid}`", inline=False)
+        embed.add_field(name="Created At", value=f"`{created_at}`", inline=False)
+        embed.add_field(name="Members", value=str(member_count), inline=False)
+
+        member_lines = []
+        for m in members:
+            uuid_short = m["player_uuid"][:8]
+            member_lines.append(f"- `{uuid_short}`")
+
+        if member_lines:
+            embed.add_field(
+                name="Member UUIDs (shortened)",
+                value="\n".join(member_lines),
+                inline=False
             )
-            embed.add_field(name="Creator UUID", value=f"`{creator_uuid}`", inline=False)
-            embed.add_field(name="Created At", value=f"`{created_at}`", inline=False)
-            embed.add_field(name="Members", value=str(member_count), inline=False)
-
-            member_lines = []
-            for m in members:
-                uuid_short = m["player_uuid"][:8]
-                member_lines.append(f"- `{uuid_short}`")
-
-            if member_lines:
-                embed.add_field(
-                    name="Member UUIDs (shortened)",
-                    value="\n".join(member_lines),
-                    inline=False
-                )
 
-            await interaction.followup.send(embed=embed)
+        await interaction.followup.send(embed=embed)
 
     except Exception as e:
         print("FACTION_DETAILS ERROR:", e)
-        await interaction.followup.send("❌ Internal error while loading faction details.")
+        await interaction.followup.send(internal_error_text(e, "❌ Internal error while loading faction details."))
 
 @tree.command(name="faction_leave", description="Leave your current faction")
+@instrumented
 async def faction_leave(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            acc = await get_account_by_discord(session, interaction.user.id)
-            if not acc or not acc.get("mc_uuid"):
-                return await interaction.followup.send(
-                    "❌ You are not linked to a Minecraft account. Use `/link` first."
-                )
-
-            mc_uuid = acc["mc_uuid"]
+        acc = await get_account_by_discord(interaction.user.id)
+        if not acc or not acc.get("mc_uuid"):
+            return await interaction.followup.send(
+                "❌ You are not linked to a Minecraft account. Use `/link` first."
+            )
 
-            faction, member_row = await get_player_faction(session, mc_uuid)
-            if not faction or not member_row:
-                return await interaction.followup.send("❌ You are not in a faction.")
+        mc_uuid = acc["mc_uuid"]
 
-            faction_id = faction["id"]
+        faction, member_row = await get_player_faction(mc_uuid)
+        if not faction or not member_row:
+            return await interaction.followup.send("❌ You are not in a faction.")
 
-            if faction["creator_uuid"] == mc_uuid:
-                return await interaction.followup.send(
-                    "❌ You are the faction leader. Use `/faction_disband` instead."
-                )
+        faction_id = faction["id"]
 
-            _, status = await supabase_delete(
-                session,
-                "faction_members",
-                f"?faction_id=eq.{faction_id}&player_uuid=eq.{mc_uuid}"
+        if faction["creator_uuid"] == mc_uuid:
+            return await interaction.followup.send(
+                "❌ You are the faction leader. Use `/faction_disband` instead."
             )
-            if status not in (200, 204):
-                return await interaction.followup.send("❌ Failed to leave faction (database error).")
 
-            count = await update_faction_member_count(session, faction_id)
-            await refresh_faction_embed(session)
+        _, status = await supabase_delete(
+            "faction_members",
+            f"?faction_id=eq.{faction_id}&player_uuid=eq.{mc_uuid}"
+        )
+        if status not in (200, 204):
+            return await interaction.followup.send("❌ Failed to leave faction (database error).")
+        faction_index.remove_member(mc_uuid)
+
+        count = await adjust_faction_member_count(faction_id, -1)
+        faction_embed_refresher.mark_dirty()
 
-            await interaction.followup.send(
-                f"✅ You left faction **{faction['name']}**.\n"
-                f"Remaining members: **{count}**."
-            )
+        await interaction.followup.send(
+            f"✅ You left faction **{faction['name']}**.\n"
+            f"Remaining members: **{count}**."
+        )
 
     except Exception as e:
         print("FACTION_LEAVE ERROR:", e)
-        await interaction.followup.send("❌ Internal error while leaving faction.")
+        await interaction.followup.send(internal_error_text(e, "❌ Internal error while leaving faction."))
 
 @tree.command(name="faction_disband", description="Disband your faction (leader only)")
+@instrumented
 async def faction_disband(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            acc = await get_account_by_discord(session, interaction.user.id)
-            if not acc or not acc.get("mc_uuid"):
-                return await interaction.followup.send(
-                    "❌ You are not linked to a Minecraft account. Use `/link` first."
-                )
+        acc = await get_account_by_discord(interaction.user.id)
+        if not acc or not acc.get("mc_uuid"):
+            return await interaction.followup.send(
+                "❌ You are not linked to a Minecraft account. Use `/link` first."
+            )
 
-            mc_uuid = acc["mc_uuid"]
+        mc_uuid = acc["mc_uuid"]
 
-            faction, member_row = await get_player_faction(session, mc_uuid)
-            if not faction:
-                return await interaction.followup.send("❌ You are not in a faction.")
+        faction, member_row = await get_player_faction(mc_uuid)
+        if not faction:
+            return await interaction.followup.send("❌ You are not in a faction.")
 
-            if faction["creator_uuid"] != mc_uuid:
-                return await interaction.followup.send("❌ Only the faction creator can disband the faction.")
+        if faction["creator_uuid"] != mc_uuid:
+            return await interaction.followup.send("❌ Only the faction creator can disband the faction.")
 
-            faction_id = faction["id"]
+        faction_id = faction["id"]
 
-            _, m_status = await supabase_delete(
-                session,
-                "faction_members",
-                f"?faction_id=eq.{faction_id}"
-            )
-            if m_status not in (200, 204):
-                print("FACTION DISBAND MEMBER DELETE ERROR:", m_status)
+        _, m_status = await supabase_delete(
+            "faction_members",
+            f"?faction_id=eq.{faction_id}"
+        )
+        if m_status not in (200, 204):
+            print("FACTION DISBAND MEMBER DELETE ERROR:", m_status)
 
-            _, f_status = await supabase_delete(
-                session,
-                "factions",
-                f"?id=eq.{faction_id}"
-            )
-            if f_status not in (200, 204):
-                return await interaction.followup.send("❌ Failed to disband faction (database error).")
+        _, f_status = await supabase_delete(
+            "factions",
+            f"?id=eq.{faction_id}"
+        )
+        if f_status not in (200, 204):
+            return await interaction.followup.send("❌ Failed to disband faction (database error).")
+        faction_index.remove_faction(faction_id)
 
-            await refresh_faction_embed(session)
+        faction_embed_refresher.mark_dirty()
 
-            await interaction.followup.send(
-                f"💥 Faction **{faction['name']}** has been disbanded."
-            )
+        await interaction.followup.send(
+            f"💥 Faction **{faction['name']}** has been disbanded."
+        )
 
     except Exception as e:
         print("FACTION_DISBAND ERROR:", e)
-        await interaction.followup.send("❌ Internal error while disbanding faction.")
+        await interaction.followup.send(internal_error_text(e, "❌ Internal error while disbanding faction."))
+
+# ============================================================
+# SCHEDULED ECONOMY JOBS (sql/economy_jobs.sql)
+# ============================================================
+ECONOMY_JOB_TICK = float(os.getenv("ECONOMY_JOB_TICK", "60"))
+ECONOMY_JOB_CHUNK = int(os.getenv("ECONOMY_JOB_CHUNK", "1000"))
+ECONOMY_INTEREST_RATE = float(os.getenv("ECONOMY_INTEREST_RATE", "0"))          # per day
+ECONOMY_INTEREST_CAP = float(os.getenv("ECONOMY_INTEREST_CAP", "100000"))       # balance that earns interest
+ECONOMY_WEALTH_TAX_RATE = float(os.getenv("ECONOMY_WEALTH_TAX_RATE", "0"))      # per day
+ECONOMY_WEALTH_TAX_THRESHOLD = float(os.getenv("ECONOMY_WEALTH_TAX_THRESHOLD", "1000000"))
+
+async def iter_accounts(chunk_size: int, after: str = None, select: str = "discord_id,balance"):
+    """Yield linked accounts in discord_id order, `chunk_size` rows at a time (keyset paging)."""
+    while True:
+        params = f"?select={select}&discord_id=not.is.null&order=discord_id.asc&limit={chunk_size}"
+        if after is not None:
+            params += f"&discord_id=gt.{quote(after, safe='')}"
+        data, status = await supabase_get("accounts", params)
+        if status != 200 or not isinstance(data, list):
+            raise RuntimeError(f"account scan failed: {status} {data}")
+        if not data:
+            return
+        yield data
+        if len(data) < chunk_size:
+            return
+        after = str(data[-1]["discord_id"])
+
+def interest_deltas(rows):
+    return {
+        str(row["discord_id"]): round(min(float(row["balance"]), ECONOMY_INTEREST_CAP) * ECONOMY_INTEREST_RATE, 2)
+        for row in rows
+        if float(row["balance"]) > 0
+    }
+
+def wealth_tax_deltas(rows):
+    return {
+        str(row["discord_id"]): -round((float(row["balance"]) - ECONOMY_WEALTH_TAX_THRESHOLD) * ECONOMY_WEALTH_TAX_RATE, 2)
+        for row in rows
+        if float(row["balance"]) > ECONOMY_WEALTH_TAX_THRESHOLD
+    }
+
+class EconomyJob:
+    """A once-per-day pass over all accounts; `compute` maps a chunk of rows to {discord_id: delta}."""
+
+    def __init__(self, name: str, compute, enabled):
+        self.name = name
+        self.compute = compute
+        self.enabled = enabled
+        self.last_run_key = None
+        self.last_accounts = 0
+        self.last_total = 0.0
+
+    def run_key(self) -> str:
+        return time.strftime("%Y-%m-%d", time.gmtime())
+
+class EconomyScheduler:
+    """Runs due jobs from the bot's event loop, checkpointing after every chunk so a restart resumes."""
+
+    def __init__(self, jobs, tick: float, chunk_size: int):
+        self.jobs = jobs
+        self.tick = tick
+        self.chunk_size = chunk_size
+        self.running = None
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def stats(self):
+        stats = {"running": self.running or "-"}
+        for job in self.jobs:
+            stats[f"{job.name}_enabled"] = int(bool(job.enabled()))
+            stats[f"{job.name}_last_run"] = job.last_run_key or "-"
+            stats[f"{job.name}_last_accounts"] = job.last_accounts
+        return stats
+
+    async def _run(self):
+        while True:
+            for job in self.jobs:
+                if not job.enabled():
+                    continue
+                try:
+                    await self.run_job(job)
+                except Exception as e:
+                    print(f"ECONOMY JOB {job.name.upper()} ERROR:", e)
+                finally:
+                    self.running = None
+            await asyncio.sleep(self.tick)
+
+    async def run_job(self, job: EconomyJob):
+        run_key = job.run_key()
+        if job.last_run_key == run_key:
+            return
+
+        checkpoint = await self._checkpoint(job, run_key)
+        if checkpoint is None:
+            return
+        if checkpoint.get("status") == "done":
+            job.last_run_key = run_key
+            return
+
+        self.running = job.name
+        cursor = checkpoint.get("cursor")
+        accounts = int(checkpoint.get("accounts") or 0)
+        total = float(checkpoint.get("total_delta") or 0)
+        key_params = f"?job=eq.{job.name}&run_key=eq.{run_key}"
+
+        async for rows in iter_accounts(self.chunk_size, after=cursor):
+            deltas = {discord_id: delta for discord_id, delta in job.compute(rows).items() if delta}
+            if deltas:
+                # Derived from the chunk start, so replaying a chunk after a crash is a no-op.
+                batch_id = f"job:{job.name}:{run_key}:{cursor or ''}"
+                result = await economy_rpc(
+                    "economy_apply_deltas",
+                    {"p_batch_id": batch_id, "p_deltas": deltas},
+                    idempotency_key=batch_id
+                )
+                if not result.get("ok"):
+                    raise RuntimeError(f"chunk after {cursor!r} failed")
+                if not result.get("duplicate"):
+                    applied = result.get("applied") or {}
+                    ledger.record_result(result, applied, job.name, ref=f"job:{job.name}:{run_key}")
+                    accounts += len(applied)
+                    total += sum(float(v) for v in applied.values())
+
+            cursor = str(rows[-1]["discord_id"])
+            await supabase_patch(
+                "economy_job_runs",
+                key_params,
+                {"cursor": cursor, "accounts": accounts, "total_delta": total,
+                 "updated_at": datetime.now(timezone.utc).isoformat()},
+                idempotency_key=f"job-cursor:{job.name}:{run_key}:{cursor}"
+            )
+
+        await supabase_patch(
+            "economy_job_runs",
+            key_params,
+            {"status": "done", "updated_at": datetime.now(timezone.utc).isoformat()},
+            idempotency_key=f"job-done:{job.name}:{run_key}"
+        )
+        job.last_run_key = run_key
+        job.last_accounts = accounts
+        job.last_total = total
+        print(f"ECONOMY JOB {job.name.upper()}: {accounts} accounts, total {total:+.2f} for {run_key}")
+
+    async def _checkpoint(self, job: EconomyJob, run_key: str):
+        data, status = await supabase.request("POST", "economy_job_runs", data={
+            "job": job.name,
+            "run_key": run_key
+        }, headers={
+            "Content-Type": "application/json",
+            "Prefer": "resolution=ignore-duplicates,return=minimal"
+        })
+        if status not in (200, 201, 204, 409):
+            print("ECONOMY JOB CHECKPOINT ERROR:", status, data)
+            return None
+
+        data, status = await supabase_get("economy_job_runs", f"?job=eq.{job.name}&run_key=eq.{run_key}")
+        if status != 200 or not isinstance(data, list) or not data:
+            print("ECONOMY JOB CHECKPOINT ERROR:", status, data)
+            return None
+        return data[0]
+
+economy_scheduler = EconomyScheduler([
+    EconomyJob("interest", interest_deltas, lambda: ECONOMY_INTEREST_RATE > 0),
+    EconomyJob("wealth_tax", wealth_tax_deltas, lambda: ECONOMY_WEALTH_TAX_RATE > 0)
+], ECONOMY_JOB_TICK, ECONOMY_JOB_CHUNK)
+
+# ============================================================
+# HTTP API (FASTAPI ON THE BOT'S EVENT LOOP)
+# ============================================================
+# Loopback by default; set API_HOST=0.0.0.0 to expose /metrics and the plugin endpoints.
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", "8080"))
+
+api = FastAPI()
+
+class EmbeddedServer(uvicorn.Server):
+    """uvicorn server run as a task on the bot's loop; signal handling stays with discord.py."""
+
+    def install_signal_handlers(self):
+        pass
+
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
+
+    async def serve(self, sockets=None):
+        # uvicorn calls sys.exit(1) when it can't bind; that must not take the Discord bot down too.
+        try:
+            await super().serve(sockets)
+        except (SystemExit, OSError) as e:
+            print(f"API SERVER ERROR: could not serve on {self.config.host}:{self.config.port}:", repr(e))
+
+@api.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+metrics.register_collector("supabase_pool", lambda: supabase.pool_stats())
+metrics.register_collector("supabase_health", lambda: {
+    **supabase.health_stats(),
+    "breaker_open": int(supabase.breaker.state != "closed")
+})
+metrics.register_collector("account_cache", lambda: account_cache.stats())
+metrics.register_collector("faction_embed", lambda: faction_embed_refresher.stats())
+metrics.register_collector("faction_index", lambda: faction_index.stats())
+metrics.register_collector("order_book", lambda: market_engine.stats())
+metrics.register_collector("ledger", lambda: ledger.stats())
+metrics.register_collector("blackjack_tables", lambda: blackjack_tables.stats())
+metrics.register_collector("balance_write_behind", lambda: {
+    key: value for key, value in balance_write_behind.stats().items() if key != "enabled"
+})
+metrics.register_histogram("account_lock_wait_seconds", account_locks.wait_time)
+
+# ============================================================
+# MINECRAFT EVENT INGESTION (POST /mc/events)
+# ============================================================
+MC_PLUGIN_KEY = os.getenv("MC_PLUGIN_KEY")
+MC_EVENT_QUEUE_SIZE = int(os.getenv("MC_EVENT_QUEUE_SIZE", "5000"))
+MC_EVENT_FLUSH_INTERVAL = float(os.getenv("MC_EVENT_FLUSH_INTERVAL", "2"))
+MC_EVENT_RETRY_AFTER = 5
+MC_EVENTS_PER_EMBED = 20
+
+def format_mc_event(event: dict) -> str:
+    kind = event.get("type", "event")
+    player = event.get("player") or (event.get("uuid") or "?")[:8]
+    if kind == "join":
+        return f"📥 **{player}** joined the server"
+    if kind == "leave":
+        return f"📤 **{player}** left the server"
+    if kind == "delivery":
+        return f"📦 Delivered **{event.get('amount', '?')}x {event.get('item_type', '?')}** to **{player}**"
+    if kind == "sale":
+        return (
+            f"💰 **{player}** sold **{event.get('amount', '?')}x {event.get('item_type', '?')}** "
+            f"for **{event.get('price', '?')} WeirdCoins**"
+        )
+    return f"• `{kind}` — **{player}**"
+
+class McEventForwarder:
+    """Bounded in-memory buffer of plugin events, drained into batched embeds in MC_EVENT_CHANNEL.
+
+    Draining stops while the channel writer's queue is full, so when Discord falls behind the
+    events back up here and /mc/events answers 429 instead of losing them.
+    """
+
+    def __init__(self, maxsize: int, flush_interval: float):
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self.accepted = 0
+        self.rejected = 0
+        self.forwarded = 0
+        self.dropped = 0
+        self.deferred_flushes = 0
+        self._events = deque()
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def offer(self, events) -> bool:
+        # All-or-nothing, so the plugin can simply retry the whole batch after Retry-After.
+        if len(self._events) + len(events) > self.maxsize:
+            self.rejected += len(events)
+            return False
+        self._events.extend(events)
+        self.accepted += len(events)
+        self._ready.set()
+        return True
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def stats(self):
+        return {
+            "queue_depth": len(self._events),
+            "queue_size": self.maxsize,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "forwarded": self.forwarded,
+            "dropped": self.dropped,
+            "deferred_flushes": self.deferred_flushes
+        }
+
+    async def _run(self):
+        await bot.wait_until_ready()
+        while True:
+            await self._ready.wait()
+            await asyncio.sleep(self.flush_interval)
+            self._ready.clear()
+            try:
+                await self._flush()
+            except Exception as e:
+                print("MC EVENT FORWARD ERROR:", e)
+
+    async def _flush(self):
+        writer = get_channel_writer(MC_EVENT_CHANNEL)
+        while self._events:
+            if writer.full():
+                # Keep the rest buffered (and try again next interval) rather than drop it.
+                self.deferred_flushes += 1
+                self._ready.set()
+                return
+            lines = []
+            while self._events and len(lines) < MC_EVENTS_PER_EMBED:
+                lines.append(format_mc_event(self._events.popleft()))
+            sent = writer.send(discord.Embed(
+                title="⛏️ Minecraft Events",
+                description="\n".join(lines),
+                color=discord.Color.dark_green()
+            ))
+            if sent:
+                self.forwarded += len(lines)
+            else:
+                self.dropped += len(lines)
+
+mc_event_forwarder = McEventForwarder(MC_EVENT_QUEUE_SIZE, MC_EVENT_FLUSH_INTERVAL)
+
+def plugin_authorized(request: Request) -> bool:
+    # These endpoints change player state, so without a configured key they refuse everyone.
+    if not MC_PLUGIN_KEY:
+        return False
+    return hmac.compare_digest(request.headers.get("X-Plugin-Key", ""), MC_PLUGIN_KEY)
+
+@api.post("/mc/events")
+async def ingest_mc_events(request: Request):
+    if not plugin_authorized(request):
+        return JSONResponse({"error": "unauthorized"}, status_code=401)
+
+    try:
+        payload = await request.json()
+    except Exception:
+        return JSONResponse({"error": "invalid json"}, status_code=400)
+
+    events = payload.get("events") if isinstance(payload, dict) else payload
+    if not isinstance(events, list) or not all(isinstance(event, dict) for event in events):
+        return JSONResponse({"error": "expected a list of event objects"}, status_code=400)
+
+    if not mc_event_forwarder.offer(events):
+        return JSONResponse(
+            {"error": "event queue full", "accepted": 0},
+            status_code=429,
+            headers={"Retry-After": str(MC_EVENT_RETRY_AFTER)}
+        )
+    return {"accepted": len(events)}
+
+metrics.register_collector("mc_events", lambda: mc_event_forwarder.stats())
+
+# ============================================================
+# MINECRAFT DELIVERY QUEUE (sql/deliveries.sql)
+# ============================================================
+DELIVERY_CLAIM_LIMIT = int(os.getenv("DELIVERY_CLAIM_LIMIT", "500"))
+
+async def claim_deliveries(mc_uuids, limit: int = DELIVERY_CLAIM_LIMIT, after_id: int = 0):
+    data, status = await supabase_rpc("claim_deliveries", {
+        "p_uuids": list(mc_uuids),
+        "p_limit": limit,
+        "p_after_id": after_id
+    })
+    if status != 200 or not isinstance(data, list):
+        print("CLAIM DELIVERIES ERROR:", status, data)
+        return None
+    return sorted(data, key=lambda row: row["id"])
+
+async def ack_deliveries(delivery_ids):
+    data, status = await supabase_rpc("ack_deliveries", {"p_ids": list(delivery_ids)})
+    if status != 200 or not isinstance(data, list):
+        print("ACK DELIVERIES ERROR:", status, data)
+        return None
+    return [row["id"] for row in data]
+
+@api.post("/mc/deliveries/claim")
+async def claim_deliveries_endpoint(request: Request):
+    """Claim pending deliveries for many players at once: {"uuids": [...], "limit": 500, "after_id": 0}."""
+    if not plugin_authorized(request):
+        return JSONResponse({"error": "unauthorized"}, status_code=401)
+
+    try:
+        payload = await request.json()
+        uuids = [str(uuid) for uuid in payload["uuids"]]
+        limit = min(int(payload.get("limit", DELIVERY_CLAIM_LIMIT)), DELIVERY_CLAIM_LIMIT)
+        after_id = int(payload.get("after_id", 0))
+    except Exception:
+        return JSONResponse({"error": "expected {\"uuids\": [...]}"}, status_code=400)
+
+    if not uuids:
+        return {"deliveries": [], "next_after_id": None}
+
+    rows = await claim_deliveries(uuids, limit, after_id)
+    if rows is None:
+        return JSONResponse({"error": "claim failed"}, status_code=502)
+
+    metrics.inc("deliveries_claimed_total", value=len(rows))
+    # A full page means there may be more; the plugin calls again with next_after_id.
+    next_after_id = rows[-1]["id"] if len(rows) == limit else None
+    return {"deliveries": rows, "next_after_id": next_after_id}
+
+@api.post("/mc/deliveries/ack")
+async def ack_deliveries_endpoint(request: Request):
+    """Mark deliveries as delivered: {"ids": [...]}. Safe to repeat."""
+    if not plugin_authorized(request):
+        return JSONResponse({"error": "unauthorized"}, status_code=401)
+
+    try:
+        payload = await request.json()
+        ids = [int(delivery_id) for delivery_id in payload["ids"]]
+    except Exception:
+        return JSONResponse({"error": "expected {\"ids\": [...]}"}, status_code=400)
+
+    if not ids:
+        return {"acknowledged": []}
+
+    acknowledged = await ack_deliveries(ids)
+    if acknowledged is None:
+        return JSONResponse({"error": "ack failed"}, status_code=502)
+
+    metrics.inc("deliveries_acknowledged_total", value=len(acknowledged))
+    return {"acknowledged": acknowledged}
 
 # ============================================================
 # BOT STARTUP EVENT
@@ -1207,15 +4341,11 @@ async def on_ready():
         print("COMMAND SYNC ERROR:", e)
 
     # Optional: refresh faction embed on startup
-    try:
-        async with aiohttp.ClientSession() as session:
-            await refresh_faction_embed(session)
-    except Exception as e:
-        print("FACTION EMBED STARTUP REFRESH ERROR:", e)
+    faction_embed_refresher.mark_dirty()
 
 
 # ============================================================
-# RUN BOT (NORMAL DISCORD BOT, NO FASTAPI)
+# RUN BOT (FASTAPI IS SERVED FROM setup_hook ON THE SAME LOOP)
 # ============================================================
 if __name__ == "__main__":
     bot.run(DISCORD_TOKEN)
@@ -0,0 +1,144 @@
+"""Match-throughput benchmark for the in-memory order book.
+
+Usage:
+    python orderbook_bench.py [--resting 100000] [--takers 100000] [--levels 200] [--seed S]
+
+Fills one OrderBook from main.py with --resting non-crossing orders spread over --levels price
+levels on each side, then feeds it --takers incoming orders whose limits reach a few levels
+into the other side, exactly as MarketEngine.submit does: match, then rest whatever is left.
+Whenever the book drops below --resting, a passive order behind the best price is added (not
+timed), so matching runs against a full book the whole time instead of draining it.
+
+Reports build and match throughput, fills per second and per-taker latency percentiles, then
+checks that the book is not crossed and that its depth table agrees with its resting orders
+(exits non-zero if not).
+
+Only the matching is measured; persisting placements and fills is a Supabase round-trip each
+(see loadtest.py for that side).
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+# main.py reads its configuration at import time; nothing here talks to Supabase or Discord.
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "orderbook-bench")
+
+from main import Order, OrderBook  # noqa: E402
+
+MID_PRICE = 1000.0
+TRADERS = 1000
+
+def make_order(order_id: int, side: str, price: float, amount: int, trader: int) -> Order:
+    return Order({
+        "id": order_id,
+        "item_type": "DIAMOND",
+        "side": side,
+        "price": price,
+        "remaining": amount,
+        "discord_id": str(100_000 + trader),
+        "mc_uuid": f"uuid-{trader}"
+    })
+
+def percentile(sorted_values, pct: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def check_book(book: OrderBook):
+    failures = []
+    best_bid = book._best(book.bids)
+    best_ask = book._best(book.asks)
+    if best_bid is not None and best_ask is not None and best_bid.price >= best_ask.price:
+        failures.append(f"book is crossed: bid {best_bid.price} >= ask {best_ask.price}")
+    for side in ("bid", "ask"):
+        expected = {}
+        for order in book.orders.values():
+            if order.side == side:
+                expected[order.price] = expected.get(order.price, 0) + order.remaining
+        if expected != book.depth[side]:
+            failures.append(f"{side} depth does not match the resting orders")
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--resting", type=int, default=100_000, help="orders in the book before matching starts")
+    parser.add_argument("--takers", type=int, default=100_000, help="incoming orders to match")
+    parser.add_argument("--levels", type=int, default=200, help="price levels per side")
+    parser.add_argument("--max-amount", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    book = OrderBook("DIAMOND")
+    next_id = 1
+
+    start = time.perf_counter()
+    for _ in range(args.resting):
+        side = rng.choice(("bid", "ask"))
+        offset = rng.randint(1, args.levels)
+        price = MID_PRICE - offset if side == "bid" else MID_PRICE + offset
+        book.add(make_order(next_id, side, price, rng.randint(1, args.max_amount), rng.randrange(TRADERS)))
+        next_id += 1
+    build = time.perf_counter() - start
+    print(f"built {args.resting:,} resting orders in {build:.2f}s ({args.resting / build:,.0f} orders/s)")
+
+    def refill():
+        # Passive order behind the best price on its own side, so it can never cross.
+        nonlocal next_id
+        side = rng.choice(("bid", "ask"))
+        best = book._best(book.bids if side == "bid" else book.asks)
+        offset = rng.randint(0, args.levels)
+        if side == "bid":
+            price = (best.price if best is not None else MID_PRICE - 1) - offset
+        else:
+            price = (best.price if best is not None else MID_PRICE + 1) + offset
+        book.add(make_order(next_id, side, max(price, 1.0), rng.randint(1, args.max_amount), rng.randrange(TRADERS)))
+        next_id += 1
+
+    latencies = []
+    fills = 0
+    filled_amount = 0
+    smallest = largest = len(book.orders)
+    matching = 0.0
+    for _ in range(args.takers):
+        side = rng.choice(("bid", "ask"))
+        # Reach up to 5 levels past the best opposite price, so most takers fill at least partly.
+        opposite = book._best(book.asks if side == "bid" else book.bids)
+        reference = opposite.price if opposite is not None else MID_PRICE
+        reach = rng.randint(0, 5)
+        price = reference + reach if side == "bid" else reference - reach
+        taker = make_order(next_id, side, price, rng.randint(1, args.max_amount), rng.randrange(TRADERS))
+        next_id += 1
+
+        t0 = time.perf_counter()
+        matched = book.match(taker)
+        if taker.remaining > 0:
+            book.add(taker)
+        latencies.append(time.perf_counter() - t0)
+        matching += latencies[-1]
+        fills += len(matched)
+        filled_amount += sum(amount for _, amount, _ in matched)
+
+        if len(book.orders) < args.resting:
+            refill()
+        smallest = min(smallest, len(book.orders))
+        largest = max(largest, len(book.orders))
+    elapsed = matching
+
+    latencies.sort()
+    print(f"matched {args.takers:,} takers in {elapsed:.2f}s ({args.takers / elapsed:,.0f} takers/s), "
+          f"{fills:,} fills ({fills / elapsed:,.0f} fills/s), {filled_amount:,} items")
+    print(f"per taker: p50 {percentile(latencies, 50) * 1e6:.1f} us, p99 {percentile(latencies, 99) * 1e6:.1f} us, "
+          f"max {latencies[-1] * 1e6:.1f} us")
+    print(f"resting orders during the run: {smallest:,} to {largest:,}; after: {len(book.orders):,}, "
+          f"{len(book.depth['bid'])} bid levels, {len(book.depth['ask'])} ask levels")
+
+    failures = check_book(book)
+    for failure in failures:
+        print("CHECK FAILED:", failure)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+-- Delivery queue for purchased items.
+-- economy_purchase (economy_rpc.sql) inserts one pending row per completed purchase;
+-- the Minecraft plugin claims rows in bulk when players join and acknowledges them
+-- once the items are in the player's inventory.
+--
+--   pending -> claimed -> delivered
+--
+-- A claim that is never acknowledged (plugin crash, player left) becomes claimable
+-- again after p_reclaim_after.
+
+create table if not exists deliveries (
+    id bigserial primary key,
+    listing_id bigint references marketplace_listings (id),
+    mc_uuid text not null,
+    item_type text not null,
+    amount integer not null,
+    status text not null default 'pending',
+    claimed_at timestamptz,
+    delivered_at timestamptz,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists deliveries_undelivered_idx
+    on deliveries (mc_uuid, id)
+    where status <> 'delivered';
+
+create or replace function claim_deliveries(
+    p_uuids text[],
+    p_limit integer default 500,
+    p_after_id bigint default 0,
+    p_reclaim_after interval default interval '5 minutes'
+)
+returns setof deliveries
+language sql
+as $$
+    update deliveries d
+       set status = 'claimed', claimed_at = now()
+     where d.id in (
+        select id
+          from deliveries
+         where mc_uuid = any (p_uuids)
+           and id > p_after_id
+           and (status = 'pending'
+                or (status = 'claimed' and claimed_at < now() - p_reclaim_after))
+         order by id
+         limit p_limit
+           for update skip locked
+     )
+    returning d.*;
+$$;
+
+-- Idempotent: acknowledging an already delivered row is a no-op that still reports it.
+create or replace function ack_deliveries(p_ids bigint[])
+returns table (id bigint, status text)
+language sql
+as $$
+    update deliveries d
+       set status = 'delivered', delivered_at = coalesce(d.delivered_at, now())
+     where d.id = any (p_ids)
+    returning d.id, d.status;
+$$;
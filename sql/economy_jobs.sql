@@ -0,0 +1,20 @@
+-- Checkpoints for the bot's scheduled economy jobs (interest, wealth tax).
+-- One row per job per period (run_key, e.g. the UTC date for daily jobs). The bot walks
+-- accounts in discord_id order and stores the last discord_id it finished in cursor, so a
+-- restart resumes after it. Each chunk is applied through economy_apply_deltas with a batch
+-- id derived from (job, run_key, chunk start), so a chunk that was applied just before a
+-- crash is recognised and not applied again.
+
+create table if not exists economy_job_runs (
+    job text not null,
+    run_key text not null,
+    cursor text,
+    status text not null default 'running',
+    accounts integer not null default 0,
+    total_delta numeric not null default 0,
+    started_at timestamptz not null default now(),
+    updated_at timestamptz not null default now(),
+    primary key (job, run_key)
+);
+
+create index if not exists accounts_discord_id_idx on accounts (discord_id);
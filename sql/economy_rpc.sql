@@ -0,0 +1,280 @@
+-- Atomic balance operations, called through PostgREST as /rest/v1/rpc/<function>.
+-- Each function runs in one transaction and returns a jsonb object:
+--   {"ok": true, "balances": {"<discord_id>": <new balance>, ...}, ...}
+--   {"ok": false, "error": "<code>", ...}
+-- "balances" always carries the latest known balance of every account touched,
+-- so the bot can write them through to its in-process account cache. Successful calls that
+-- change a balance also return "applied_at", the database time just after the change, which
+-- the bot uses as the ledger row's created_at (see ledger.sql).
+
+create or replace function economy_credit(p_discord_id text, p_amount numeric)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_balance numeric;
+begin
+    if p_amount <= 0 then
+        return jsonb_build_object('ok', false, 'error', 'invalid_amount');
+    end if;
+
+    update accounts
+       set balance = balance + p_amount
+     where discord_id = p_discord_id
+    returning balance into v_balance;
+
+    if not found then
+        return jsonb_build_object('ok', false, 'error', 'account_not_found');
+    end if;
+
+    return jsonb_build_object(
+        'ok', true,
+        'applied_at', clock_timestamp(),
+        'balances', jsonb_build_object(p_discord_id, v_balance)
+    );
+end;
+$$;
+
+create or replace function economy_debit(p_discord_id text, p_amount numeric, p_clamp boolean default false)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_balance numeric;
+    v_new_balance numeric;
+begin
+    if p_amount <= 0 then
+        return jsonb_build_object('ok', false, 'error', 'invalid_amount');
+    end if;
+
+    select balance into v_balance
+      from accounts
+     where discord_id = p_discord_id
+       for update;
+
+    if not found then
+        return jsonb_build_object('ok', false, 'error', 'account_not_found');
+    end if;
+
+    if not p_clamp and v_balance < p_amount then
+        return jsonb_build_object(
+            'ok', false,
+            'error', 'insufficient_funds',
+            'balances', jsonb_build_object(p_discord_id, v_balance)
+        );
+    end if;
+
+    update accounts
+       set balance = greatest(balance - p_amount, 0)
+     where discord_id = p_discord_id
+    returning balance into v_new_balance;
+
+    return jsonb_build_object(
+        'ok', true,
+        'applied_at', clock_timestamp(),
+        'debited', v_balance - v_new_balance,
+        'balances', jsonb_build_object(p_discord_id, v_new_balance)
+    );
+end;
+$$;
+
+create or replace function economy_transfer(p_from text, p_to text, p_amount numeric)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_from numeric;
+    v_to numeric;
+begin
+    if p_amount <= 0 then
+        return jsonb_build_object('ok', false, 'error', 'invalid_amount');
+    end if;
+    if p_from = p_to then
+        return jsonb_build_object('ok', false, 'error', 'same_account');
+    end if;
+
+    -- Lock both rows in a stable order so concurrent transfers cannot deadlock.
+    perform 1
+       from accounts
+      where discord_id in (p_from, p_to)
+      order by discord_id
+        for update;
+
+    select balance into v_from from accounts where discord_id = p_from;
+    if not found then
+        return jsonb_build_object('ok', false, 'error', 'sender_not_found');
+    end if;
+
+    select balance into v_to from accounts where discord_id = p_to;
+    if not found then
+        return jsonb_build_object('ok', false, 'error', 'receiver_not_found');
+    end if;
+
+    if v_from < p_amount then
+        return jsonb_build_object(
+            'ok', false,
+            'error', 'insufficient_funds',
+            'balances', jsonb_build_object(p_from, v_from, p_to, v_to)
+        );
+    end if;
+
+    update accounts set balance = balance - p_amount where discord_id = p_from
+    returning balance into v_from;
+    update accounts set balance = balance + p_amount where discord_id = p_to
+    returning balance into v_to;
+
+    return jsonb_build_object(
+        'ok', true,
+        'applied_at', clock_timestamp(),
+        'balances', jsonb_build_object(p_from, v_from, p_to, v_to)
+    );
+end;
+$$;
+
+create or replace function economy_purchase(p_listing_id bigint, p_buyer_discord_id text)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_listing marketplace_listings%rowtype;
+    v_buyer accounts%rowtype;
+    v_cost numeric;
+    v_buyer_balance numeric;
+    v_seller_discord_id text;
+    v_seller_balance numeric;
+    v_balances jsonb;
+begin
+    select * into v_listing
+      from marketplace_listings
+     where id = p_listing_id
+       for update;
+
+    if not found then
+        return jsonb_build_object('ok', false, 'error', 'listing_not_found');
+    end if;
+    if v_listing.status <> 'active' then
+        return jsonb_build_object('ok', false, 'error', 'listing_unavailable');
+    end if;
+
+    -- Lock buyer and seller in a stable order so concurrent purchases cannot deadlock.
+    perform 1
+       from accounts
+      where discord_id = p_buyer_discord_id or mc_uuid = v_listing.seller_mc_uuid
+      order by discord_id
+        for update;
+
+    select * into v_buyer from accounts where discord_id = p_buyer_discord_id;
+    if not found then
+        return jsonb_build_object('ok', false, 'error', 'buyer_not_found');
+    end if;
+    if v_buyer.mc_uuid = v_listing.seller_mc_uuid then
+        return jsonb_build_object('ok', false, 'error', 'own_listing');
+    end if;
+
+    v_cost := v_listing.price * v_listing.amount;
+    if v_buyer.balance < v_cost then
+        return jsonb_build_object(
+            'ok', false,
+            'error', 'insufficient_funds',
+            'cost', v_cost,
+            'balances', jsonb_build_object(p_buyer_discord_id, v_buyer.balance)
+        );
+    end if;
+
+    update accounts set balance = balance - v_cost where discord_id = p_buyer_discord_id
+    returning balance into v_buyer_balance;
+    v_balances := jsonb_build_object(p_buyer_discord_id, v_buyer_balance);
+
+    update accounts set balance = balance + v_cost where mc_uuid = v_listing.seller_mc_uuid
+    returning discord_id, balance into v_seller_discord_id, v_seller_balance;
+    if v_seller_discord_id is not null then
+        v_balances := v_balances || jsonb_build_object(v_seller_discord_id, v_seller_balance);
+    end if;
+
+    update marketplace_listings
+       set status = 'sold', buyer_mc_uuid = v_buyer.mc_uuid, sold_at = now()
+     where id = p_listing_id;
+
+    -- Requires sql/price_history.sql.
+    perform record_sale(v_listing.item_type, v_listing.price, v_listing.amount, now(), p_listing_id);
+
+    -- Requires sql/deliveries.sql.
+    insert into deliveries (listing_id, mc_uuid, item_type, amount)
+    values (p_listing_id, v_buyer.mc_uuid, v_listing.item_type, v_listing.amount);
+
+    return jsonb_build_object(
+        'ok', true,
+        'applied_at', clock_timestamp(),
+        'item_type', v_listing.item_type,
+        'amount', v_listing.amount,
+        'cost', v_cost,
+        'balances', v_balances
+    );
+end;
+$$;
+
+-- Bulk balance deltas, used by the bot's write-behind buffer for game results.
+-- p_deltas: {"<discord_id>": <delta>, ...}. p_batch_id makes the call idempotent: a batch
+-- that is replayed after a crash or a lost response is acknowledged without being applied
+-- twice. Balances are clamped at 0 like economy_debit(p_clamp => true).
+create table if not exists applied_delta_batches (
+    batch_id text primary key,
+    applied_at timestamptz not null default now()
+);
+
+create or replace function economy_apply_deltas(p_batch_id text, p_deltas jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_entry record;
+    v_old_balance numeric;
+    v_balance numeric;
+    v_balances jsonb := '{}'::jsonb;
+    v_applied jsonb := '{}'::jsonb;
+    v_missing jsonb := '[]'::jsonb;
+begin
+    insert into applied_delta_batches (batch_id) values (p_batch_id)
+    on conflict (batch_id) do nothing;
+
+    if not found then
+        select coalesce(jsonb_object_agg(discord_id, balance), '{}'::jsonb) into v_balances
+          from accounts
+         where discord_id in (select jsonb_object_keys(p_deltas));
+        return jsonb_build_object('ok', true, 'duplicate', true, 'balances', v_balances);
+    end if;
+
+    -- Stable order so concurrent batches cannot deadlock.
+    for v_entry in
+        select key as discord_id, value::numeric as delta
+          from jsonb_each_text(p_deltas)
+         order by key
+    loop
+        select balance into v_old_balance
+          from accounts
+         where discord_id = v_entry.discord_id
+           for update;
+
+        if not found then
+            v_missing := v_missing || to_jsonb(v_entry.discord_id);
+            continue;
+        end if;
+
+        update accounts
+           set balance = greatest(balance + v_entry.delta, 0)
+         where discord_id = v_entry.discord_id
+        returning balance into v_balance;
+
+        v_balances := v_balances || jsonb_build_object(v_entry.discord_id, v_balance);
+        v_applied := v_applied || jsonb_build_object(v_entry.discord_id, v_balance - v_old_balance);
+    end loop;
+
+    return jsonb_build_object(
+        'ok', true,
+        'applied_at', clock_timestamp(),
+        'balances', v_balances,
+        'applied', v_applied,
+        'missing', v_missing
+    );
+end;
+$$;
@@ -0,0 +1,47 @@
+-- factions.member_count maintenance.
+-- Faction commands adjust the counter with faction_adjust_member_count instead of counting
+-- the member rows on every join/leave/create. faction_repair_member_counts() recounts every
+-- faction and fixes any that drifted (failed adjustments, edits made outside the bot); the
+-- bot runs it periodically.
+-- The id arrives as text (PostgREST passes the JSON value through); it is cast to the column's
+-- bigint type, not the other way round, so the update can use the factions primary key.
+
+create index if not exists faction_members_faction_idx on faction_members (faction_id);
+
+create or replace function faction_adjust_member_count(p_faction_id text, p_delta integer)
+returns integer
+language plpgsql
+as $$
+declare
+    v_count integer;
+begin
+    update factions
+       set member_count = greatest(coalesce(member_count, 0) + p_delta, 0)
+     where id = p_faction_id::bigint
+    returning member_count into v_count;
+    return v_count;
+end;
+$$;
+
+create or replace function faction_repair_member_counts()
+returns integer
+language plpgsql
+as $$
+declare
+    v_fixed integer;
+begin
+    update factions f
+       set member_count = c.actual
+      from (
+            select f2.id, count(m.player_uuid)::integer as actual
+              from factions f2
+              left join faction_members m on m.faction_id = f2.id
+             group by f2.id
+           ) c
+     where f.id = c.id
+       and f.member_count is distinct from c.actual;
+
+    get diagnostics v_fixed = row_count;
+    return v_fixed;
+end;
+$$;
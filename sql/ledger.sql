@@ -0,0 +1,89 @@
+-- Append-only balance ledger.
+-- The bot buffers one row per balance change (see LedgerWriter in main.py) and inserts
+-- them in batches; entry_id is generated client-side so a retried batch is ignored
+-- instead of duplicated. created_at is the time the change was applied, not insert time:
+-- the economy RPCs return it as "applied_at" (clock_timestamp() after their updates).
+--
+-- ledger_snapshot() copies every balance into balance_snapshots. balance_at() starts from
+-- the newest snapshot at or before p_at and replays only the ledger rows after it. The
+-- snapshot holds a SHARE lock on accounts while it reads them, so every change committed
+-- before it has applied_at < taken_at and every change after it has applied_at > taken_at:
+-- no change is counted by both the snapshot and the replay, or by neither.
+
+create table if not exists ledger (
+    id bigserial primary key,
+    entry_id uuid not null unique,
+    discord_id text not null,
+    delta numeric not null,
+    balance_after numeric,       -- balance once the whole operation was applied
+    reason text not null,
+    ref text,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists ledger_account_idx on ledger (discord_id, id);
+create index if not exists ledger_account_time_idx on ledger (discord_id, created_at);
+
+create table if not exists balance_snapshots (
+    id bigserial primary key,
+    discord_id text not null,
+    balance numeric not null,
+    taken_at timestamptz not null default now()
+);
+
+create index if not exists balance_snapshots_account_idx on balance_snapshots (discord_id, taken_at);
+-- The bot reads the newest taken_at at startup to know when the next snapshot is due.
+create index if not exists balance_snapshots_taken_idx on balance_snapshots (taken_at);
+
+create or replace function ledger_snapshot()
+returns integer
+language plpgsql
+as $$
+declare
+    v_count integer;
+    v_taken_at timestamptz;
+begin
+    -- Waits for in-flight balance changes to commit and holds off new ones until we're done.
+    lock table accounts in share mode;
+    v_taken_at := clock_timestamp();
+
+    insert into balance_snapshots (discord_id, balance, taken_at)
+    select discord_id, balance, v_taken_at
+      from accounts
+     where discord_id is not null;
+
+    get diagnostics v_count = row_count;
+    return v_count;
+end;
+$$;
+
+create or replace function balance_at(p_discord_id text, p_at timestamptz default now())
+returns numeric
+language plpgsql
+stable
+as $$
+declare
+    v_balance numeric := 0;
+    v_from timestamptz := '-infinity';
+    v_delta numeric;
+begin
+    select balance, taken_at into v_balance, v_from
+      from balance_snapshots
+     where discord_id = p_discord_id and taken_at <= p_at
+     order by taken_at desc
+     limit 1;
+
+    if not found then
+        v_balance := 0;
+        v_from := '-infinity';
+    end if;
+
+    select coalesce(sum(delta), 0) into v_delta
+      from ledger
+     where discord_id = p_discord_id
+       and created_at > v_from
+       and created_at <= p_at;
+
+    return v_balance + v_delta;
+end;
+$$;
@@ -0,0 +1,23 @@
+-- Indexes backing /market and /soldlistings keyset pagination and filters.
+-- Every query filters on status and orders by (sort column, id).
+
+create index if not exists marketplace_listings_status_id_idx
+    on marketplace_listings (status, id);
+
+create index if not exists marketplace_listings_status_price_idx
+    on marketplace_listings (status, price, id);
+
+create index if not exists marketplace_listings_status_item_price_idx
+    on marketplace_listings (status, item_type, price, id);
+
+create index if not exists marketplace_listings_seller_status_idx
+    on marketplace_listings (seller_mc_uuid, status, id);
+
+-- Distinct item types, used to seed the bot's autocomplete index at startup.
+create or replace function market_item_types()
+returns table (item_type text)
+language sql
+stable
+as $$
+    select distinct item_type from marketplace_listings;
+$$;
@@ -0,0 +1,175 @@
+-- Limit order book for the marketplace (requires economy_rpc.sql and deliveries.sql).
+-- The bot keeps every open order in memory and does the matching itself; these
+-- functions persist placements, fills and cancellations atomically.
+--
+-- Bids escrow price * amount from the buyer when placed. A fill executes at the
+-- resting (maker) order's price, credits the seller, refunds the buyer any price
+-- improvement and queues a delivery for the buyer.
+
+create table if not exists market_orders (
+    id bigserial primary key,
+    item_type text not null,
+    side text not null check (side in ('bid', 'ask')),
+    price numeric not null check (price > 0),
+    amount integer not null check (amount > 0),
+    remaining integer not null check (remaining >= 0),
+    discord_id text not null,
+    mc_uuid text not null,
+    status text not null default 'open',
+    created_at timestamptz not null default now()
+);
+
+create index if not exists market_orders_open_idx
+    on market_orders (id)
+    where status = 'open';
+
+create index if not exists market_orders_owner_idx
+    on market_orders (discord_id, status, id);
+
+create or replace function market_place_order(
+    p_discord_id text,
+    p_item_type text,
+    p_side text,
+    p_price numeric,
+    p_amount integer
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_account accounts%rowtype;
+    v_balance numeric;
+    v_cost numeric;
+    v_order market_orders%rowtype;
+begin
+    if p_amount <= 0 or p_price <= 0 or p_side not in ('bid', 'ask') then
+        return jsonb_build_object('ok', false, 'error', 'invalid_order');
+    end if;
+
+    select * into v_account from accounts where discord_id = p_discord_id for update;
+    if not found or v_account.mc_uuid is null then
+        return jsonb_build_object('ok', false, 'error', 'account_not_found');
+    end if;
+
+    v_balance := v_account.balance;
+    if p_side = 'bid' then
+        v_cost := p_price * p_amount;
+        if v_balance < v_cost then
+            return jsonb_build_object(
+                'ok', false,
+                'error', 'insufficient_funds',
+                'cost', v_cost,
+                'balances', jsonb_build_object(p_discord_id, v_balance)
+            );
+        end if;
+        update accounts set balance = balance - v_cost where discord_id = p_discord_id
+        returning balance into v_balance;
+    end if;
+
+    insert into market_orders (item_type, side, price, amount, remaining, discord_id, mc_uuid)
+    values (p_item_type, p_side, p_price, p_amount, p_amount, p_discord_id, v_account.mc_uuid)
+    returning * into v_order;
+
+    return jsonb_build_object(
+        'ok', true,
+        'applied_at', clock_timestamp(),
+        'order', to_jsonb(v_order),
+        'balances', jsonb_build_object(p_discord_id, v_balance)
+    );
+end;
+$$;
+
+-- p_fills: [{"bid_id": ..., "ask_id": ..., "amount": ..., "price": ...}, ...]
+-- All fills are applied in one transaction; any stale fill aborts the whole batch.
+create or replace function market_settle_fills(p_fills jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_fill jsonb;
+    v_bid market_orders%rowtype;
+    v_ask market_orders%rowtype;
+    v_amount integer;
+    v_price numeric;
+    v_balance numeric;
+    v_balances jsonb := '{}'::jsonb;
+begin
+    for v_fill in select * from jsonb_array_elements(p_fills) loop
+        v_amount := (v_fill ->> 'amount')::integer;
+        v_price := (v_fill ->> 'price')::numeric;
+
+        select * into v_bid from market_orders where id = (v_fill ->> 'bid_id')::bigint for update;
+        select * into v_ask from market_orders where id = (v_fill ->> 'ask_id')::bigint for update;
+
+        if v_bid.id is null or v_ask.id is null
+           or v_bid.side <> 'bid' or v_ask.side <> 'ask'
+           or v_bid.status <> 'open' or v_ask.status <> 'open'
+           or v_bid.item_type <> v_ask.item_type
+           or v_bid.remaining < v_amount or v_ask.remaining < v_amount
+           or v_bid.price < v_price or v_ask.price > v_price then
+            raise exception 'stale fill: bid % ask %', v_fill ->> 'bid_id', v_fill ->> 'ask_id';
+        end if;
+
+        update market_orders
+           set remaining = remaining - v_amount,
+               status = case when remaining - v_amount = 0 then 'filled' else 'open' end
+         where id in (v_bid.id, v_ask.id);
+
+        update accounts set balance = balance + v_amount * v_price
+         where discord_id = v_ask.discord_id
+        returning balance into v_balance;
+        v_balances := v_balances || jsonb_build_object(v_ask.discord_id, v_balance);
+
+        if v_bid.price > v_price then
+            update accounts set balance = balance + v_amount * (v_bid.price - v_price)
+             where discord_id = v_bid.discord_id
+            returning balance into v_balance;
+            v_balances := v_balances || jsonb_build_object(v_bid.discord_id, v_balance);
+        end if;
+
+        insert into deliveries (mc_uuid, item_type, amount)
+        values (v_bid.mc_uuid, v_bid.item_type, v_amount);
+
+        -- Requires sql/price_history.sql.
+        perform record_sale(v_bid.item_type, v_price, v_amount);
+    end loop;
+
+    return jsonb_build_object('ok', true, 'applied_at', clock_timestamp(), 'balances', v_balances);
+end;
+$$;
+
+create or replace function market_cancel_order(p_order_id bigint, p_discord_id text)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_order market_orders%rowtype;
+    v_refund numeric := 0;
+    v_balance numeric;
+begin
+    select * into v_order from market_orders where id = p_order_id for update;
+    if not found or v_order.discord_id <> p_discord_id then
+        return jsonb_build_object('ok', false, 'error', 'order_not_found');
+    end if;
+    if v_order.status <> 'open' then
+        return jsonb_build_object('ok', false, 'error', 'order_closed');
+    end if;
+
+    update market_orders set status = 'cancelled' where id = p_order_id;
+
+    if v_order.side = 'bid' then
+        v_refund := v_order.remaining * v_order.price;
+        update accounts set balance = balance + v_refund where discord_id = p_discord_id
+        returning balance into v_balance;
+        return jsonb_build_object(
+            'ok', true,
+            'applied_at', clock_timestamp(),
+            'item_type', v_order.item_type,
+            'refund', v_refund,
+            'balances', jsonb_build_object(p_discord_id, v_balance)
+        );
+    end if;
+
+    return jsonb_build_object('ok', true, 'item_type', v_order.item_type, 'refund', 0);
+end;
+$$;
@@ -0,0 +1,104 @@
+-- Price history for /price.
+-- Every completed sale (economy_purchase in economy_rpc.sql, market_settle_fills in
+-- order_book.sql) calls record_sale, which appends one row to sale_history and folds it
+-- into the hourly and daily OHLC buckets for its item_type. Reads only touch the buckets.
+--
+-- price_history_backfill() replays sold marketplace_listings that are not in sale_history
+-- yet; it is safe to run more than once.
+
+alter table marketplace_listings add column if not exists sold_at timestamptz;
+
+create table if not exists sale_history (
+    id bigserial primary key,
+    item_type text not null,
+    price numeric not null,      -- per item
+    amount integer not null,
+    sold_at timestamptz not null default now(),
+    listing_id bigint unique references marketplace_listings (id)
+);
+
+create table if not exists price_buckets (
+    item_type text not null,
+    bucket text not null check (bucket in ('1h', '1d')),
+    bucket_start timestamptz not null,
+    open numeric not null,
+    high numeric not null,
+    low numeric not null,
+    close numeric not null,
+    volume bigint not null,
+    trades integer not null,
+    first_at timestamptz not null,
+    last_at timestamptz not null,
+    primary key (item_type, bucket, bucket_start)
+);
+
+create or replace function record_sale(
+    p_item_type text,
+    p_price numeric,
+    p_amount integer,
+    p_sold_at timestamptz default now(),
+    p_listing_id bigint default null
+)
+returns boolean
+language plpgsql
+as $$
+declare
+    v_bucket text;
+begin
+    insert into sale_history (item_type, price, amount, sold_at, listing_id)
+    values (p_item_type, p_price, p_amount, p_sold_at, p_listing_id)
+    on conflict (listing_id) do nothing;
+
+    if not found then
+        return false;
+    end if;
+
+    foreach v_bucket in array array['1h', '1d'] loop
+        insert into price_buckets as b (
+            item_type, bucket, bucket_start,
+            open, high, low, close, volume, trades, first_at, last_at
+        )
+        values (
+            p_item_type, v_bucket,
+            date_trunc(case v_bucket when '1h' then 'hour' else 'day' end, p_sold_at),
+            p_price, p_price, p_price, p_price, p_amount, 1, p_sold_at, p_sold_at
+        )
+        on conflict (item_type, bucket, bucket_start) do update
+           set open = case when excluded.first_at < b.first_at then excluded.open else b.open end,
+               close = case when excluded.last_at >= b.last_at then excluded.close else b.close end,
+               high = greatest(b.high, excluded.high),
+               low = least(b.low, excluded.low),
+               volume = b.volume + excluded.volume,
+               trades = b.trades + 1,
+               first_at = least(b.first_at, excluded.first_at),
+               last_at = greatest(b.last_at, excluded.last_at);
+    end loop;
+
+    return true;
+end;
+$$;
+
+-- Listings sold before sold_at existed have no timestamp and are bucketed at backfill time.
+create or replace function price_history_backfill()
+returns integer
+language plpgsql
+as $$
+declare
+    v_listing marketplace_listings%rowtype;
+    v_count integer := 0;
+begin
+    for v_listing in
+        select l.*
+          from marketplace_listings l
+         where l.status = 'sold'
+           and not exists (select 1 from sale_history h where h.listing_id = l.id)
+         order by l.id
+    loop
+        if record_sale(v_listing.item_type, v_listing.price, v_listing.amount,
+                       coalesce(v_listing.sold_at, now()), v_listing.id) then
+            v_count := v_count + 1;
+        end if;
+    end loop;
+    return v_count;
+end;
+$$;